@@ -23,8 +23,10 @@ python3 address.py  # Запуск в интерактивном режиме
 
 import asyncio
 import csv
+import hashlib
 import json
 import logging
+import os
 import re
 import sys
 import time
@@ -38,89 +40,122 @@ try:
 except ImportError:
     HTMLParser = None
 
-# Встроенные классы
-import httpx
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut, GeocoderServiceError
+from antibot import AntiBotClient, ChallengeDetected, SiteBlocked
+from availability import AvailabilityCache
+from geocoding import GeocodingService
 
 
-class AntiBotClient:
-    """HTTP клиент с поддержкой cookies для обхода защиты."""
+# Номер страницы в ссылках пагинации каталога (?page=N или битриксовый ?PAGEN_1=N)
+PAGE_PARAM_RE = re.compile(r'[?&](?:page|PAGEN_\d+)=(\d+)')
 
-    def __init__(self, concurrency: int = 10, timeout: int = 30):
-        self.semaphore = asyncio.Semaphore(concurrency)
-        self.timeout = timeout
-        self.cookies = {}
-        self.client = None  # Храним клиент
+# Категории готовой еды для проверки доступности (как в moscow_improved.py)
+AVAILABILITY_CATEGORIES = [
+    "/goods/gotovaya-eda/",
+    "/goods/gotovaya-eda/novinki/",
+    "/goods/gotovaya-eda/vtorye-blyuda/",
+    "/goods/gotovaya-eda/vtorye-blyuda/vtorye-blyuda-s-myasom/",
+    "/goods/gotovaya-eda/vtorye-blyuda/vtorye-blyuda-s-ptitsey/",
+    "/goods/gotovaya-eda/vtorye-blyuda/vtorye-blyuda-s-ryboy-i-moreproduktami/",
+    "/goods/gotovaya-eda/vtorye-blyuda/garniry-i-vtorye-blyuda-bez-myasa/",
+    "/goods/gotovaya-eda/vtorye-blyuda/pasta-pitstsa/",
+    "/goods/gotovaya-eda/salaty/",
+    "/goods/gotovaya-eda/sendvichi-shaurma-i-burgery/",
+    "/goods/gotovaya-eda/bolshe-belka-menshe-kaloriy/",
+    "/goods/gotovaya-eda/bolshe-belka-menshe-kaloriy/malo-kaloriy/",
+    "/goods/gotovaya-eda/bolshe-belka-menshe-kaloriy/bolshe-belka/",
+    "/goods/gotovaya-eda/okroshki-i-letnie-supy/",
+    "/goods/gotovaya-eda/supy/",
+    "/goods/gotovaya-eda/zavtraki/",
+    "/goods/gotovaya-eda/zavtraki/bliny-i-oladi/",
+    "/goods/gotovaya-eda/zavtraki/syrniki-zapekanki-i-rikotniki/",
+    "/goods/gotovaya-eda/zavtraki/omlety-i-zavtraki-s-yaytsom/",
+    "/goods/gotovaya-eda/zavtraki/kashi/",
+    "/goods/gotovaya-eda/zakuski/",
+    "/goods/gotovaya-eda/rolly-i-sety/",
+    "/goods/gotovaya-eda/onigiri/",
+    "/goods/gotovaya-eda/pirogi-pirozhki-i-lepyeshki/",
+    "/goods/gotovaya-eda/privezem-goryachim/",
+    "/goods/gotovaya-eda/privezem-goryachim/goryachie-napitki/",
+    "/goods/gotovaya-eda/tarelka-zdorovogo-pitaniya/",
+    "/goods/gotovaya-eda/veganskie-i-postnye-blyuda/",
+    "/goods/gotovaya-eda/semeynyy-format/",
+    "/goods/gotovaya-eda/kombo-na-kazhdyy-den/",
+    "/goods/gotovaya-eda/kukhni-mira/",
+    "/goods/gotovaya-eda/kukhni-mira/aziatskaya-kukhnya/",
+    "/goods/gotovaya-eda/kukhni-mira/russkaya-kukhnya/",
+    "/goods/gotovaya-eda/kukhni-mira/kukhnya-kavkaza/",
+    "/goods/gotovaya-eda/kukhni-mira/sredizemnomorskaya-kukhnya/",
+    "/goods/gotovaya-eda/bliny-i-oladi/",
+    "/goods/gotovaya-eda/khalyal/"
+]
 
-    async def _ensure_client(self):
-        """Создание или переиспользование клиента."""
-        if self.client is None:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'ru-RU,ru;q=0.8,en-US;q=0.5,en;q=0.3',
-                'Accept-Encoding': 'gzip, deflate',
-                'Connection': 'keep-alive',
-                'Upgrade-Insecure-Requests': '1',
-            }
-            self.client = httpx.AsyncClient(
-                timeout=self.timeout,
-                headers=headers,
-                cookies=self.cookies,
-                follow_redirects=True,
-                limits=httpx.Limits(max_keepalive_connections=5, max_connections=10)
-            )
-        return self.client
+# Отпечаток зоны доставки снимается всегда по одним и тем же страницам
+ZONE_PROBE_CATEGORIES = AVAILABILITY_CATEGORIES[:2]
 
-    async def request(self, method: str, url: str, **kwargs):
-        """Выполнить HTTP запрос с сохранением cookies."""
-        async with self.semaphore:
-            client = await self._ensure_client()
-            try:
-                response = await client.request(method, url, **kwargs)
-                # Обновляем cookies
-                self.cookies.update(response.cookies)
-                return response
-            except httpx.TimeoutException:
-                # При таймауте пересоздаем клиент
-                await self.close()
-                self.client = None
-                raise
+# Выход категорий при проверке доступности (CATEGORY_YIELD_PATH переопределяет путь)
+CATEGORY_YIELD_PATH = "data/category_yield.json"
 
-    async def close(self):
-        """Закрытие клиента."""
-        if self.client:
-            await self.client.aclose()
-            self.client = None
 
-class LocationService:
-    """Простой сервис геолокации."""
+class CategoryYield:
+    """Сколько сопоставленных с базой товаров давала категория при проверке доступности.
     
-    def __init__(self):
-        self.nominatim = Nominatim(user_agent="vkusvill-scraper/1.0")
-        # Популярные адреса
-        self.test_addresses = {
-            "Москва, Красная площадь, 1": (55.7539, 37.6208),
-            "Москва, Тверская улица, 1": (55.7558, 37.6176),
-            "Санкт-Петербург, Невский проспект, 1": (59.9311, 30.3609),
-        }
-        
-    async def geocode_address(self, address: str) -> Optional[tuple]:
-        """Геокодировать адрес в координаты."""
-        # Проверяем популярные адреса
-        if address in self.test_addresses:
-            return self.test_addresses[address]
-            
-        try:
-            location = self.nominatim.geocode(address, timeout=10)
-            if location:
-                return (location.latitude, location.longitude)
-        except (GeocoderTimedOut, GeocoderServiceError):
-            pass
-            
-        # Возвращаем Москву по умолчанию
-        return (55.7558, 37.6176)
+    Категории с большим выходом на страницу проверяются первыми, а по сумме
+    выхода оценивается, сколько категорий нужно для небольшого лимита.
+    """
+    
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        # category -> {'matched': товаров из базы, 'pages': страниц с товарами}
+        self.categories: Dict[str, Dict[str, float]] = {}
+    
+    @classmethod
+    def load(cls, path: Optional[str]) -> 'CategoryYield':
+        stats = cls(path)
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    stats.categories = json.load(f)
+            except (OSError, ValueError):
+                stats.categories = {}
+        return stats
+    
+    def save(self):
+        if not self.path:
+            return
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(self.categories, f, ensure_ascii=False)
+    
+    def record(self, category: str, matched: int, pages: int):
+        """Учесть полностью проверенную категорию (скользящее среднее с прошлыми)."""
+        known = self.categories.get(category)
+        if known is None:
+            self.categories[category] = {'matched': matched, 'pages': pages}
+        else:
+            known['matched'] = (known['matched'] + matched) / 2
+            known['pages'] = (known['pages'] + pages) / 2
+    
+    def order(self, categories: List[str]) -> List[str]:
+        """Категории по убыванию выхода на страницу; непроверенные - после них."""
+        def rate(category):
+            known = self.categories.get(category)
+            if known is None:
+                return -1.0
+            return known['matched'] / max(known['pages'], 1)
+        return sorted(categories, key=rate, reverse=True)
+    
+    def window(self, categories: List[str], limit: int) -> Optional[int]:
+        """Сколько категорий проверять одновременно, чтобы набрать limit (None - все)."""
+        expected = 0.0
+        for count, category in enumerate(categories, 1):
+            known = self.categories.get(category)
+            if known is None:
+                return None
+            expected += known['matched']
+            # С запасом: выход по адресу бывает меньше, чем в прошлый раз
+            if expected >= limit * 1.5:
+                return max(count, 2)
+        return None
 
 
 class VkusvillFastParser:
@@ -130,6 +165,20 @@ class VkusvillFastParser:
         self.antibot_client = antibot_client
         self.BASE_URL = "https://vkusvill.ru"
         self.heavy_data = {}  # База данных тяжелого парсера
+        # Порядок категорий при проверке доступности - по выходу в прошлых проверках
+        self.category_yield = CategoryYield.load(
+            os.getenv("CATEGORY_YIELD_PATH", str(Path(__file__).parent / CATEGORY_YIELD_PATH)))
+        # Доступные товары по ячейкам геосетки (AVAILABILITY_TTL=0 отключает кэш)
+        availability_cache = AvailabilityCache.from_env()
+        self.availability_cache = availability_cache if availability_cache.ttl > 0 else None
+        # Фоновые обновления кэша доступности по ячейкам
+        self._availability_tasks: Dict[str, asyncio.Task] = {}
+        # Отпечаток зоны доставки по паре страниц каталога (ZONE_PROBE=0 отключает)
+        self.zone_probe = os.getenv("ZONE_PROBE", "1") == "1"
+        self.zone_stats = {'probes': 0, 'known_zones': 0, 'new_zones': 0}
+        # Дозаполнять кэш ячейки полным обходом в фоне, если проверка остановилась
+        # на лимите (AVAILABILITY_BACKGROUND_SCAN=1); по умолчанию запросов сверх лимита нет
+        self.background_scan = os.getenv("AVAILABILITY_BACKGROUND_SCAN", "0") == "1"
 
     def load_heavy_data(self, heavy_file_path: str = None):
         """Загрузка данных тяжелого парсера."""
@@ -166,49 +215,101 @@ class VkusvillFastParser:
         print(f"⚡ Начинаем быстрый парсинг на {limit} товаров...")
         print(f"📍 Локация: {address or city}")
         
-        # Установка локации
-        await self._set_location(city, coords)
-        
-        # Сначала получаем список доступных товаров по адресу
-        print(f"🔍 Проверяем доступность товаров по адресу...")
-        available_product_ids = await self._get_available_products(coords)
-        print(f"📦 По адресу доступно: {len(available_product_ids)} товаров")
+        # Соседние адреса обслуживает тот же магазин - берем доступность ячейки из кэша
+        cell = self.availability_cache.cell(coords) if self.heavy_data and self.availability_cache else None
+        if cell:
+            cached = await self.availability_cache.get(cell)
+            if cached:
+                available_ids, age, _ = cached
+                if age > self.availability_cache.ttl:
+                    # Устаревшая запись отдается сразу, а обновляется в фоне
+                    self._start_availability_task(cell, self._refresh_availability(city, coords, [cell]))
+                products = [self._product_from_heavy(product_id)
+                            for product_id in available_ids if product_id in self.heavy_data][:limit]
+                print(f"💾 Доступность из кэша ячейки {cell} ({age/60:.0f} мин назад): {len(available_ids)} товаров")
+                print(f"⚡ Быстрый парсинг завершен: {len(products)} товаров")
+                return products
         
-        products = []
+        # Установка локации, параллельно прогреваем пул соединений
+        await asyncio.gather(self._set_location(city, coords), self.antibot_client.warmup(self.BASE_URL))
         
-        # Если есть база тяжелого парсера - сопоставляем с доступными товарами
-        if self.heavy_data and available_product_ids:
-            print(f"📚 Сопоставляем с базой тяжелого парсера...")
-            matched_count = 0
-            
-            for product_id in available_product_ids[:limit]:
-                if product_id in self.heavy_data:
-                    heavy_product = self.heavy_data[product_id]
-                    # Определяем подкатегорию для товаров из базы
-                    subcategory = self._determine_subcategory(
-                        heavy_product.get('url', ''), 
-                        heavy_product.get('name', '')
-                    )
-                    product = {
-                        'id': heavy_product.get('id', product_id),
-                        'name': heavy_product.get('name', ''),
-                        'price': heavy_product.get('price', ''),
-                        'category': subcategory,
-                        'url': heavy_product.get('url', ''),
-                        'shop': 'vkusvill_address',
-                        'photo': heavy_product.get('photo', ''),
-                        'composition': heavy_product.get('composition', ''),
-                        'tags': heavy_product.get('tags', ''),
-                        'portion_g': heavy_product.get('portion_g', ''),
-                        'kcal_100g': heavy_product.get('kcal_100g', ''),
-                        'protein_100g': heavy_product.get('protein_100g', ''),
-                        'fat_100g': heavy_product.get('fat_100g', ''),
-                        'carb_100g': heavy_product.get('carb_100g', '')
-                    }
-                    products.append(product)
-                    matched_count += 1
+        # Если есть база тяжелого парсера - сопоставляем с доступными товарами,
+        # пока они находятся: как только набран лимит, проверка останавливается
+        if self.heavy_data:
+            categories = self.category_yield.order(AVAILABILITY_CATEGORIES)
+            # Ключи кэша, под которыми сохранится результат: ячейка и зона доставки
+            cache_keys = [cell] if cell else []
+            if cell and self.zone_probe:
+                zone = await self._probe_zone(ZONE_PROBE_CATEGORIES)
+                if zone:
+                    cached = await self.availability_cache.get(zone)
+                    if cached:
+                        # Адрес обслуживает уже известный магазин - полный обход не нужен
+                        self.zone_stats['known_zones'] += 1
+                        available_ids, age, checked_at = cached
+                        # Ячейка наследует время проверки зоны, а не получает свежую метку
+                        await self.availability_cache.put(cell, available_ids, ts=checked_at)
+                        if age > self.availability_cache.ttl:
+                            self._start_availability_task(
+                                zone, self._refresh_availability(city, coords, [zone, cell]))
+                        products = [self._product_from_heavy(product_id)
+                                    for product_id in available_ids if product_id in self.heavy_data][:limit]
+                        print(f"🧭 Зона доставки {zone} уже известна: {len(available_ids)} товаров")
+                        print(f"⚡ Быстрый парсинг завершен: {len(products)} товаров")
+                        return products
+                    self.zone_stats['new_zones'] += 1
+                    cache_keys.append(zone)
+            print(f"🔍 Проверяем доступность товаров по адресу...")
+            window = self.category_yield.window(categories, limit)
+            products = []
+            available_ids = []
+            limit_reached = False
+            # Совпадения и страницы текущей категории - для статистики выхода
+            current, matched, pages = None, 0, 0
+            # Категории с ошибкой: без них список неполный и не кэшируется
+            failures = []
+            # Ответы каталога, дошедшие до сопоставления (страницы и концы категорий)
+            answered = 0
+            scan = self._iter_available_products(categories, window, failures)
+            try:
+                async for category, page_ids, done in scan:
+                    answered += 1
+                    if category != current:
+                        # Новая категория (предыдущая могла оборваться с ошибкой)
+                        current, matched, pages = category, 0, 0
+                    if done:
+                        self.category_yield.record(category, matched, pages)
+                        continue
+                    available_ids.extend(page_ids)
+                    pages += 1
+                    for product_id in page_ids:
+                        if product_id in self.heavy_data:
+                            matched += 1
+                            if len(products) < limit:
+                                products.append(self._product_from_heavy(product_id))
+                    if len(products) >= limit:
+                        # Категория просмотрена не до конца - в выход не записываем,
+                        # ее оставшиеся страницы не загружаются
+                        limit_reached = True
+                        break
+            finally:
+                # Оставшиеся страницы каталога отменяются
+                await scan.aclose()
+            if failures and not answered:
+                # Ни одна категория не проверилась: это сбой проверки, а не пустой ассортимент
+                print(f"⚠️ Проверка доступности не удалась (категорий с ошибкой - {len(failures)}), "
+                      f"пробуем парсить каталог...")
+                return await self._fallback_catalog_parsing(limit)
+            self._save_category_yield()
+            if not limit_reached:
+                await self._store_availability(cache_keys, available_ids, failures)
+            elif cache_keys and self.background_scan:
+                # Обход прерван на лимите - ячейка проверяется полностью в фоне, ответ не ждет
+                self._start_availability_task(
+                    cell, self._refresh_availability(city, coords, cache_keys))
             
-            print(f"✅ Сопоставлено с базой: {matched_count} товаров")
+            print(f"📦 По адресу найдено доступных: {len(available_ids)} товаров")
+            print(f"✅ Сопоставлено с базой: {len(products)} товаров")
             print(f"⚡ Быстрый парсинг завершен: {len(products)} товаров")
             return products
         
@@ -216,94 +317,264 @@ class VkusvillFastParser:
         print("⚠️ База тяжелого парсера пуста, пробуем парсить каталог...")
         return await self._fallback_catalog_parsing(limit)
     
+    def _product_from_heavy(self, product_id: str) -> Dict:
+        """Товар из базы тяжелого парсера в формате быстрого парсера."""
+        heavy_product = self.heavy_data[product_id]
+        # Определяем подкатегорию для товаров из базы
+        subcategory = self._determine_subcategory(
+            heavy_product.get('url', ''), 
+            heavy_product.get('name', '')
+        )
+        return {
+            'id': heavy_product.get('id', product_id),
+            'name': heavy_product.get('name', ''),
+            'price': heavy_product.get('price', ''),
+            'category': subcategory,
+            'url': heavy_product.get('url', ''),
+            'shop': 'vkusvill_address',
+            'photo': heavy_product.get('photo', ''),
+            'composition': heavy_product.get('composition', ''),
+            'tags': heavy_product.get('tags', ''),
+            'portion_g': heavy_product.get('portion_g', ''),
+            'kcal_100g': heavy_product.get('kcal_100g', ''),
+            'protein_100g': heavy_product.get('protein_100g', ''),
+            'fat_100g': heavy_product.get('fat_100g', ''),
+            'carb_100g': heavy_product.get('carb_100g', '')
+        }
+    
+    def _start_availability_task(self, cell: str, coro):
+        """Фоновое обновление доступности ячейки - не больше одного на ячейку."""
+        if cell in self._availability_tasks:
+            coro.close()
+            return
+        task = asyncio.create_task(coro)
+        self._availability_tasks[cell] = task
+        task.add_done_callback(lambda _: self._availability_tasks.pop(cell, None))
+    
+    async def _refresh_availability(self, city: str, coords: str, keys: List[str]):
+        """Заново проверить доступность по координатам в своей сессии и обновить кэш."""
+        try:
+            async with self.antibot_client.lease(coords):
+                await self._set_location(city, coords)
+                categories = self.category_yield.order(AVAILABILITY_CATEGORIES)
+                failures = []
+                available_ids = [product_id
+                                 async for _, page_ids, _ in self._iter_available_products(categories, failures=failures)
+                                 for product_id in page_ids]
+        except Exception as e:
+            print(f"⚠️ Кэш доступности {keys[0]} не обновлен: {e}")
+            return
+        await self._store_availability(keys, available_ids, failures)
+    
+    async def _store_availability(self, keys: List[str], available_ids: List[str], failures: List[str]):
+        """Записать список в кэш, только если обход прошел все категории без ошибок."""
+        if not keys:
+            return
+        if failures:
+            # Неполный список отдавался бы соседним адресам как весь ассортимент
+            print(f"⚠️ Кэш доступности {keys[0]} не обновлен: категорий с ошибкой - {len(failures)}")
+            return
+        for key in keys:
+            await self.availability_cache.put(key, available_ids)
+    
+    async def _probe_zone(self, categories: List[str]) -> Optional[str]:
+        """Отпечаток зоны доставки: ID и цены с первых страниц пары категорий.
+        
+        Адреса, которые обслуживает один магазин, видят одинаковые товары по
+        одинаковым ценам, поэтому совпавший отпечаток означает ту же зону.
+        """
+        self.zone_stats['probes'] += 1
+        
+        async def probe_page(category):
+            url = f"{self.BASE_URL}{category}?page=1"
+            response = await self.antibot_client.request(method="GET", url=url)
+            if response.status_code != 200 or not HTMLParser:
+                return []
+            parser = HTMLParser(response.text)
+            items = []
+            for link in parser.css('a[href*="/goods/"][href$=".html"]'):
+                product = self._extract_product_from_link(link)
+                if product:
+                    items.append(f"{product['id']}:{product['price']}")
+            return items
+        
+        try:
+            pages = await asyncio.gather(*(probe_page(category) for category in categories))
+        except SiteBlocked:
+            raise
+        except Exception:
+            return None
+        items = sorted({item for page in pages for item in page})
+        if not items:
+            return None
+        return "zone-" + hashlib.sha1("|".join(items).encode('utf-8')).hexdigest()[:16]
+    
+    async def wait_background(self):
+        """Дождаться фоновых обновлений кэша доступности (перед закрытием клиента)."""
+        if self._availability_tasks:
+            await asyncio.gather(*self._availability_tasks.values(), return_exceptions=True)
+    
+    def _save_category_yield(self):
+        try:
+            self.category_yield.save()
+        except OSError as e:
+            print(f"⚠️ Не удалось сохранить выход категорий: {e}")
+    
     async def _get_available_products(self, coords: str) -> List[str]:
         """Получение списка доступных товаров по адресу."""
-        available_ids = []
+        return [product_id
+                async for _, page_ids, _ in self._iter_available_products()
+                for product_id in page_ids]
+    
+    async def _iter_available_products(self, categories: Optional[List[str]] = None,
+                                       window: Optional[int] = None,
+                                       failures: Optional[List[str]] = None):
+        """Доступные по адресу товары по мере проверки, по странице за раз.
         
-        # Расширенные категории готовой еды (как в moscow_improved.py)
-        categories = [
-            "/goods/gotovaya-eda/",
-            "/goods/gotovaya-eda/novinki/",
-            "/goods/gotovaya-eda/vtorye-blyuda/",
-            "/goods/gotovaya-eda/vtorye-blyuda/vtorye-blyuda-s-myasom/",
-            "/goods/gotovaya-eda/vtorye-blyuda/vtorye-blyuda-s-ptitsey/",
-            "/goods/gotovaya-eda/vtorye-blyuda/vtorye-blyuda-s-ryboy-i-moreproduktami/",
-            "/goods/gotovaya-eda/vtorye-blyuda/garniry-i-vtorye-blyuda-bez-myasa/",
-            "/goods/gotovaya-eda/vtorye-blyuda/pasta-pitstsa/",
-            "/goods/gotovaya-eda/salaty/",
-            "/goods/gotovaya-eda/sendvichi-shaurma-i-burgery/",
-            "/goods/gotovaya-eda/bolshe-belka-menshe-kaloriy/",
-            "/goods/gotovaya-eda/bolshe-belka-menshe-kaloriy/malo-kaloriy/",
-            "/goods/gotovaya-eda/bolshe-belka-menshe-kaloriy/bolshe-belka/",
-            "/goods/gotovaya-eda/okroshki-i-letnie-supy/",
-            "/goods/gotovaya-eda/supy/",
-            "/goods/gotovaya-eda/zavtraki/",
-            "/goods/gotovaya-eda/zavtraki/bliny-i-oladi/",
-            "/goods/gotovaya-eda/zavtraki/syrniki-zapekanki-i-rikotniki/",
-            "/goods/gotovaya-eda/zavtraki/omlety-i-zavtraki-s-yaytsom/",
-            "/goods/gotovaya-eda/zavtraki/kashi/",
-            "/goods/gotovaya-eda/zakuski/",
-            "/goods/gotovaya-eda/rolly-i-sety/",
-            "/goods/gotovaya-eda/onigiri/",
-            "/goods/gotovaya-eda/pirogi-pirozhki-i-lepyeshki/",
-            "/goods/gotovaya-eda/privezem-goryachim/",
-            "/goods/gotovaya-eda/privezem-goryachim/goryachie-napitki/",
-            "/goods/gotovaya-eda/tarelka-zdorovogo-pitaniya/",
-            "/goods/gotovaya-eda/veganskie-i-postnye-blyuda/",
-            "/goods/gotovaya-eda/semeynyy-format/",
-            "/goods/gotovaya-eda/kombo-na-kazhdyy-den/",
-            "/goods/gotovaya-eda/kukhni-mira/",
-            "/goods/gotovaya-eda/kukhni-mira/aziatskaya-kukhnya/",
-            "/goods/gotovaya-eda/kukhni-mira/russkaya-kukhnya/",
-            "/goods/gotovaya-eda/kukhni-mira/kukhnya-kavkaza/",
-            "/goods/gotovaya-eda/kukhni-mira/sredizemnomorskaya-kukhnya/",
-            "/goods/gotovaya-eda/bliny-i-oladi/",
-            "/goods/gotovaya-eda/khalyal/"
-        ]
+        Выдает (категория, новые ID страницы, False) для каждой страницы и
+        (категория, [], True), когда категория пройдена до конца. Категории и
+        их страницы загружаются параллельно под лимитами клиента, а выдаются в
+        порядке categories, страница за страницей, с прежними условиями
+        остановки - полный обход дает тот же список, что последовательный.
+        window - сколько категорий загружается наперед (None - все сразу).
+        Если потребитель прекращает обход, незагруженные страницы отменяются.
+        Категории, проверка которых оборвалась ошибкой, добавляются в failures:
+        список без них неполный и в кэш не записывается.
+        """
+        categories = list(categories or AVAILABILITY_CATEGORIES)
+        window = window or len(categories)
+        # Упорядоченное множество: dict сохраняет порядок добавления
+        available_ids: Dict[str, None] = {}
         
-        for category in categories:
-            try:
-                # Пагинация по страницам (как в moscow_improved.py)
-                for page_num in range(1, 20):  # До 20 страниц на категорию
-                    try:
-                        url = f"{self.BASE_URL}{category}?page={page_num}"
-                        response = await self.antibot_client.request(method="GET", url=url)
-                        
-                        if response.status_code != 200:
-                            break
-                            
-                        if not HTMLParser:
-                            break
-                            
-                        parser = HTMLParser(response.text)
-                        product_links = parser.css('a[href*="/goods/"][href$=".html"]')
-                        
-                        if not product_links:
-                            break
-
-                        page_count = 0
-                        for link in product_links:
-                            href = link.attributes.get('href')
-                            if href and '.html' in href and '/goods/' in href:
-                                product_id = self._extract_id_from_url(urljoin(self.BASE_URL, href))
-                                if product_id and product_id not in available_ids:
-                                    available_ids.append(product_id)
-                                    page_count += 1
-
-                        if page_count == 0:  # Нет новых товаров - конец
-                            break
-                            
-                        await asyncio.sleep(0.2)  # Пауза между страницами
-                        
-                    except Exception:
+        queues: List[asyncio.Queue] = []
+        tasks = []
+        try:
+            for index, category in enumerate(categories):
+                # Скользящее окно: следующая категория стартует, как только текущая выдана
+                while len(tasks) < min(index + window, len(categories)):
+                    queue = asyncio.Queue()
+                    queues.append(queue)
+                    tasks.append(asyncio.ensure_future(self._scan_category_pages(categories[len(tasks)], queue)))
+                queue = queues[index]
+                while True:
+                    page_ids = await queue.get()
+                    if page_ids is None:
+                        yield category, [], True
                         break
-                
-                await asyncio.sleep(0.5)  # Пауза между категориями
-                
-            except Exception as e:
-                print(f"   ❌ Ошибка категории {category}: {e}")
+                    if isinstance(page_ids, SiteBlocked):
+                        raise page_ids
+                    if isinstance(page_ids, Exception):
+                        # Страница проверки или ошибка - категория не пройдена, а не закончилась
+                        print(f"   ❌ Ошибка категории {category}: {page_ids}")
+                        if failures is not None:
+                            failures.append(category)
+                        break
+                    page_new = [product_id for product_id in dict.fromkeys(page_ids)
+                                if product_id not in available_ids]
+                    if not page_new:
+                        # Нет новых товаров - конец категории, ее страницы больше не нужны
+                        tasks[index].cancel()
+                        yield category, [], True
+                        break
+                    available_ids.update(dict.fromkeys(page_new))
+                    yield category, page_new, False
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def _scan_category_pages(self, category: str, queue: asyncio.Queue):
+        """Переложить страницы категории в queue: в конце None, при ошибке - исключение."""
+        try:
+            async for page_ids in self._iter_category_pages(category):
+                queue.put_nowait(page_ids)
+        except Exception as e:
+            queue.put_nowait(e)
+        else:
+            queue.put_nowait(None)
+    
+    async def _iter_category_pages(self, category: str, max_pages: int = 19):
+        """ID товаров по страницам одной категории, по порядку.
+        
+        Число страниц берется из пагинации первой страницы, остальные
+        загружаются параллельно; без пагинации страницы идут по одной.
+        Обход категории прекращается и на странице без новых для нее товаров -
+        такая страница остановила бы и общий обход.
+        """
+        seen = set()
+        
+        def accept(page) -> bool:
+            if not page or seen.issuperset(page[0]):
+                return False
+            seen.update(page[0])
+            return True
+        
+        first = await self._fetch_available_page(category, 1)
+        if not accept(first):
+            return
+        yield first[0]
+        next_page = 2
+        last_page = min(first[1], max_pages)
+        if last_page >= next_page:
+            tasks = [asyncio.ensure_future(self._fetch_available_page(category, page_num))
+                     for page_num in range(next_page, last_page + 1)]
+            try:
+                for task in tasks:
+                    page = await task
+                    if not accept(page):
+                        return
+                    yield page[0]
+                    next_page += 1
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        # Пагинации нет или она показывает не все страницы - дальше по одной
+        while next_page <= max_pages:
+            page = await self._fetch_available_page(category, next_page)
+            if not accept(page):
+                break
+            yield page[0]
+            next_page += 1
+    
+    async def _fetch_available_page(self, category: str, page_num: int) -> Optional[tuple]:
+        """(ID товаров, число страниц по пагинации) или None, если страниц больше нет.
         
-        return available_ids
+        Страница проверки, сетевая ошибка или 5xx после повторов клиента - не
+        конец категории: исключение прерывает обход категории как неудачный.
+        """
+        try:
+            url = f"{self.BASE_URL}{category}?page={page_num}"
+            response = await self.antibot_client.request(method="GET", url=url)
+            
+            if response.status_code >= 500:
+                raise RuntimeError(f"HTTP {response.status_code}: {url}")
+            if response.status_code != 200 or not HTMLParser:
+                return None
+            
+            parser = HTMLParser(response.text)
+            product_links = parser.css('a[href*="/goods/"][href$=".html"]')
+            if not product_links:
+                return None
+            
+            page_ids = []
+            for link in product_links:
+                href = link.attributes.get('href')
+                if href and '.html' in href and '/goods/' in href:
+                    product_id = self._extract_id_from_url(urljoin(self.BASE_URL, href))
+                    if product_id:
+                        page_ids.append(product_id)
+            
+            page_count = 0
+            for link in parser.css('a[href*="page"], a[href*="PAGEN"]'):
+                match = PAGE_PARAM_RE.search(link.attributes.get('href') or '')
+                if match:
+                    page_count = max(page_count, int(match.group(1)))
+            return page_ids, page_count
+        except (SiteBlocked, ChallengeDetected):
+            raise
+        except Exception as e:
+            raise RuntimeError(f"страница {page_num} недоступна: {e}") from e
     
     async def _fallback_catalog_parsing(self, limit: int) -> List[Dict]:
         """Резервный парсинг каталога если нет базы."""
@@ -358,6 +629,8 @@ class VkusvillFastParser:
                 if len(products) >= limit:
                     break
                     
+            except SiteBlocked:
+                raise
             except Exception as e:
                 print(f"   ❌ Ошибка категории {category}: {e}")
         
@@ -368,9 +641,18 @@ class VkusvillFastParser:
         """Установка локации с правильной обработкой cookies."""
         try:
             lat, lon = coords.split(',')
+            location = f"{lat.strip()},{lon.strip()}"
+            session = self.antibot_client.session
+            if session.location == location:
+                # Сессия из пула уже настроена на эти координаты
+                print(f"📍 Локация уже установлена: {city} ({coords})")
+                return
+            # Кэш страниц разделяется по локации
+            self.antibot_client.location_key = location
 
-            # Получаем главную страницу для cookies
-            main_response = await self.antibot_client.request(method="GET", url=self.BASE_URL)
+            # Получаем главную страницу для cookies - с сайта, а не из кэша:
+            # новой сессии нужен Set-Cookie до setCoords
+            main_response = await self.antibot_client.request(method="GET", url=self.BASE_URL, cache=False)
 
             # Используем правильный API endpoint
             headers = {
@@ -397,6 +679,7 @@ class VkusvillFastParser:
                 )
 
                 if response.status_code == 200:
+                    session.location = location
                     print(f"📍 Локация установлена: {city} ({coords})")
                     return
             except:
@@ -409,8 +692,11 @@ class VkusvillFastParser:
                 url=location_url,
                 headers={'X-Requested-With': 'XMLHttpRequest'}
             )
+            session.location = location
             print(f"📍 Локация установлена (альтернативный метод): {city}")
 
+        except SiteBlocked:
+            raise
         except Exception as e:
             print(f"⚠️ Ошибка установки локации: {e}")
             # Продолжаем даже если не удалось
@@ -470,13 +756,15 @@ class VkusvillFastParser:
                     
                     if page_products == 0:  # Нет новых товаров - конец
                         break
-                        
-                    await asyncio.sleep(0.2)  # Пауза между страницами
                     
+                except SiteBlocked:
+                    raise
                 except Exception as e:
                     print(f"   ❌ Ошибка страницы {page_num}: {e}")
                     break
         
+        except SiteBlocked:
+            raise
         except Exception as e:
             print(f"   ❌ Ошибка парсинга категории: {e}")
             import traceback
@@ -735,11 +1023,17 @@ class VkusvillFastParser:
         return 'Готовая еда'
 
 
+# Общий геокодер: кэш и объединение одинаковых запросов - на весь процесс
+_geocoder: Optional[GeocodingService] = None
+
+
 async def get_location_from_address(address: str) -> tuple:
     """Получение координат из адреса."""
+    global _geocoder
     try:
-        location_service = LocationService()
-        result = await location_service.geocode_address(address)
+        if _geocoder is None:
+            _geocoder = GeocodingService.from_env()
+        result = await _geocoder.geocode(address)
         if result:
             lat, lon = result
             # Извлекаем город из адреса
@@ -811,7 +1105,12 @@ async def main():
     
     logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
     
-    antibot_client = AntiBotClient(concurrency=20, timeout=30)  # Быстрые настройки
+    # HTTP_CACHE_DIR включает дисковый кэш страниц между запусками
+    antibot_client = AntiBotClient(
+        timeout=30,
+        cache_dir=os.getenv("HTTP_CACHE_DIR"),
+        http2=os.getenv("HTTP2") == "1",
+    )
     
     try:
         parser = VkusvillFastParser(antibot_client)
@@ -822,6 +1121,8 @@ async def main():
         start_time = time.time()
         products = await parser.scrape_fast(city, coords, address, limit)
         end_time = time.time()
+        # Кэш доступности дописывается до выхода - следующий запуск рядом возьмет его
+        await parser.wait_background()
         
         if not products:
             print("❌ Быстрый парсинг не дал результатов")
@@ -865,6 +1166,8 @@ async def main():
                 
     except KeyboardInterrupt:
         print("\n⚠️ Парсинг прерван пользователем")
+    except SiteBlocked as e:
+        print(f"🛑 Парсинг остановлен: {e}")
     except Exception as e:
         print(f"❌ Ошибка быстрого парсинга: {e}")
         import traceback
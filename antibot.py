@@ -0,0 +1,1028 @@
+#!/usr/bin/env python3
+"""
+antibot.py - Общий HTTP клиент парсеров ВкусВилл.
+
+Клиент хранит cookies между запросами и сам подбирает число одновременных
+запросов: AIMD контроллер плавно поднимает лимит, пока сайт отвечает быстро
+и без ошибок, и резко снижает его при 429/503, таймаутах и страницах проверки.
+Частота запросов ограничивается token bucket'ами по хосту и классу адреса
+(каталог, карточка, ajax), поэтому парсерам не нужны собственные паузы.
+Опциональный дисковый кэш хранит сжатые страницы и перепроверяет их
+условными запросами (If-None-Match / If-Modified-Since). Пул соединений
+рассчитан от потолка параллельности, по желанию работает поверх HTTP/2,
+а ожидание свободного соединения учитывается отдельно от ответа сервера.
+Сбойный запрос повторяется с джиттером; сессия пересоздается только когда
+сбоев много подряд, а не из-за одного медленного ответа. Для карточек
+доступно хеджирование: если ответа нет дольше p95, уходит второй такой же
+запрос, побеждает первый ответивший (в пределах бюджета лишних запросов).
+Страницы проверки (капча, JS-challenge, мягкая блокировка) распознаются по
+статусу, заголовкам и разметке: такой ответ выбрасывает ChallengeDetected,
+а серия проверок размыкает цепь - все запросы ждут с нарастающей паузой,
+и если сайт продолжает блокировать, сразу падают с SiteBlocked.
+Для нескольких адресов одновременно клиент держит пул сессий по локации:
+у каждой свои cookies, соединения и лимиты общие. Сессия выдается задаче
+через lease(), повторные координаты получают уже настроенную сессию.
+"""
+
+import asyncio
+import contextvars
+import hashlib
+import importlib.util
+import json
+import random
+import time
+import zlib
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+# Пакет h2 нужен httpx для HTTP/2; сам модуль парсеру не нужен
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+# Статусы, которыми сайт сообщает о перегрузке или ограничении частоты
+THROTTLE_STATUSES = {429, 503}
+
+# Сетевые ошибки, после которых идемпотентный запрос можно повторить
+RETRYABLE_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+# Маркеры страниц проверки браузера / капчи
+CHALLENGE_MARKERS = (
+    'captcha', 'ddos-guard', 'cf-challenge', 'challenge-platform', 'qrator',
+    'checking your browser', 'проверка браузера', 'доступ ограничен', 'вы не робот',
+)
+
+# Страницы проверки маленькие, обычные карточки и каталог весят сотни КБ
+CHALLENGE_MAX_BYTES = 20000
+
+# Бюджет частоты по классам адресов: (запросов в секунду, размер пачки)
+DEFAULT_RATE_LIMITS = {
+    'catalog': (8.0, 8),
+    'card': (10.0, 10),
+    'ajax': (2.0, 2),
+}
+
+
+# Сколько секунд кэшированная страница считается свежей без перепроверки.
+# ajax не кэшируется: это установка локации и прочие действия.
+DEFAULT_CACHE_TTL = {
+    'catalog': 600,
+    'card': 24 * 3600,
+    'ajax': 0,
+}
+
+
+def classify_endpoint(url: str) -> str:
+    """Класс адреса для лимита частоты: catalog, card или ajax."""
+    path = urlsplit(url).path
+    if path.startswith('/ajax/') or path.startswith('/api/'):
+        return 'ajax'
+    if path.startswith('/goods/') and path.endswith('.html'):
+        return 'card'
+    return 'catalog'
+
+
+class ChallengeDetected(Exception):
+    """Вместо страницы сайт отдал проверку браузера или блокировку."""
+
+    def __init__(self, url: str, reason: str):
+        super().__init__(f"страница проверки ({reason}): {url}")
+        self.url = url
+        self.reason = reason
+
+
+class SiteBlocked(Exception):
+    """Сайт устойчиво блокирует парсер - запросы не отправляются."""
+
+
+def detect_challenge(response) -> Optional[str]:
+    """Признак страницы проверки в ответе или None для обычной страницы.
+
+    Проверки дешевые: статус, заголовки защиты, адрес после редиректов и
+    маркеры в начале небольшого HTML. Разбор DOM не нужен.
+    """
+    headers = response.headers
+    if headers.get('cf-mitigated') == 'challenge':
+        return 'cloudflare'
+    server = headers.get('server', '').lower()
+    if response.status_code in (403, 503) and ('ddos-guard' in server or 'qrator' in server):
+        return server
+    if 'captcha' in urlsplit(str(response.url)).path.lower():
+        return 'redirect:captcha'
+    if response.status_code == 403:
+        return 'http-403'
+    if 'text/html' in headers.get('content-type', '') and len(response.content) < CHALLENGE_MAX_BYTES:
+        head = response.text[:2000].lower()
+        for marker in CHALLENGE_MARKERS:
+            if marker in head:
+                return marker
+        # JS-заглушка: страница из одного скрипта, который ставит cookie и перезагружается
+        if 'document.cookie' in head and ('location.reload' in head or 'location.href' in head):
+            return 'js-challenge'
+    return None
+
+
+class TokenBucket:
+    """Ограничитель частоты: rate запросов в секунду с пачкой до burst."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.waits = 0
+        self.wait_time = 0.0
+
+    async def acquire(self):
+        """Взять токен; ждем только если бюджет частоты исчерпан."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # Токен резервируется сразу, поэтому ожидающие обслуживаются по очереди
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return
+        delay = -self.tokens / self.rate
+        self.waits += 1
+        self.wait_time += delay
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.tokens += 1
+            raise
+
+    def metrics(self) -> Dict:
+        return {
+            'rate': self.rate,
+            'burst': int(self.capacity),
+            'waits': self.waits,
+            'wait_time': round(self.wait_time, 2),
+        }
+
+
+class AIMDConcurrencyController:
+    """Адаптивный лимит одновременных запросов (additive increase / multiplicative decrease)."""
+
+    def __init__(self, initial_limit: int = 6, min_limit: int = 2, max_limit: int = 32,
+                 decrease_factor: float = 0.5, latency_tolerance: float = 2.0,
+                 max_backoff: float = 30.0):
+        self.limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        # Во сколько раз задержка может превышать минимальную, оставаясь "здоровой"
+        self.latency_tolerance = latency_tolerance
+        self.max_backoff = max_backoff
+
+        self.in_flight = 0
+        self.latency_ewma: Optional[float] = None
+        self.latency_min: Optional[float] = None
+
+        self._waiters = deque()
+        self._last_decrease = 0.0
+        self._paused_until = 0.0
+        self._consecutive_overloads = 0
+
+        self.stats = {
+            'ok': 0, 'throttled': 0, 'timeouts': 0, 'challenges': 0, 'errors': 0,
+            'increases': 0, 'decreases': 0,
+        }
+
+    async def acquire(self) -> float:
+        """Дождаться свободного слота, вернуть момент начала запроса."""
+        loop = asyncio.get_running_loop()
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            if self.in_flight < int(self.limit):
+                break
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Если нас успели разбудить, передаем слот следующему
+                if waiter.done() and not waiter.cancelled():
+                    self._wake_waiters()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, started: float, outcome: str, retry_after: Optional[float] = None,
+                latency: Optional[float] = None):
+        """Освободить слот и скорректировать лимит по результату запроса.
+
+        outcome: 'ok', 'throttled', 'timeout', 'challenge' или 'error'.
+        latency - время ответа сервера без ожидания пула, если оно известно.
+        """
+        self.in_flight -= 1
+        now = time.monotonic()
+
+        if outcome == 'ok':
+            self.stats['ok'] += 1
+            self._on_success(latency if latency is not None else now - started)
+        elif outcome in ('throttled', 'timeout', 'challenge'):
+            key = {'throttled': 'throttled', 'timeout': 'timeouts', 'challenge': 'challenges'}[outcome]
+            self.stats[key] += 1
+            # Паузу после страниц проверки выдерживает ChallengeCircuit клиента
+            self._on_overload(started, now, retry_after, pause=outcome != 'challenge')
+        else:
+            # Сетевые ошибки не говорят о нагрузке на сайт - лимит не трогаем
+            self.stats['errors'] += 1
+
+        self._wake_waiters()
+
+    def _on_success(self, latency: float):
+        self._consecutive_overloads = 0
+        self.latency_min = latency if self.latency_min is None else min(self.latency_min, latency)
+        self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+
+        # Небольшой абсолютный запас, чтобы сетевой джиттер не блокировал рост
+        healthy = self.latency_ewma <= max(self.latency_min * self.latency_tolerance, self.latency_min + 0.05)
+        # Поднимаем лимит только когда он реально используется
+        saturated = self.in_flight + 1 >= int(self.limit)
+        if healthy and saturated and self.limit < self.max_limit:
+            old = int(self.limit)
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            if int(self.limit) > old:
+                self.stats['increases'] += 1
+
+    def _on_overload(self, started: float, now: float, retry_after: Optional[float], pause: bool = True):
+        # Запросы, начатые до последнего снижения, уже учтены в нем
+        if started < self._last_decrease:
+            return
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+        self._last_decrease = now
+        self._consecutive_overloads += 1
+        self.stats['decreases'] += 1
+        if not pause:
+            return
+
+        backoff = min(self.max_backoff, 0.5 * 2 ** (self._consecutive_overloads - 1))
+        if retry_after:
+            backoff = min(self.max_backoff, max(backoff, retry_after))
+        self._paused_until = max(self._paused_until, now + backoff)
+
+    def _wake_waiters(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def metrics(self) -> Dict:
+        """Текущее окно контроллера для статистики воркера."""
+        return {
+            'limit': int(self.limit),
+            'in_flight': self.in_flight,
+            'waiting': len(self._waiters),
+            'latency_ewma': round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+            'latency_min': round(self.latency_min, 3) if self.latency_min is not None else None,
+            'paused_for': round(max(0.0, self._paused_until - time.monotonic()), 2),
+            **self.stats,
+        }
+
+
+class HttpCache:
+    """Дисковый кэш GET ответов с перепроверкой по ETag / Last-Modified.
+
+    Ключ - URL плюс локация клиента: каталог и карточки зависят от адреса
+    доставки. Тела хранятся сжатыми zlib, по файлу на ключ.
+    """
+
+    STORED_HEADERS = ('content-type', 'etag', 'last-modified')
+
+    def __init__(self, cache_dir, ttl: Optional[Dict[str, int]] = None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.ttl = {**DEFAULT_CACHE_TTL, **(ttl or {})}
+        self.stats = {'hits': 0, 'misses': 0, 'revalidated': 0, 'stored': 0, 'bytes_saved': 0}
+
+    def _path(self, url: str, location: str) -> Path:
+        digest = hashlib.sha1(f"{location}|{url}".encode('utf-8')).hexdigest()
+        return self.cache_dir / digest[:2] / f"{digest}.z"
+
+    def cacheable(self, method: str, endpoint: str) -> bool:
+        return method.upper() == 'GET' and self.ttl.get(endpoint, 0) > 0
+
+    def load(self, url: str, location: str) -> Optional[Dict]:
+        """Запись кэша или None."""
+        path = self._path(url, location)
+        try:
+            raw = zlib.decompress(path.read_bytes())
+        except (OSError, zlib.error):
+            return None
+        header, _, body = raw.partition(b'\n')
+        try:
+            entry = json.loads(header)
+        except ValueError:
+            return None
+        entry['body'] = body
+        return entry
+
+    def is_fresh(self, entry: Dict, endpoint: str) -> bool:
+        return time.time() - entry['stored_at'] < self.ttl.get(endpoint, 0)
+
+    @staticmethod
+    def conditional_headers(entry: Dict) -> Dict[str, str]:
+        headers = {}
+        if entry['headers'].get('etag'):
+            headers['If-None-Match'] = entry['headers']['etag']
+        if entry['headers'].get('last-modified'):
+            headers['If-Modified-Since'] = entry['headers']['last-modified']
+        return headers
+
+    def store(self, url: str, location: str, response):
+        headers = {name: response.headers[name] for name in self.STORED_HEADERS if name in response.headers}
+        self._write(url, location, headers, response.content)
+        self.stats['stored'] += 1
+
+    def invalidate(self, url: str, location: str):
+        """Удалить запись, чтобы следующий запрос пошел в сеть."""
+        try:
+            self._path(url, location).unlink()
+        except OSError:
+            pass
+
+    def touch(self, url: str, location: str, entry: Dict):
+        """Продлить свежесть записи после ответа 304."""
+        self._write(url, location, entry['headers'], entry['body'])
+
+    def _write(self, url: str, location: str, headers: Dict, body: bytes):
+        path = self._path(url, location)
+        header = json.dumps({'url': url, 'stored_at': time.time(), 'headers': headers}).encode('utf-8')
+        try:
+            path.parent.mkdir(exist_ok=True)
+            tmp_path = path.with_suffix('.tmp')
+            tmp_path.write_bytes(zlib.compress(header + b'\n' + body, 6))
+            tmp_path.replace(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def to_response(method: str, url: str, entry: Dict):
+        return httpx.Response(
+            200,
+            headers=entry['headers'],
+            content=entry['body'],
+            request=httpx.Request(method, url),
+        )
+
+    def metrics(self) -> Dict:
+        return dict(self.stats)
+
+
+class RequestTiming:
+    """Фазы одного запроса по trace событиям httpcore."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.connect_started: Optional[float] = None
+        self.connect_done: Optional[float] = None
+        self.sent: Optional[float] = None
+        self.headers_received: Optional[float] = None
+
+    async def trace(self, event_name: str, info: Dict):
+        now = time.monotonic()
+        if event_name == 'connection.connect_tcp.started' and self.connect_started is None:
+            self.connect_started = now
+        elif event_name in ('connection.connect_tcp.complete', 'connection.start_tls.complete'):
+            self.connect_done = now
+        elif event_name.endswith('.send_request_headers.started') and self.sent is None:
+            self.sent = now
+        elif event_name.endswith('.receive_response_headers.complete'):
+            self.headers_received = now
+
+    @property
+    def pool_wait(self) -> Optional[float]:
+        """Ожидание свободного соединения в пуле httpx."""
+        first_io = self.connect_started or self.sent
+        return first_io - self.started if first_io else None
+
+    @property
+    def connect(self) -> Optional[float]:
+        if self.connect_started and self.connect_done:
+            return self.connect_done - self.connect_started
+        return None
+
+    @property
+    def server(self) -> Optional[float]:
+        """Время от отправки запроса до заголовков ответа."""
+        if self.sent and self.headers_received:
+            return self.headers_received - self.sent
+        return None
+
+
+class CircuitBreaker:
+    """Доля сбоев в скользящем окне последних запросов.
+
+    Срабатывает, когда в окне набралось min_samples исходов и доля сбоев
+    достигла threshold; после срабатывания окно очищается и действует cooldown.
+    """
+
+    def __init__(self, window: int = 50, threshold: float = 0.5, min_samples: int = 20,
+                 cooldown: float = 30.0):
+        self.outcomes = deque(maxlen=window)
+        self.threshold = threshold
+        self.min_samples = min_samples
+        self.cooldown = cooldown
+        self._tripped_at = 0.0
+        self.trips = 0
+
+    def record(self, failed: bool) -> bool:
+        """Учесть исход запроса, вернуть True если предохранитель сработал."""
+        self.outcomes.append(failed)
+        if time.monotonic() - self._tripped_at < self.cooldown:
+            return False
+        if len(self.outcomes) < self.min_samples:
+            return False
+        if sum(self.outcomes) / len(self.outcomes) < self.threshold:
+            return False
+        self.outcomes.clear()
+        self._tripped_at = time.monotonic()
+        self.trips += 1
+        return True
+
+    @property
+    def failure_rate(self) -> float:
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+
+class ChallengeCircuit:
+    """Цепь, которая останавливает все запросы, пока сайт отдает проверки.
+
+    threshold проверок подряд размыкают цепь: запросы ждут паузу, после нее
+    проходит один пробный. Проба без проверки замыкает цепь, иначе пауза
+    удваивается. После max_trips размыканий подряд цепь переходит в blocked:
+    на block_cooldown секунд запросы сразу падают с SiteBlocked.
+    """
+
+    def __init__(self, threshold: int = 3, backoff: float = 5.0, max_backoff: float = 120.0,
+                 max_trips: int = 3, block_cooldown: float = 600.0):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_trips = max_trips
+        self.block_cooldown = block_cooldown
+        self.state = 'closed'
+        self.open_until = 0.0
+        self.consecutive = 0
+        self.trips_in_row = 0
+        self.last_reason = None
+        self._settled = asyncio.Event()
+        self.stats = {'challenges': 0, 'trips': 0, 'blocked': 0, 'paused_seconds': 0.0}
+
+    async def wait(self) -> bool:
+        """Дождаться разрешения на запрос; True - этот запрос пробный."""
+        while True:
+            now = time.monotonic()
+            if self.state == 'closed':
+                return False
+            if self.state == 'blocked':
+                if now < self.open_until:
+                    raise SiteBlocked(f"сайт блокирует парсер ({self.last_reason}), "
+                                      f"повтор через {self.open_until - now:.0f} с")
+                self.state = 'half_open'
+                return True
+            if self.state == 'open':
+                if now < self.open_until:
+                    await asyncio.sleep(self.open_until - now)
+                    continue
+                self.state = 'half_open'
+                return True
+            # half_open: ждем результат пробного запроса
+            await self._settled.wait()
+
+    def record(self, outcome: str, reason: Optional[str] = None, probe: bool = False):
+        """Учесть исход запроса ('challenge', 'ok' или прочий)."""
+        if outcome == 'challenge':
+            self.stats['challenges'] += 1
+            self.last_reason = reason
+            self.consecutive += 1
+            if probe or (self.state == 'closed' and self.consecutive >= self.threshold):
+                self._trip()
+        elif outcome == 'ok':
+            self.consecutive = 0
+            if probe or self.state == 'half_open':
+                self.state = 'closed'
+                self.trips_in_row = 0
+                self._settle()
+        elif probe:
+            # Проба не дала ответа - следующий запрос пробует снова
+            self.state = 'open'
+            self.open_until = time.monotonic()
+            self._settle()
+
+    def _trip(self):
+        now = time.monotonic()
+        self.trips_in_row += 1
+        self.stats['trips'] += 1
+        if self.trips_in_row > self.max_trips:
+            self.state = 'blocked'
+            self.stats['blocked'] += 1
+            self.open_until = now + self.block_cooldown
+            print(f"🛑 Сайт блокирует парсер ({self.last_reason}), запросы остановлены")
+        else:
+            pause = min(self.max_backoff, self.backoff * 2 ** (self.trips_in_row - 1))
+            self.state = 'open'
+            self.open_until = now + pause
+            self.stats['paused_seconds'] += pause
+            print(f"🚧 Страницы проверки ({self.last_reason}), пауза {pause:.0f} с")
+        self._settle()
+
+    def _settle(self):
+        self._settled.set()
+        self._settled = asyncio.Event()
+
+    def metrics(self) -> Dict:
+        return {
+            **self.stats,
+            'paused_seconds': round(self.stats['paused_seconds'], 1),
+            'state': self.state,
+            'last_reason': self.last_reason,
+        }
+
+
+class ClientSession:
+    """Cookies и локация одной сессии сайта.
+
+    location - координаты, уже установленные на сайте для этой сессии
+    (None, пока парсер их не выставил).
+    """
+
+    def __init__(self, key: str = ''):
+        self.key = key
+        self.cookies = httpx.Cookies()
+        self.client: Optional[httpx.AsyncClient] = None
+        self.location: Optional[str] = None
+        self.leases = 0
+        self.last_used = time.monotonic()
+
+
+class SharedTransport(httpx.AsyncBaseTransport):
+    """Транспорт сессий: все клиенты ходят через общий пул соединений владельца."""
+
+    def __init__(self, owner: 'AntiBotClient'):
+        self.owner = owner
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self.owner._ensure_transport().handle_async_request(request)
+
+    async def aclose(self):
+        # Пул закрывает владелец, сессия лишь перестает им пользоваться
+        pass
+
+
+# Сессия, выданная текущей задаче через AntiBotClient.lease()
+_current_session: contextvars.ContextVar = contextvars.ContextVar('antibot_session', default=None)
+
+
+class AntiBotClient:
+    """HTTP клиент с поддержкой cookies для обхода защиты."""
+
+    def __init__(self, timeout: int = 30, initial_concurrency: int = 6,
+                 min_concurrency: int = 2, max_concurrency: int = 32,
+                 rate_limits: Optional[Dict[str, Tuple[float, int]]] = None,
+                 cache_dir: Optional[str] = None, cache_ttl: Optional[Dict[str, int]] = None,
+                 http2: bool = False, max_retries: int = 2, retry_backoff: float = 0.5,
+                 hedge: bool = False, hedge_budget: float = 0.05, hedge_endpoints: Tuple[str, ...] = ('card',),
+                 max_sessions: int = 8):
+        self.concurrency = AIMDConcurrencyController(
+            initial_limit=initial_concurrency,
+            min_limit=min_concurrency,
+            max_limit=max_concurrency,
+        )
+        self.rate_limits = {**DEFAULT_RATE_LIMITS, **(rate_limits or {})}
+        self.buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self.cache = HttpCache(cache_dir, cache_ttl) if cache_dir else None
+        # Сессия без lease(): ее ключ - локация, выставленная парсером вручную
+        self.default_session = ClientSession()
+        # Сессии по локации, в порядке последнего использования
+        self.sessions: 'OrderedDict[str, ClientSession]' = OrderedDict()
+        self.max_sessions = max_sessions
+        self.session_stats = {'created': 0, 'reused': 0, 'evicted': 0}
+        self.timeout = timeout
+        # HTTP/2 мультиплексирует запросы поверх нескольких соединений
+        self.http2 = http2 and HTTP2_AVAILABLE
+        if http2 and not HTTP2_AVAILABLE:
+            print("⚠️ HTTP/2 недоступен (pip install httpx[http2]), используем HTTP/1.1")
+        self.transport: Optional[httpx.AsyncBaseTransport] = None  # Общий пул соединений
+        self._warmed_transport: Optional[httpx.AsyncBaseTransport] = None
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        # Пересоздание сессии только при устойчивой доле сетевых сбоев
+        self.session_breaker = CircuitBreaker()
+        self._retired_transports: Dict[asyncio.Task, httpx.AsyncBaseTransport] = {}
+        self.retry_stats = {'retries': 0, 'session_resets': 0}
+        # Остановка всех запросов при страницах проверки
+        self.challenge_circuit = ChallengeCircuit()
+        # Хеджирование: не больше hedge_budget дополнительных запросов от числа обычных
+        self.hedge = hedge
+        self.hedge_budget = hedge_budget
+        self.hedge_endpoints = hedge_endpoints
+        self.hedge_stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'saved_seconds': 0.0}
+        self._latency_samples: Dict[str, deque] = {}
+        self.pool_stats = {
+            'requests': 0, 'new_connections': 0,
+            'pool_wait_total': 0.0, 'pool_wait_max': 0.0,
+            'connect_total': 0.0, 'server_total': 0.0,
+        }
+
+    @property
+    def session(self) -> ClientSession:
+        """Сессия текущей задачи (выданная lease() или общая)."""
+        return _current_session.get() or self.default_session
+
+    @property
+    def location_key(self) -> str:
+        """Локация сессии (координаты) - входит в ключ кэша."""
+        return self.session.key
+
+    @location_key.setter
+    def location_key(self, value: str):
+        self.session.key = value
+
+    @property
+    def cookies(self) -> httpx.Cookies:
+        return self.session.cookies
+
+    @asynccontextmanager
+    async def lease(self, location_key: str):
+        """Выдать текущей задаче сессию локации на время блока.
+
+        Задачи с одинаковыми координатами получают одну сессию (cookies и
+        уже установленную локацию), с разными - независимые. Лишние свободные
+        сессии вытесняются по давности использования.
+        """
+        session = self.sessions.get(location_key)
+        if session is None:
+            session = ClientSession(location_key)
+            self.sessions[location_key] = session
+            self.session_stats['created'] += 1
+        else:
+            self.session_stats['reused'] += 1
+        self.sessions.move_to_end(location_key)
+        session.leases += 1
+        token = _current_session.set(session)
+        try:
+            yield session
+        finally:
+            _current_session.reset(token)
+            session.leases -= 1
+            session.last_used = time.monotonic()
+            self._evict_sessions()
+
+    def _evict_sessions(self):
+        """Вытеснить самые давние свободные сессии сверх max_sessions."""
+        for key in list(self.sessions):
+            if len(self.sessions) <= self.max_sessions:
+                break
+            if self.sessions[key].leases == 0:
+                del self.sessions[key]
+                self.session_stats['evicted'] += 1
+
+    def _ensure_transport(self) -> httpx.AsyncBaseTransport:
+        """Общий пул соединений для всех сессий."""
+        if self.transport is None:
+            self.transport = httpx.AsyncHTTPTransport(http2=self.http2, limits=self._pool_limits())
+        return self.transport
+
+    async def _ensure_client(self):
+        """Клиент текущей сессии: свои cookies поверх общего пула соединений."""
+        session = self.session
+        if session.client is None:
+            headers = {
+                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36',
+                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+                'Accept-Language': 'ru-RU,ru;q=0.8,en-US;q=0.5,en;q=0.3',
+                'Accept-Encoding': 'gzip, deflate',
+                'Connection': 'keep-alive',
+                'Upgrade-Insecure-Requests': '1',
+            }
+            session.client = httpx.AsyncClient(
+                timeout=self.timeout,
+                headers=headers,
+                cookies=session.cookies,
+                follow_redirects=True,
+                transport=SharedTransport(self),
+            )
+            # Клиент и сессия делят одну банку cookies
+            session.cookies = session.client.cookies
+        return session.client
+
+    def _pool_limits(self) -> httpx.Limits:
+        """Пул под потолок параллельности, чтобы разрешенные запросы не ждали соединения."""
+        max_connections = self.concurrency.max_limit
+        if self.http2:
+            # Потоки HTTP/2 делят соединение, хватит нескольких
+            max_connections = max(2, max_connections // 8)
+        return httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=30,
+        )
+
+    async def warmup(self, url: str = "https://vkusvill.ru/", connections: Optional[int] = None):
+        """Заранее открыть соединения пула, чтобы первые запросы не платили за TCP/TLS.
+
+        Пул прогревается один раз, повторно - только после его замены
+        (_retire_transport). Запросы прогрева идут под общими лимитами:
+        цепь страниц проверки, частота и параллельность.
+        """
+        transport = self._ensure_transport()
+        if self._warmed_transport is transport:
+            return
+        self._warmed_transport = transport
+        if connections is None:
+            connections = 1 if self.http2 else int(self.concurrency.limit)
+
+        async def open_connection():
+            try:
+                await self._send_once("HEAD", url, 'catalog')
+            except (httpx.HTTPError, ChallengeDetected):
+                pass
+
+        await asyncio.gather(*(open_connection() for _ in range(connections)))
+
+    def _record_timing(self, timing: RequestTiming):
+        stats = self.pool_stats
+        stats['requests'] += 1
+        if timing.pool_wait is not None:
+            stats['pool_wait_total'] += timing.pool_wait
+            stats['pool_wait_max'] = max(stats['pool_wait_max'], timing.pool_wait)
+        if timing.connect is not None:
+            stats['new_connections'] += 1
+            stats['connect_total'] += timing.connect
+        if timing.server is not None:
+            stats['server_total'] += timing.server
+
+    def _bucket(self, url: str, endpoint: Optional[str] = None) -> TokenBucket:
+        """Token bucket для пары (хост, класс адреса)."""
+        endpoint = endpoint or classify_endpoint(url)
+        key = (urlsplit(url).netloc, endpoint)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            rate, burst = self.rate_limits.get(endpoint, self.rate_limits['catalog'])
+            bucket = self.buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    async def request(self, method: str, url: str, endpoint: Optional[str] = None, cache: bool = True, **kwargs):
+        """Выполнить HTTP запрос с сохранением cookies.
+
+        endpoint переопределяет класс адреса для лимита частоты и TTL кэша.
+        cache=False - запрос идет на сайт мимо кэша (нужны cookies из ответа).
+        """
+        endpoint = endpoint or classify_endpoint(url)
+        if not cache or not self.cache or not self.cache.cacheable(method, endpoint) or 'params' in kwargs:
+            return await self._fetch(method, url, endpoint, **kwargs)
+
+        entry = self.cache.load(url, self.location_key)
+        if entry and self.cache.is_fresh(entry, endpoint):
+            self.cache.stats['hits'] += 1
+            self.cache.stats['bytes_saved'] += len(entry['body'])
+            return self.cache.to_response(method, url, entry)
+
+        if entry:
+            kwargs['headers'] = {**(kwargs.get('headers') or {}), **self.cache.conditional_headers(entry)}
+        response = await self._fetch(method, url, endpoint, **kwargs)
+
+        if entry and response.status_code == 304:
+            self.cache.stats['revalidated'] += 1
+            self.cache.stats['bytes_saved'] += len(entry['body'])
+            self.cache.touch(url, self.location_key, entry)
+            return self.cache.to_response(method, url, entry)
+
+        self.cache.stats['misses'] += 1
+        if response.status_code == 200 and self._classify(response) == 'ok':
+            self.cache.store(url, self.location_key, response)
+        return response
+
+    async def _fetch(self, method: str, url: str, endpoint: str, **kwargs):
+        """Сетевой запрос, с хеджированием для медленных GET выбранных классов."""
+        if self.hedge and method.upper() == 'GET' and endpoint in self.hedge_endpoints:
+            return await self._send_hedged(method, url, endpoint, **kwargs)
+        return await self._send(method, url, endpoint, **kwargs)
+
+    def _hedge_delay(self, endpoint: str) -> Optional[float]:
+        """p95 времени ответа класса или None, пока замеров мало."""
+        samples = self._latency_samples.get(endpoint)
+        if not samples or len(samples) < 20:
+            return None
+        ordered = sorted(samples)
+        return max(0.05, ordered[int(len(ordered) * 0.95) - 1])
+
+    def _record_latency(self, endpoint: str, latency: float):
+        self._latency_samples.setdefault(endpoint, deque(maxlen=500)).append(latency)
+
+    async def _send_hedged(self, method: str, url: str, endpoint: str, **kwargs):
+        """Если основной запрос не ответил за p95, отправить дубль; ответ - от первого.
+
+        Отсчет идет с момента, когда запрос получил слот параллельности:
+        ожидание в очереди лимитера дублем не ускорить.
+        """
+        self.hedge_stats['requests'] += 1
+        sent = asyncio.Event()
+        primary = asyncio.create_task(self._send(method, url, endpoint, sent=sent, **kwargs))
+        tasks = {primary}
+        try:
+            waiter = asyncio.create_task(sent.wait())
+            try:
+                await asyncio.wait({primary, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiter.cancel()
+            on_wire = time.monotonic()
+
+            delay = self._hedge_delay(endpoint)
+            hedge_sent = None
+            within_budget = self.hedge_stats['hedged'] < self.hedge_budget * self.hedge_stats['requests']
+            if delay is not None and within_budget and not primary.done():
+                await asyncio.wait(tasks, timeout=delay)
+                if not primary.done():
+                    self.hedge_stats['hedged'] += 1
+                    hedge_sent = time.monotonic()
+                    tasks.add(asyncio.create_task(self._send(method, url, endpoint, **kwargs)))
+
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        if task is primary or error is None:
+                            error = task.exception()
+                        continue
+                    now = time.monotonic()
+                    elapsed = now - on_wire
+                    if task is not primary:
+                        # Нижняя граница выигрыша: основной запрос к отмене был в пути
+                        # elapsed и еще не ответил, дублю на весь ответ хватило меньше
+                        hedge_latency = now - hedge_sent
+                        self.hedge_stats['hedge_wins'] += 1
+                        self.hedge_stats['saved_seconds'] += elapsed - hedge_latency
+                        self._record_latency(endpoint, hedge_latency)
+                    # Для отмененного основного запроса известна лишь нижняя граница времени
+                    self._record_latency(endpoint, elapsed)
+                    return task.result()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _send(self, method: str, url: str, endpoint: str, sent: Optional[asyncio.Event] = None, **kwargs):
+        """Запрос с повторами сетевых сбоев для идемпотентных методов."""
+        attempts = self.max_retries + 1 if method.upper() in IDEMPOTENT_METHODS else 1
+        for attempt in range(attempts):
+            try:
+                response = await self._send_once(method, url, endpoint, sent=sent, **kwargs)
+            except RETRYABLE_ERRORS:
+                self._record_session_outcome(failed=True)
+                if attempt + 1 >= attempts:
+                    raise
+                self.retry_stats['retries'] += 1
+                # Full jitter: повторы разных запросов не совпадают по времени
+                await asyncio.sleep(random.uniform(0, self.retry_backoff * 2 ** attempt))
+                continue
+            self._record_session_outcome(failed=False)
+            return response
+
+    def _record_session_outcome(self, failed: bool):
+        if self.session_breaker.record(failed) and self.transport is not None:
+            self.retry_stats['session_resets'] += 1
+            print("⚠️ Устойчивые сетевые сбои, пересоздаем HTTP сессию")
+            self._retire_transport()
+
+    def _retire_transport(self):
+        """Заменить пул соединений новым; старый закрывается, когда его запросы завершатся.
+
+        Cookies сессий при этом сохраняются.
+        """
+        old_transport, self.transport = self.transport, None
+        # Новый пул прогреется при следующем warmup()
+        self._warmed_transport = None
+
+        async def close_later():
+            await asyncio.sleep(self.timeout)
+            self._retired_transports.pop(task, None)
+            await old_transport.aclose()
+
+        task = asyncio.create_task(close_later())
+        self._retired_transports[task] = old_transport
+
+    async def _send_once(self, method: str, url: str, endpoint: str, sent: Optional[asyncio.Event] = None, **kwargs):
+        """Запрос к сайту под лимитами частоты и параллельности."""
+        probe = await self.challenge_circuit.wait()
+        try:
+            await self._bucket(url, endpoint).acquire()
+            started = await self.concurrency.acquire()
+        except BaseException:
+            # Отмененная в очереди проба не должна оставить цепь полуоткрытой
+            self.challenge_circuit.record('error', probe=probe)
+            raise
+        if sent is not None:
+            sent.set()
+        outcome = 'error'
+        retry_after = None
+        challenge = None
+        timing = RequestTiming()
+        try:
+            client = await self._ensure_client()
+            extensions = {**(kwargs.pop('extensions', None) or {}), 'trace': timing.trace}
+            try:
+                response = await client.request(method, url, extensions=extensions, **kwargs)
+            except httpx.TimeoutException:
+                # Соединение с таймаутом httpcore выбрасывает из пула сам,
+                # остальные запросы и cookies клиента не трогаем
+                outcome = 'timeout'
+                raise
+            challenge = detect_challenge(response)
+            outcome = self._classify(response, challenge)
+            if outcome == 'throttled':
+                retry_after = self._parse_retry_after(response)
+            if challenge:
+                raise ChallengeDetected(url, challenge)
+            return response
+        finally:
+            self._record_timing(timing)
+            self.concurrency.release(started, outcome, retry_after, latency=timing.server)
+            self.challenge_circuit.record(outcome, challenge, probe)
+
+    def _classify(self, response, challenge: Optional[str] = None) -> str:
+        """Оценка ответа для контроллера параллельности."""
+        if challenge:
+            return 'challenge'
+        if response.status_code in THROTTLE_STATUSES:
+            return 'throttled'
+        return 'ok'
+
+    @staticmethod
+    def _parse_retry_after(response) -> Optional[float]:
+        value = response.headers.get('retry-after')
+        try:
+            return float(value) if value else None
+        except ValueError:
+            return None
+
+    def metrics(self) -> Dict:
+        """Метрики клиента для логов и статистики воркера."""
+        return {
+            'concurrency': self.concurrency.metrics(),
+            'rate': {f"{host} {endpoint}": bucket.metrics() for (host, endpoint), bucket in self.buckets.items()},
+            'cache': self.cache.metrics() if self.cache else None,
+            'pool': self._pool_metrics(),
+            'retries': {
+                **self.retry_stats,
+                'failure_rate': round(self.session_breaker.failure_rate, 3),
+            },
+            'hedge': self._hedge_metrics() if self.hedge else None,
+            'challenge': self.challenge_circuit.metrics(),
+            'sessions': {**self.session_stats, 'active': len(self.sessions)},
+        }
+
+    def _hedge_metrics(self) -> Dict:
+        """Счетчики хеджирования и хвост задержек по классам."""
+        tails = {}
+        for endpoint, samples in self._latency_samples.items():
+            ordered = sorted(samples)
+            tails[endpoint] = {
+                'p95_delay': round(self._hedge_delay(endpoint) or 0, 3),
+                'p99': round(ordered[max(0, int(len(ordered) * 0.99) - 1)], 3),
+            }
+        return {**self.hedge_stats, 'saved_seconds': round(self.hedge_stats['saved_seconds'], 2), 'tails': tails}
+
+    def _pool_metrics(self) -> Dict:
+        """Средние времена: ожидание пула отдельно от соединения и ответа сервера."""
+        stats = self.pool_stats
+        requests = stats['requests'] or 1
+        return {
+            'http2': self.http2,
+            'requests': stats['requests'],
+            'new_connections': stats['new_connections'],
+            'avg_pool_wait': round(stats['pool_wait_total'] / requests, 4),
+            'max_pool_wait': round(stats['pool_wait_max'], 4),
+            'avg_connect': round(stats['connect_total'] / max(stats['new_connections'], 1), 4),
+            'avg_server': round(stats['server_total'] / requests, 4),
+        }
+
+    async def close(self):
+        """Закрытие клиента."""
+        for task, old_transport in list(self._retired_transports.items()):
+            task.cancel()
+            await old_transport.aclose()
+        self._retired_transports.clear()
+        self.default_session.client = None
+        for session in self.sessions.values():
+            session.client = None
+        if self.transport:
+            await self.transport.aclose()
+            self.transport = None
+        self._warmed_transport = None
@@ -119,8 +119,8 @@ async def health_check():
 
 
 @app.post("/admin/parse_full")
-async def trigger_full_parsing():
-    """Запуск полного парсинга."""
+async def trigger_full_parsing(incremental: bool = True):
+    """Запуск полного парсинга (incremental=false - все карточки заново)."""
     try:
         redis = await get_redis()
 
@@ -129,6 +129,7 @@ async def trigger_full_parsing():
             "task_id": f"admin_full_{int(datetime.now().timestamp())}",
             "user_id": 0,
             "mode": "full",
+            "incremental": incremental,
             "admin_command": True,
             "timestamp": datetime.now().isoformat()
         }
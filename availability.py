@@ -0,0 +1,119 @@
+"""
+availability.py - Кэш доступных по адресу товаров по ячейкам геосетки.
+
+Ассортимент зависит от магазина, который обслуживает адрес, а не от точных
+координат: соседние адреса получают один и тот же список. Список доступных
+ID хранится по ячейке geohash координат в Redis (если он подключен) или в
+JSON-файлах на диске. Запись свежая ttl секунд; после этого до max_stale
+секунд она еще отдается сразу, а парсер обновляет ее в фоне.
+"""
+
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# Файлы ячеек при работе без Redis (AVAILABILITY_CACHE_DIR переопределяет путь)
+AVAILABILITY_CACHE_DIR = "data/availability"
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash(lat: float, lon: float, precision: int = 6) -> str:
+    """Geohash точки: 6 символов - ячейка около 1.2 x 0.6 км."""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    code = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(code) < precision:
+        value, bounds = (lon, lon_range) if even else (lat, lat_range)
+        middle = (bounds[0] + bounds[1]) / 2
+        if value >= middle:
+            bits = bits * 2 + 1
+            bounds[0] = middle
+        else:
+            bits = bits * 2
+            bounds[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            code.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(code)
+
+
+class AvailabilityCache:
+    """Доступные ID товаров по ячейке геосетки с TTL и отдачей устаревших записей."""
+
+    def __init__(self, redis=None, cache_dir: Optional[str] = None, ttl: int = 1800,
+                 max_stale: int = 6 * 3600, precision: int = 6):
+        # redis - клиент redis.asyncio; без него записи хранятся в cache_dir
+        self.redis = redis
+        self.cache_dir = Path(cache_dir or AVAILABILITY_CACHE_DIR)
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.precision = precision
+        self.stats = {'hits': 0, 'stale': 0, 'misses': 0, 'stored': 0, 'errors': 0}
+
+    @classmethod
+    def from_env(cls, redis=None) -> 'AvailabilityCache':
+        return cls(
+            redis=redis,
+            cache_dir=os.getenv("AVAILABILITY_CACHE_DIR", str(Path(__file__).parent / AVAILABILITY_CACHE_DIR)),
+            ttl=int(os.getenv("AVAILABILITY_TTL", "1800")),
+            max_stale=int(os.getenv("AVAILABILITY_MAX_STALE", str(6 * 3600))),
+            precision=int(os.getenv("AVAILABILITY_CELL_PRECISION", "6")),
+        )
+
+    def cell(self, coords: str) -> str:
+        """Ячейка геосетки для координат "lat,lon"."""
+        lat, lon = coords.split(',')
+        return geohash(float(lat), float(lon), self.precision)
+
+    async def get(self, cell: str) -> Optional[Tuple[List[str], float, float]]:
+        """(ID, возраст записи в секундах, время записи) или None, если записи нет или она слишком старая."""
+        try:
+            entry = await self._load(cell)
+        except Exception:
+            self.stats['errors'] += 1
+            entry = None
+        age = time.time() - entry['ts'] if entry else None
+        if entry is None or age > self.ttl + self.max_stale:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits' if age <= self.ttl else 'stale'] += 1
+        return entry['ids'], age, entry['ts']
+
+    async def put(self, cell: str, ids: List[str], ts: Optional[float] = None):
+        """Записать ID; ts - время проверки, если список скопирован из другой записи."""
+        entry = {'ids': ids, 'ts': ts if ts is not None else time.time()}
+        try:
+            await self._store(cell, entry)
+            self.stats['stored'] += 1
+        except Exception:
+            self.stats['errors'] += 1
+
+    async def _load(self, cell: str) -> Optional[Dict]:
+        if self.redis is not None:
+            raw = await self.redis.get(f"availability:{cell}")
+            return json.loads(raw) if raw else None
+        path = self.cache_dir / f"{cell}.json"
+        if not path.exists():
+            return None
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    async def _store(self, cell: str, entry: Dict):
+        if self.redis is not None:
+            await self.redis.set(f"availability:{cell}", json.dumps(entry), ex=self.ttl + self.max_stale)
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self.cache_dir / f"{cell}.json"
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
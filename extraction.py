@@ -0,0 +1,1107 @@
+#!/usr/bin/env python3
+"""
+extraction.py - Извлечение данных из карточек товаров ВкусВилл.
+
+TextIndex собирает текст страницы за один обход DOM: тексты листьев склеены
+в одну строку, для каждого элемента известен его отрезок в ней. Текст любого
+элемента - это срез строки, поэтому поиск "элемента с ключевым словом" не
+пересобирает текст вложенных узлов заново для каждого предка.
+
+CardPage разбирает не всю страницу, а блок товара: его границы и скрипты с
+JSON-LD находятся поиском подстрок, DOM строится только по этому срезу, а
+шапка, меню, подвал и рекомендации не попадают ни в DOM, ни в регулярные
+выражения. Если поле в блоке не нашлось (или блок не распознан), правила
+повторяются по всей странице.
+
+Поля карточки извлекаются по таблице правил FIELD_RULES: для каждого поля
+упорядоченный по цене список стратегий (JSON-LD, точные селекторы, поиск по
+индексу текста, регулярные выражения по странице). Первое значение, прошедшее
+проверку поля, завершает поиск - дорогие стратегии на типичной карточке не
+запускаются. Все регулярные выражения компилируются при импорте.
+
+StrategyStats считает попадания и время каждой стратегии и переставляет
+вперед ту, что надежно срабатывает на текущем шаблоне сайта. Статистика
+сохраняется между запусками, поэтому следующий обход сразу начинает с
+выигравшей стратегии.
+
+ExtractionPool выносит разбор в пул процессов: загрузчики передают байты
+ответа в extract_card и продолжают качать, пока карточка разбирается на
+другом ядре. Порядок стратегий передается в процесс, записи о попытках
+возвращаются и применяются к StrategyStats основного процесса.
+"""
+
+import asyncio
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from bisect import bisect_left, bisect_right
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import urljoin
+
+try:
+    from selectolax.parser import HTMLParser
+except ImportError:
+    HTMLParser = None
+
+BASE_URL = "https://vkusvill.ru"
+
+NUMBER_RUN_RE = re.compile(r'\d+')
+NUMBER_RE = re.compile(r'(\d+(?:[.,]\d+)?)')
+META_TAG_RE = re.compile(r'<meta\b[^>]*>', re.I)
+META_CONTENT_RE = re.compile(r'content\s*=\s*["\']([^"\']*)["\']', re.I)
+
+# Начало блока товара - по приоритету маркеров, а не по позиции в документе
+PRODUCT_REGION_STARTS = (
+    'itemtype="http://schema.org/Product"',
+    'itemtype="https://schema.org/Product"',
+    'class="Product ',
+    'class="Product"',
+    'class="product-card',
+    'class="goods-card',
+    '<main',
+    '<h1',
+)
+# Конец блока - первый из маркеров после начала: рекомендации, подвал
+PRODUCT_REGION_ENDS = (
+    'class="reco',
+    'class="Recommend',
+    'class="js-product-recommend',
+    '<footer',
+    '</main>',
+)
+JSONLD_MARKER = 'application/ld+json'
+# Скрипты с состоянием страницы, где встречается цена в JSON
+STATE_SCRIPT_MARKERS = ('__NEXT_DATA__', '__INITIAL_STATE__', '__NUXT__')
+
+PRICE_JSON_RES = tuple(re.compile(pattern, re.I) for pattern in (
+    r'"price"\s*:\s*"?(\d+(?:[.,]\d+)?)"?',
+    r'"cost"\s*:\s*"?(\d+(?:[.,]\d+)?)"?',
+    r'"currentPrice"\s*:\s*"?(\d+(?:[.,]\d+)?)"?',
+))
+PRICE_TEXT_RES = tuple(re.compile(pattern, re.I) for pattern in (
+    r'(\d+(?:[.,]\d+)?)\s*руб',
+    r'(\d+(?:[.,]\d+)?)\s*₽',
+    r'цена[:\s]*(\d+(?:[.,]\d+)?)',
+    r'стоимость[:\s]*(\d+(?:[.,]\d+)?)',
+))
+# Цена на странице: itemprop, точные селекторы текущей цены, любой элемент с ценой
+PRICE_ITEMPROP_SELECTOR = '[itemprop="price"]'
+CURRENT_PRICE_SELECTOR = '.js-product-price, .product-price, .goods-price, .current-price'
+ANY_PRICE_SELECTOR = '.price, .cost, [data-testid*="price"], [class*="price"]'
+# Старая (зачеркнутая) цена и цена за единицу веса - не цена товара
+NOT_CURRENT_PRICE_RE = re.compile(r'old|prev|crossed|strike|discount-base|unit|per-?kg|per-?100|за-?кг', re.I)
+STRUCK_TAGS = ('s', 'del', 'strike')
+# В плитках каталога класс цены бывает с заглавной буквы (ProductCard__Price)
+LISTING_ANY_PRICE_SELECTOR = f'{ANY_PRICE_SELECTOR}, [class*="Price"]'
+PORTION_RE = re.compile(r'(\d+(?:[.,]\d+)?)\s*(?:г|гр|грам)', re.I)
+PORTION_LABELED_RE = re.compile(r'(?:вес|масса)[^\d]{0,20}(\d+(?:[.,]\d+)?)\s*(?:г|гр|грам)', re.I)
+
+NUTRITION_FIELDS = ('kcal_100g', 'protein_100g', 'fat_100g', 'carb_100g')
+
+# Слова, по которым элемент страницы относится к блоку БЖУ
+NUTRITION_CONTEXT_WORDS = (
+    'ккал', 'белки', 'жиры', 'углеводы', 'энергетическая', 'калорийность', 'пищевая', 'ценность', 'состав',
+)
+NUTRITION_TRIGGERS = {
+    'kcal_100g': ('ккал', 'калорийность', 'энергетическая'),
+    'protein_100g': ('белк',),
+    'fat_100g': ('жир',),
+    'carb_100g': ('углевод',),
+}
+# Шаблоны для текста одного элемента (уже в нижнем регистре)
+NUTRITION_ELEMENT_RES = {
+    'kcal_100g': tuple(re.compile(pattern) for pattern in (
+        r'(\d+(?:[.,]\d+)?)\s*ккал',  # "189.6 Ккал"
+        r'ккал[:\s]*(\d+(?:[.,]\d+)?)',
+        r'калорийность[:\s]*(\d+(?:[.,]\d+)?)',
+        r'энергетическая\s+ценность[:\s]*(\d+(?:[.,]\d+)?)',
+    )),
+    'protein_100g': tuple(re.compile(pattern) for pattern in (
+        r'(\d+(?:[.,]\d+)?)\s+белки,\s*г',  # "11 Белки, г"
+        r'белк[иа][:\s]*(\d+(?:[.,]\d+)?)',
+        r'белок[:\s]*(\d+(?:[.,]\d+)?)',
+        r'(\d+(?:[.,]\d+)?)\s*г\s*белк',
+    )),
+    'fat_100g': tuple(re.compile(pattern) for pattern in (
+        r'(\d+(?:[.,]\d+)?)\s+жиры,\s*г',  # "7.6 Жиры, г"
+        r'жир[ыа][:\s]*(\d+(?:[.,]\d+)?)',
+        r'жир[:\s]*(\d+(?:[.,]\d+)?)',
+        r'(\d+(?:[.,]\d+)?)\s*г\s*жир',
+    )),
+    'carb_100g': tuple(re.compile(pattern) for pattern in (
+        r'(\d+(?:[.,]\d+)?)\s+углеводы,\s*г',  # "19.3 Углеводы, г"
+        r'углевод[ыа][:\s]*(\d+(?:[.,]\d+)?)',
+        r'углевод[:\s]*(\d+(?:[.,]\d+)?)',
+        r'(\d+(?:[.,]\d+)?)\s*г\s*углевод',
+    )),
+}
+# Шаблоны для всей страницы - последний резерв
+NUTRITION_PAGE_RES = {
+    'kcal_100g': tuple(re.compile(pattern, re.I) for pattern in (
+        r'(\d+(?:[.,]\d+)?)\s*ккал',
+        r'калорийность[:\s]*(\d+(?:[.,]\d+)?)',
+        r'энергетическая\s+ценность[:\s]*(\d+(?:[.,]\d+)?)',
+        r'энергия[:\s]*(\d+(?:[.,]\d+)?)\s*ккал',
+    )),
+    'protein_100g': tuple(re.compile(pattern, re.I) for pattern in (
+        r'(\d+(?:[.,]\d+)?)\s+белки,\s*г',
+        r'белки[:\s]*(\d+(?:[.,]\d+)?)',
+        r'белок[:\s]*(\d+(?:[.,]\d+)?)',
+        r'протеин[:\s]*(\d+(?:[.,]\d+)?)',
+    )),
+    'fat_100g': tuple(re.compile(pattern, re.I) for pattern in (
+        r'(\d+(?:[.,]\d+)?)\s+жиры,\s*г',
+        r'жиры[:\s]*(\d+(?:[.,]\d+)?)',
+        r'жир[:\s]*(\d+(?:[.,]\d+)?)',
+    )),
+    'carb_100g': tuple(re.compile(pattern, re.I) for pattern in (
+        r'(\d+(?:[.,]\d+)?)\s+углеводы,\s*г',
+        r'углеводы[:\s]*(\d+(?:[.,]\d+)?)',
+        r'углевод[:\s]*(\d+(?:[.,]\d+)?)',
+    )),
+}
+
+COMPOSITION_NOISE = ('меню', 'каталог', 'корзина', 'вкусвилл', 'доставки', 'выберите')
+PHOTO_KEYWORDS = ('product', 'goods', 'catalog', 'upload', 'resize')
+PHOTO_SKIP = ('icon', 'logo', 'banner', 'button', 'svg')
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+class TextIndex:
+    """Текст страницы и отрезки элементов, собранные за один обход.
+
+    Текст элемента совпадает с element.text() selectolax: склейка всех
+    текстовых узлов поддерева без разделителей (комментарии не входят).
+    """
+
+    def __init__(self, root):
+        chunks: List[str] = []
+        # (тег, начало, конец) в порядке документа
+        self.elements: List[List] = []
+        self.by_tag: Dict[str, List[int]] = {}
+        # Родитель каждого элемента и начало/родитель каждого текстового узла
+        self.parents: List[int] = []
+        self._chunk_starts: List[int] = []
+        self._chunk_parents: List[int] = []
+        if root is not None:
+            self._build(root, chunks)
+        self.text = ''.join(chunks)
+        lower = self.text.lower()
+        # Для редких символов lower() меняет длину - тогда отрезки считаем по исходному тексту
+        self.lower = lower if len(lower) == len(self.text) else None
+        self._hits: Dict[str, List[int]] = {}
+        self._number_starts: Optional[List[int]] = None
+        self._number_ends: List[int] = []
+
+    def _build(self, root, chunks: List[str]):
+        elements = self.elements
+        by_tag = self.by_tag
+        parents = self.parents
+        chunk_starts = self._chunk_starts
+        chunk_parents = self._chunk_parents
+        pos = 0
+        # Обход по ссылкам child/next: в стеке открытые элементы, конец отрезка
+        # элемента записывается, когда обход поднимается из его поддерева
+        stack = []
+        node = root
+        while node is not None:
+            tag = node.tag
+            first = tag[0]
+            if first == '-':
+                text = node.text_content
+                if text:
+                    chunks.append(text)
+                    chunk_starts.append(pos)
+                    chunk_parents.append(stack[-1][2] if stack else -1)
+                    pos += len(text)
+            elif first != '_' and first != '!':
+                index = len(elements)
+                element = [tag, pos, pos]
+                by_tag.setdefault(tag, []).append(index)
+                elements.append(element)
+                parents.append(stack[-1][2] if stack else -1)
+                child = node.child
+                if child is not None:
+                    stack.append((node, element, index))
+                    node = child
+                    continue
+            if not stack:
+                break
+            node = node.next
+            while node is None and stack:
+                parent, element, _ = stack.pop()
+                element[2] = pos
+                node = parent.next if stack else None
+
+    def element_text(self, index: int) -> str:
+        _, start, end = self.elements[index]
+        return self.text[start:end]
+
+    def element_lower(self, index: int) -> str:
+        _, start, end = self.elements[index]
+        if self.lower is not None:
+            return self.lower[start:end]
+        return self.text[start:end].lower()
+
+    def hits(self, keyword: str) -> List[int]:
+        """Позиции ключевого слова (в нижнем регистре) в тексте страницы."""
+        positions = self._hits.get(keyword)
+        if positions is None:
+            positions = []
+            if self.lower is not None:
+                pos = self.lower.find(keyword)
+                while pos != -1:
+                    positions.append(pos)
+                    pos = self.lower.find(keyword, pos + 1)
+            self._hits[keyword] = positions
+        return positions
+
+    def contains(self, index: int, keyword: str) -> bool:
+        """Есть ли ключевое слово целиком внутри текста элемента."""
+        if self.lower is None:
+            return keyword in self.element_lower(index)
+        _, start, end = self.elements[index]
+        positions = self.hits(keyword)
+        i = bisect_left(positions, start)
+        return i < len(positions) and positions[i] + len(keyword) <= end
+
+    def numbers_in(self, index: int) -> int:
+        """Число групп цифр в тексте элемента (как len(re.findall(r'\\d+', text)))."""
+        if self._number_starts is None:
+            self._number_starts = []
+            for match in NUMBER_RUN_RE.finditer(self.text):
+                self._number_starts.append(match.start())
+                self._number_ends.append(match.end())
+        _, start, end = self.elements[index]
+        return bisect_left(self._number_starts, end) - bisect_right(self._number_ends, start)
+
+    def candidates(self, tags: Sequence[str], keywords: Sequence[str]) -> Iterator[int]:
+        """Элементы с тегами tags, в тексте которых есть одно из keywords.
+
+        Порядок как у parser.css('tag1, tag2, ...'): по тегам, внутри тега - по документу.
+        Кандидаты - предки текстовых узлов с вхождениями слова, остальные
+        элементы страницы не просматриваются.
+        """
+        if self.lower is None:
+            for tag in tags:
+                for index in self.by_tag.get(tag, ()):
+                    if any(self.contains(index, keyword) for keyword in keywords):
+                        yield index
+            return
+
+        found = set()
+        for keyword in keywords:
+            for hit in self.hits(keyword):
+                hit_end = hit + len(keyword)
+                chunk = bisect_right(self._chunk_starts, hit) - 1
+                element = self._chunk_parents[chunk] if chunk >= 0 else -1
+                # Вверх по предкам: как только элемент содержит слово, его содержат и все выше
+                while element != -1 and element not in found:
+                    if self.elements[element][2] >= hit_end:
+                        found.add(element)
+                    element = self.parents[element]
+        for tag in tags:
+            for index in sorted(i for i in found if self.elements[i][0] == tag):
+                yield index
+
+
+def locate_region(html: str) -> Optional[Tuple[int, int]]:
+    """Границы блока товара в HTML поиском подстрок; None - блок не распознан."""
+    for marker in PRODUCT_REGION_STARTS:
+        start = html.find(marker)
+        if start == -1:
+            continue
+        # Начало тега, в котором найден маркер
+        tag_start = html.rfind('<', 0, start + 1)
+        start = tag_start if tag_start != -1 else start
+        end = len(html)
+        for end_marker in PRODUCT_REGION_ENDS:
+            position = html.find(end_marker, start + len(marker))
+            if position != -1:
+                tag_start = html.rfind('<', start, position + 1)
+                end = min(end, tag_start if tag_start > start else position)
+        return start, end
+    return None
+
+
+def script_bodies(html: str, marker: str, in_tag: bool) -> Iterator[str]:
+    """Тела тегов <script>, у которых маркер в открывающем теге (in_tag) или в содержимом."""
+    position = html.find(marker)
+    while position != -1:
+        open_start = html.rfind('<script', 0, position)
+        open_end = html.find('>', open_start) if open_start != -1 else -1
+        close = html.find('</script', open_end) if open_end != -1 else -1
+        if close == -1:
+            return
+        inside = position < open_end if in_tag else open_end < position < close
+        if inside:
+            yield html[open_end + 1:close]
+            position = html.find(marker, close)
+        else:
+            position = html.find(marker, position + len(marker))
+
+
+class CardPage:
+    """HTML карточки с ленивым разбором: DOM, индекс текста и JSON-LD строятся по требованию.
+
+    scoped=True ограничивает DOM и регулярные выражения блоком товара;
+    full() - та же страница целиком для повторного поиска.
+    """
+
+    def __init__(self, html: str, url: str = '', scoped: bool = True):
+        self.html = html
+        self.url = url
+        self.bounds = locate_region(html) if scoped else None
+        self.scoped = self.bounds is not None
+        self._region = None
+        self._head = None
+        self._scripts = None
+        self._dom = None
+        self._index = None
+        self._jsonld = None
+        self._full = None
+        self._groups: Dict[str, Dict[str, List[str]]] = {}
+
+    @property
+    def region(self) -> str:
+        """HTML блока товара (вся страница, если блок не распознан)."""
+        if self._region is None:
+            self._region = self.html[self.bounds[0]:self.bounds[1]] if self.scoped else self.html
+        return self._region
+
+    @property
+    def head(self) -> str:
+        """HTML до <body> - meta-теги og:*."""
+        if self._head is None:
+            end = self.html.find('<body')
+            self._head = self.html[:end] if end != -1 else self.html
+        return self._head
+
+    @property
+    def scripts(self) -> str:
+        """JSON из JSON-LD и скриптов состояния (вся страница без блока товара)."""
+        if self._scripts is None:
+            if not self.scoped:
+                self._scripts = self.html
+            else:
+                bodies = list(script_bodies(self.html, JSONLD_MARKER, True))
+                for marker in STATE_SCRIPT_MARKERS:
+                    bodies.extend(script_bodies(self.html, marker, False))
+                self._scripts = '\n'.join(bodies)
+        return self._scripts
+
+    def full(self) -> 'CardPage':
+        """Вся страница без ограничения блоком товара."""
+        if not self.scoped:
+            return self
+        if self._full is None:
+            self._full = CardPage(self.html, self.url, scoped=False)
+            self._full._jsonld = self._jsonld
+        return self._full
+
+    @property
+    def dom(self):
+        if self._dom is None and HTMLParser is not None:
+            self._dom = HTMLParser(self.region)
+        return self._dom
+
+    @property
+    def index(self) -> TextIndex:
+        if self._index is None:
+            self._index = TextIndex(self.dom.root)
+        return self._index
+
+    @property
+    def jsonld(self) -> List:
+        """Разобранные блоки application/ld+json."""
+        if self._jsonld is None:
+            self._jsonld = []
+            for raw in script_bodies(self.html, JSONLD_MARKER, True):
+                try:
+                    self._jsonld.append(json.loads(raw))
+                except ValueError:
+                    continue
+        return self._jsonld
+
+    def group(self, name: str, build: Callable[['CardPage'], Dict[str, List[str]]]) -> Dict[str, List[str]]:
+        """Результат источника, который дает сразу несколько полей (считается один раз)."""
+        if name not in self._groups:
+            self._groups[name] = build(self)
+        return self._groups[name]
+
+
+class Strategy:
+    """Способ извлечь поле: имя для статистики, условная цена и генератор кандидатов.
+
+    fallback=False - не повторять по всей странице: результат от блока товара
+    не зависит (JSON-LD, meta) или вне блока стратегия ловит чужие значения.
+    catch_all=True - общий перебор (любой элемент с ценой, первое "N г"):
+    такая стратегия всегда идет после точных, как бы быстро она ни находила.
+    """
+
+    def __init__(self, name: str, cost: int, candidates: Callable[[CardPage], Iterable], fallback: bool = True,
+                 catch_all: bool = False):
+        self.name = name
+        self.cost = cost
+        self.candidates = candidates
+        self.fallback = fallback
+        self.catch_all = catch_all
+
+    def __repr__(self):
+        return f"Strategy({self.name!r}, cost={self.cost})"
+
+
+# --- Источники кандидатов ---
+
+def _walk_json(obj) -> Iterator[Dict]:
+    if isinstance(obj, dict):
+        yield obj
+        for value in obj.values():
+            yield from _walk_json(value)
+    elif isinstance(obj, list):
+        for value in obj:
+            yield from _walk_json(value)
+
+
+def _jsonld_objects(page: CardPage, types: Sequence[str]) -> Iterator[Dict]:
+    for block in page.jsonld:
+        for obj in _walk_json(block):
+            if obj.get('@type') in types:
+                yield obj
+
+
+def jsonld_product(*path: str) -> Callable[[CardPage], Iterator]:
+    """Значение по пути в объекте Product из JSON-LD (списки разворачиваются)."""
+    def candidates(page: CardPage):
+        for product in _jsonld_objects(page, ('Product',)):
+            values = [product]
+            for key in path:
+                next_values = []
+                for value in values:
+                    for item in (value if isinstance(value, list) else [value]):
+                        if isinstance(item, dict) and key in item:
+                            next_values.append(item[key])
+                values = next_values
+            for value in values:
+                for item in (value if isinstance(value, list) else [value]):
+                    if isinstance(item, dict):
+                        item = item.get('url') or item.get('value') or item.get('contentUrl')
+                    if item is not None:
+                        yield str(item)
+    return candidates
+
+
+def css_text(selector: str) -> Callable[[CardPage], Iterator]:
+    """Текст элементов по селектору, в порядке документа."""
+    def candidates(page: CardPage):
+        if page.dom is None:
+            return
+        for element in page.dom.css(selector):
+            yield element.text(strip=True)
+    return candidates
+
+
+def css_attr(selector: str, attribute: str) -> Callable[[CardPage], Iterator]:
+    """Атрибут элементов по селектору (meta content, itemprop и т.п.)."""
+    def candidates(page: CardPage):
+        if page.dom is None:
+            return
+        for element in page.dom.css(selector):
+            value = element.attributes.get(attribute)
+            if value:
+                yield value
+    return candidates
+
+
+def meta_content(prop: str) -> Callable[[CardPage], Iterator]:
+    """content meta-тега с property/name из <head> (без разбора DOM)."""
+    quoted = (f'"{prop}"', f"'{prop}'")
+    def candidates(page: CardPage):
+        for tag in META_TAG_RE.findall(page.head):
+            if any(value in tag for value in quoted):
+                match = META_CONTENT_RE.search(tag)
+                if match:
+                    yield match.group(1)
+    return candidates
+
+
+def regex_in(patterns: Sequence, region: str) -> Callable[[CardPage], Iterator]:
+    """Группа 1 шаблонов по области: 'text' - видимый текст блока товара,
+    'html' - HTML блока товара, 'scripts' - JSON-LD и скрипты состояния."""
+    def candidates(page: CardPage):
+        if region == 'text':
+            haystack = page.index.text
+        elif region == 'scripts':
+            haystack = page.scripts
+        else:
+            haystack = page.region
+        for pattern in patterns:
+            for match in pattern.finditer(haystack):
+                yield match.group(1)
+    return candidates
+
+
+def grouped(name: str, build: Callable[[CardPage], Dict[str, List[str]]], field: str) -> Callable[[CardPage], Iterator]:
+    """Кандидаты поля из источника, который разбирается один раз на все поля."""
+    def candidates(page: CardPage):
+        yield from page.group(name, build).get(field, ())
+    return candidates
+
+
+def _image_size(element) -> Optional[Tuple[int, int]]:
+    width = element.attributes.get('width')
+    height = element.attributes.get('height')
+    if width and height:
+        try:
+            return int(width), int(height)
+        except ValueError:
+            return None
+    return None
+
+
+def photo_images(selector: str) -> Callable[[CardPage], Iterator]:
+    """Адреса картинок, похожих на фото товара (без иконок и мелких изображений)."""
+    def candidates(page: CardPage):
+        if page.dom is None:
+            return
+        for element in page.dom.css(selector):
+            src = element.attributes.get('src') or element.attributes.get('data-src')
+            if not src:
+                continue
+            lower = src.lower()
+            size = _image_size(element)
+            if any(keyword in lower for keyword in PHOTO_KEYWORDS):
+                if size and (size[0] < 50 or size[1] < 50):
+                    continue
+                yield src
+            elif src.startswith('/') and any(ext in lower for ext in PHOTO_EXTENSIONS):
+                # Без ключевых слов берем только большое изображение
+                if size and size[0] >= 100 and size[1] >= 100:
+                    yield src
+    return candidates
+
+
+def composition_elements(page: CardPage) -> Iterator[str]:
+    """Текст элементов со словом "состав" через индекс текста."""
+    index = page.index
+    for element in index.candidates(('div', 'p', 'span', 'td', 'li'), ('состав',)):
+        yield index.element_text(element)
+
+
+def nutrition_jsonld(page: CardPage) -> Dict[str, List[str]]:
+    keys = {
+        'kcal_100g': ('calories', 'energy'),
+        'protein_100g': ('proteinContent',),
+        'fat_100g': ('fatContent',),
+        'carb_100g': ('carbohydrateContent',),
+    }
+    found: Dict[str, List[str]] = {}
+    for obj in _jsonld_objects(page, ('NutritionInformation', 'Nutrition')):
+        for field, names in keys.items():
+            for name in names:
+                if obj.get(name):
+                    found.setdefault(field, []).append(str(obj[name]))
+    return found
+
+
+def nutrition_tables(page: CardPage) -> Dict[str, List[str]]:
+    """Строки таблиц "показатель - значение"; строка относится к первому подходящему полю."""
+    found: Dict[str, List[str]] = {}
+    if page.dom is None:
+        return found
+    for row in page.dom.css('table tr'):
+        cells = row.css('td, th')
+        if len(cells) < 2:
+            continue
+        header = cells[0].text().lower()
+        match = NUMBER_RE.search(cells[1].text())
+        if not match:
+            continue
+        value = match.group(1)
+        if 'ккал' in header or 'калорийность' in header:
+            found.setdefault('kcal_100g', []).append(value)
+        elif 'белк' in header:
+            found.setdefault('protein_100g', []).append(value)
+        elif 'жир' in header:
+            found.setdefault('fat_100g', []).append(value)
+        elif 'углевод' in header:
+            found.setdefault('carb_100g', []).append(value)
+    return found
+
+
+def nutrition_elements(field: str) -> Callable[[CardPage], Iterator]:
+    """Число рядом с ключевым словом поля в небольших элементах блока БЖУ."""
+    def candidates(page: CardPage):
+        index = page.index
+        for element in index.candidates(('div', 'span', 'p', 'td', 'th', 'li'), NUTRITION_TRIGGERS[field]):
+            # Элементы с большим количеством чисел - скорее всего не блок БЖУ
+            if index.numbers_in(element) > 10:
+                continue
+            text = index.element_lower(element)
+            if not any(word in text for word in NUTRITION_CONTEXT_WORDS):
+                continue
+            for pattern in NUTRITION_ELEMENT_RES[field]:
+                match = pattern.search(text)
+                if match:
+                    yield match.group(1)
+    return candidates
+
+
+# --- Проверка и нормализация значений ---
+
+def _number_in_range(low: float, high: float) -> Callable[[str], Optional[str]]:
+    def validate(raw: str) -> Optional[str]:
+        for number in NUMBER_RE.findall(str(raw)):
+            number = number.replace(',', '.')
+            if low <= float(number) <= high:
+                return number
+        return None
+    return validate
+
+
+def valid_name(raw: str) -> Optional[str]:
+    text = raw.strip()
+    return text[:150] or None
+
+
+def valid_photo(raw: str) -> Optional[str]:
+    if any(skip in raw.lower() for skip in PHOTO_SKIP):
+        return None
+    url = urljoin(BASE_URL, raw)
+    return url if url.startswith('http') else None
+
+
+def valid_composition(raw: str) -> Optional[str]:
+    text = raw.strip()
+    lower = text.lower()
+    if 'состав' not in lower or len(text) <= 10:
+        return None
+    if any(word in lower for word in COMPOSITION_NOISE):
+        return None
+    if lower.startswith('состав'):
+        return text[:800]
+    if len(text) < 800:
+        return text[:500]
+    return None
+
+
+def valid_portion(raw: str) -> Optional[str]:
+    match = NUMBER_RE.search(str(raw))
+    if match:
+        weight = float(match.group(1).replace(',', '.'))
+        if 10 <= weight <= 2000:
+            return f"{weight}г"
+    return None
+
+
+def portion_from(texts: Callable[[CardPage], Iterator]) -> Callable[[CardPage], Iterator]:
+    """Вес порции "N г" из текстов источника."""
+    def candidates(page: CardPage):
+        for text in texts(page):
+            for match in PORTION_RE.finditer(text):
+                yield match.group(1)
+    return candidates
+
+
+FIELD_VALIDATORS: Dict[str, Callable[[str], Optional[str]]] = {
+    'name': valid_name,
+    'price': _number_in_range(10, 10000),
+    'photo': valid_photo,
+    'composition': valid_composition,
+    'portion_g': valid_portion,
+    'kcal_100g': _number_in_range(10, 900),
+    'protein_100g': _number_in_range(0, 100),
+    'fat_100g': _number_in_range(0, 100),
+    'carb_100g': _number_in_range(0, 100),
+}
+
+
+# Цена стратегии: 1 - JSON-LD, 2 - meta/itemprop, 3 - точный селектор,
+# 4 - поиск по индексу текста, 5-6 - общие селекторы и видимый текст,
+# 8-9 - перебор всех изображений и регулярные выражения по всему HTML
+FIELD_RULES: Dict[str, List[Strategy]] = {
+    'name': [
+        Strategy('jsonld', 1, jsonld_product('name'), fallback=False),
+        Strategy('css:h1', 2, css_text('h1')),
+        Strategy('css:title-class', 3, css_text('.product-title, .goods-title')),
+        Strategy('meta:og-title', 3, meta_content('og:title'), fallback=False),
+    ],
+    'price': [
+        Strategy('jsonld', 1, jsonld_product('offers', 'price'), fallback=False),
+        Strategy('itemprop', 2, css_attr(PRICE_ITEMPROP_SELECTOR, 'content')),
+        Strategy('css:product-price', 3, css_text(CURRENT_PRICE_SELECTOR)),
+        Strategy('css:any-price', 5, css_text(ANY_PRICE_SELECTOR), fallback=False, catch_all=True),
+        Strategy('regex:json', 6, regex_in(PRICE_JSON_RES, 'scripts')),
+        Strategy('regex:text', 6, regex_in(PRICE_TEXT_RES, 'text'), fallback=False, catch_all=True),
+    ],
+    'photo': [
+        Strategy('jsonld', 1, jsonld_product('image'), fallback=False),
+        Strategy('meta:og-image', 2, meta_content('og:image'), fallback=False),
+        Strategy('css:gallery', 3, photo_images(
+            '.product-image img, .main-image img, .gallery img, [data-testid*="image"] img')),
+        Strategy('css:all-images', 8, photo_images('img'), fallback=False, catch_all=True),
+    ],
+    'composition': [
+        Strategy('css:composition', 3, css_text('[class*="composition"], [class*="Composition"]')),
+        Strategy('index:keyword', 4, composition_elements),
+    ],
+    'portion_g': [
+        Strategy('jsonld', 1, jsonld_product('weight'), fallback=False),
+        Strategy('css:weight', 3, portion_from(css_text('[class*="weight"], [class*="Weight"]'))),
+        Strategy('regex:labeled', 5, regex_in((PORTION_LABELED_RE,), 'text')),
+        # Первое "N г" на всей странице - обычно вес чужого товара из меню
+        Strategy('regex:html', 9, regex_in((PORTION_RE,), 'html'), fallback=False, catch_all=True),
+    ],
+}
+for _field in NUTRITION_FIELDS:
+    FIELD_RULES[_field] = [
+        Strategy('jsonld', 1, grouped('jsonld-nutrition', nutrition_jsonld, _field), fallback=False),
+        Strategy('tables', 3, grouped('tables', nutrition_tables, _field)),
+        Strategy('index:elements', 4, nutrition_elements(_field)),
+        Strategy('regex:html', 9, regex_in(NUTRITION_PAGE_RES[_field], 'html'), catch_all=True),
+    ]
+for _rules in FIELD_RULES.values():
+    _rules.sort(key=lambda strategy: strategy.cost)
+
+CARD_FIELDS = tuple(FIELD_RULES)
+# Имя в статистике для повторного поиска по всей странице
+FULL_PAGE = 'full-page'
+
+
+def _not_current_price(node) -> bool:
+    return node.tag in STRUCK_TAGS or bool(NOT_CURRENT_PRICE_RE.search(node.attributes.get('class') or ''))
+
+
+def _current_price_text(element, tile) -> Optional[str]:
+    """Текст элемента цены без зачеркнутых частей; None - старая цена или цена за единицу."""
+    node = element
+    while node is not None and node != tile:
+        if _not_current_price(node):
+            return None
+        node = node.parent
+    parts = []
+    for child in element.traverse(include_text=True):
+        if child.tag != '-text':
+            continue
+        node = child.parent
+        while node is not None and node != element and not _not_current_price(node):
+            node = node.parent
+        if node is None or node == element:
+            parts.append(child.text_content)
+    return " ".join(parts)
+
+
+def listing_price(tile) -> str:
+    """Текущая цена товара в плитке каталога ('' - не найдена).
+
+    Селекторы те же и в том же порядке, что у стратегий цены карточки.
+    Зачеркнутая старая цена и цена за килограмм пропускаются; из общего
+    селектора берутся только элементы без вложенных элементов цены.
+    """
+    validate = FIELD_VALIDATORS['price']
+    for element in tile.css(PRICE_ITEMPROP_SELECTOR):
+        value = validate(element.attributes.get('content') or '')
+        if value:
+            return value
+    for selector in (CURRENT_PRICE_SELECTOR, LISTING_ANY_PRICE_SELECTOR):
+        for element in tile.css(selector):
+            if any(node != element for node in element.css(LISTING_ANY_PRICE_SELECTOR)):
+                # Обертка нескольких цен - смотрим сами цены
+                continue
+            text = _current_price_text(element, tile)
+            value = validate(text) if text else None
+            if value:
+                return value
+    return ''
+
+
+class StrategyStats:
+    """Попадания и время стратегий по полям; порядок стратегий по наблюдениям.
+
+    Порядок меняется только внутри группы одинаковой точности: точные
+    стратегии между собой, общие (catch_all) между собой, и общие всегда
+    после точных - иначе быстрый перебор вроде первого "N г" на странице
+    перехватывал бы поле у точного селектора. Внутри группы стратегии, которые
+    после min_samples попыток что-то находили, идут первыми по возрастанию
+    среднего времени на одно найденное значение (время попытки, деленное на
+    долю попаданий), остальные сохраняют порядок по цене из FIELD_RULES.
+    Время попытки включает разбор страницы (DOM, индекс), который стратегия
+    запустила первой. Когда попыток больше window, счетчики уменьшаются вдвое,
+    чтобы смена шаблона сайта быстро меняла порядок.
+    """
+
+    def __init__(self, min_samples: int = 20, window: int = 500):
+        self.min_samples = min_samples
+        self.window = window
+        # поле -> стратегия -> [попытки, попадания, секунды]
+        self.fields: Dict[str, Dict[str, List[float]]] = {}
+        # поле -> [карточки, найдено]
+        self.totals: Dict[str, List[int]] = {}
+
+    def record(self, field: str, strategy: str, hit: bool, seconds: float):
+        counters = self.fields.setdefault(field, {}).setdefault(strategy, [0, 0, 0.0])
+        counters[0] += 1
+        counters[1] += 1 if hit else 0
+        counters[2] += seconds
+        if counters[0] > self.window:
+            counters[0] /= 2
+            counters[1] /= 2
+            counters[2] /= 2
+
+    def record_field(self, field: str, found: bool):
+        totals = self.totals.setdefault(field, [0, 0])
+        totals[0] += 1
+        totals[1] += 1 if found else 0
+
+    def order(self, field: str) -> List[Strategy]:
+        """Стратегии поля: точные, затем общие; в группе срабатывающие по наблюдениям вперед."""
+        rules = FIELD_RULES[field]
+        # Без наблюдений тоже: иначе первые карточки обхода шли бы в другом порядке
+        observed = self.fields.get(field, {})
+        specific = [strategy for strategy in rules if not strategy.catch_all]
+        catch_all = [strategy for strategy in rules if strategy.catch_all]
+        return self._order_group(specific, observed) + self._order_group(catch_all, observed)
+
+    def _order_group(self, group: List[Strategy], observed: Dict[str, List[float]]) -> List[Strategy]:
+        preferred = []
+        for strategy in group:
+            counters = observed.get(strategy.name)
+            if counters and counters[0] >= self.min_samples and counters[1]:
+                # Время попытки / доля попаданий = время на одно найденное значение
+                preferred.append((counters[2] / counters[1], strategy))
+        preferred.sort(key=lambda item: item[0])
+        first = [strategy for _, strategy in preferred]
+        return first + [strategy for strategy in group if strategy not in first]
+
+    def report(self) -> Dict[str, Dict]:
+        """Для отчета обхода: порядок, доля попаданий и среднее время стратегий."""
+        report = {}
+        for field in FIELD_RULES:
+            observed = self.fields.get(field, {})
+            cards, found = self.totals.get(field, (0, 0))
+            strategies = {}
+            for name in [strategy.name for strategy in self.order(field)] + [FULL_PAGE]:
+                counters = observed.get(name)
+                if not counters or not counters[0]:
+                    continue
+                strategies[name] = {
+                    'attempts': round(counters[0]),
+                    'hit_rate': round(counters[1] / counters[0], 3),
+                    'avg_ms': round(counters[2] / counters[0] * 1000, 2),
+                }
+            if cards or strategies:
+                report[field] = {
+                    'fill_rate': round(found / cards, 3) if cards else None,
+                    'strategies': strategies,
+                }
+        return report
+
+    def orders(self) -> Dict[str, List[str]]:
+        """Текущий порядок стратегий по полям (имена) - для процессов пула."""
+        return {field: [strategy.name for strategy in self.order(field)] for field in FIELD_RULES}
+
+    def apply(self, log: 'StrategyLog'):
+        """Учесть попытки, записанные в другом процессе."""
+        for field, strategy, hit, seconds in log.records:
+            self.record(field, strategy, hit, seconds)
+        for field, found in log.found:
+            self.record_field(field, found)
+
+    def to_dict(self) -> Dict:
+        return {'fields': self.fields}
+
+    def save(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+    @classmethod
+    def load(cls, path: Optional[str], **kwargs) -> 'StrategyStats':
+        """Статистика прошлого обхода; без файла - пустая (порядок по цене)."""
+        stats = cls(**kwargs)
+        if not path or not os.path.exists(path):
+            return stats
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return stats
+        for field, strategies in data.get('fields', {}).items():
+            if field not in FIELD_RULES:
+                continue
+            known = {strategy.name for strategy in FIELD_RULES[field]} | {FULL_PAGE}
+            stats.fields[field] = {
+                name: [float(value) for value in counters[:3]]
+                for name, counters in strategies.items()
+                if name in known and len(counters) >= 3
+            }
+        return stats
+
+
+class StrategyLog:
+    """Заданный порядок стратегий и записи попыток для разбора вне основного процесса.
+
+    Интерфейс тот же, что у StrategyStats в extract_field; записи переносятся
+    в основной процесс и применяются StrategyStats.apply.
+    """
+
+    def __init__(self, orders: Optional[Dict[str, List[str]]] = None):
+        self.orders = orders or {}
+        self.records: List[Tuple[str, str, bool, float]] = []
+        self.found: List[Tuple[str, bool]] = []
+
+    def order(self, field: str) -> List[Strategy]:
+        names = self.orders.get(field)
+        if not names:
+            return FIELD_RULES[field]
+        by_name = {strategy.name: strategy for strategy in FIELD_RULES[field]}
+        ordered = [by_name[name] for name in names if name in by_name]
+        return ordered + [strategy for strategy in FIELD_RULES[field] if strategy not in ordered]
+
+    def record(self, field: str, strategy: str, hit: bool, seconds: float):
+        self.records.append((field, strategy, hit, seconds))
+
+    def record_field(self, field: str, found: bool):
+        self.found.append((field, found))
+
+
+def _run_strategy(page: CardPage, strategy: Strategy, validate: Callable[[str], Optional[str]]) -> Optional[str]:
+    try:
+        for raw in strategy.candidates(page):
+            value = validate(raw)
+            if value:
+                return value
+    except Exception:
+        # Сломанный источник (битый JSON, неожиданная разметка) - пробуем следующий
+        pass
+    return None
+
+
+def extract_field(page: CardPage, field: str, rules: Optional[Sequence[Strategy]] = None,
+                  stats=None) -> Tuple[str, Optional[str]]:
+    """Значение поля и имя сработавшей стратегии ('', None - поле не найдено).
+
+    Сначала стратегии идут по блоку товара; если ни одна не сработала,
+    стратегии с fallback=True повторяются по всей странице (имя "full:...").
+    """
+    validate = FIELD_VALIDATORS[field]
+    if rules is None:
+        rules = stats.order(field) if stats is not None else FIELD_RULES[field]
+    for strategy in rules:
+        started = time.perf_counter()
+        value = _run_strategy(page, strategy, validate)
+        if stats is not None:
+            stats.record(field, strategy.name, bool(value), time.perf_counter() - started)
+        if value:
+            if stats is not None:
+                stats.record_field(field, True)
+            return value, strategy.name
+    if page.scoped:
+        started = time.perf_counter()
+        full_page = page.full()
+        found = None
+        for strategy in rules:
+            if strategy.fallback:
+                value = _run_strategy(full_page, strategy, validate)
+                if value:
+                    found = value, f"full:{strategy.name}"
+                    break
+        if stats is not None:
+            stats.record(field, FULL_PAGE, bool(found), time.perf_counter() - started)
+            stats.record_field(field, bool(found))
+        return found or ('', None)
+    if stats is not None:
+        stats.record_field(field, False)
+    return '', None
+
+
+def extract_fields(page: CardPage, fields: Sequence[str] = CARD_FIELDS,
+                   stats=None) -> Tuple[Dict[str, str], Dict[str, Optional[str]]]:
+    """Все поля карточки: (значения, стратегии, давшие каждое поле)."""
+    values: Dict[str, str] = {}
+    sources: Dict[str, Optional[str]] = {}
+    for field in fields:
+        values[field], sources[field] = extract_field(page, field, stats=stats)
+    return values, sources
+
+
+def extract_card(content: bytes, url: str = '', encoding: Optional[str] = None,
+                 orders: Optional[Dict[str, List[str]]] = None) -> Tuple[Dict[str, str], Dict[str, Optional[str]], StrategyLog]:
+    """Разбор карточки по байтам ответа - функция верхнего уровня для пула процессов."""
+    html = content.decode(encoding or 'utf-8', errors='replace')
+    log = StrategyLog(orders)
+    values, sources = extract_fields(CardPage(html, url), stats=log)
+    return values, sources, log
+
+
+class ExtractionPool:
+    """Пул процессов для разбора карточек; workers=0 - разбор в текущем потоке.
+
+    Процессы создаются при первой карточке. Если пул сломался (процесс убит),
+    разбор продолжается в текущем потоке.
+    """
+
+    def __init__(self, workers: int, stats: Optional[StrategyStats] = None):
+        self.workers = max(workers, 0)
+        self.stats = stats
+        self.executor: Optional[ProcessPoolExecutor] = None
+        # seconds - время от передачи страницы до результата (с очередью пула)
+        self.pool_stats = {'pages': 0, 'inline': 0, 'seconds': 0.0}
+        # Порядок стратегий пересчитывается раз в orders_every карточек
+        self.orders_every = 20
+        self._orders: Optional[Dict[str, List[str]]] = None
+
+    def _current_orders(self) -> Optional[Dict[str, List[str]]]:
+        if self.stats is None:
+            return None
+        if self._orders is None or self.pool_stats['pages'] % self.orders_every == 0:
+            self._orders = self.stats.orders()
+        return self._orders
+
+    async def extract(self, content: bytes, url: str = '', encoding: Optional[str] = None) -> Tuple[Dict[str, str], Dict[str, Optional[str]]]:
+        """Поля карточки (значения, стратегии); статистика попыток учитывается в stats."""
+        orders = self._current_orders()
+        self.pool_stats['pages'] += 1
+        started = time.perf_counter()
+        if self.workers:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            loop = asyncio.get_running_loop()
+            try:
+                values, sources, log = await loop.run_in_executor(
+                    self.executor, extract_card, content, url, encoding, orders)
+                self.pool_stats['seconds'] += time.perf_counter() - started
+                self._apply(log)
+                return values, sources
+            except BrokenProcessPool:
+                print("⚠️ Пул разбора карточек остановлен, разбор продолжается в основном процессе")
+                self.close()
+                self.workers = 0
+                started = time.perf_counter()
+        values, sources, log = extract_card(content, url, encoding, orders)
+        self.pool_stats['inline'] += 1
+        self.pool_stats['seconds'] += time.perf_counter() - started
+        self._apply(log)
+        return values, sources
+
+    def _apply(self, log: StrategyLog):
+        if self.stats is not None:
+            self.stats.apply(log)
+
+    def metrics(self) -> Dict:
+        return {
+            'workers': self.workers,
+            'pages': self.pool_stats['pages'],
+            'inline': self.pool_stats['inline'],
+            'avg_ms': round(self.pool_stats['seconds'] / self.pool_stats['pages'] * 1000, 1) if self.pool_stats['pages'] else 0.0,
+        }
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
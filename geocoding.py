@@ -0,0 +1,175 @@
+"""
+geocoding.py - Асинхронное геокодирование адресов с кэшем.
+
+Адрес нормализуется и ищется по порядку: в памяти, в постоянном кэше
+(JSON-файл), в офлайн-справочнике адресов и только потом в Nominatim.
+Запрос к Nominatim блокирующий (geopy), поэтому выполняется в пуле потоков и
+не останавливает цикл событий; одновременные запросы одного адреса ждут один
+общий запрос. Nominatim допускает не больше одного запроса в секунду.
+"""
+
+import asyncio
+import json
+import os
+import re
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from geopy.geocoders import Nominatim
+    from geopy.exc import GeocoderServiceError, GeocoderTimedOut
+except ImportError:
+    Nominatim = None
+    GeocoderServiceError = GeocoderTimedOut = Exception
+
+# Постоянный кэш адрес -> координаты (GEOCODE_CACHE_PATH переопределяет путь)
+GEOCODE_CACHE_PATH = "data/geocode_cache.json"
+
+# Встроенный справочник популярных адресов; дополняется файлом GAZETTEER_PATH
+DEFAULT_GAZETTEER = {
+    "Москва, Красная площадь, 1": (55.7539, 37.6208),
+    "Москва, Тверская улица, 1": (55.7558, 37.6176),
+    "Санкт-Петербург, Невский проспект, 1": (59.9311, 30.3609),
+}
+
+# Сокращения, которые пишут в адресах по-разному
+ADDRESS_ABBREVIATIONS = (
+    (re.compile(r'\bг\.\s*'), ''),
+    (re.compile(r'\bул\.?(?=[\s,]|$)'), 'улица'),
+    (re.compile(r'\bпр-т\b|\bпросп\.?(?=[\s,]|$)'), 'проспект'),
+    (re.compile(r'\bпл\.?(?=[\s,]|$)'), 'площадь'),
+    (re.compile(r'\bд\.\s*'), ''),
+    (re.compile(r'\bспб\b'), 'санкт-петербург'),
+)
+
+Coordinates = Tuple[float, float]
+
+
+@lru_cache(maxsize=4096)
+def normalize_address(address: str) -> str:
+    """Ключ адреса: нижний регистр, раскрытые сокращения, единые пробелы и запятые."""
+    text = address.lower().replace('ё', 'е')
+    for pattern, replacement in ADDRESS_ABBREVIATIONS:
+        text = pattern.sub(replacement, text)
+    parts = [" ".join(part.split()) for part in text.split(',')]
+    return ", ".join(part for part in parts if part)
+
+
+class OfflineGazetteer:
+    """Офлайн-справочник адресов: встроенные адреса и JSON-файл {"адрес": [lat, lon]}."""
+
+    def __init__(self, entries: Optional[Dict[str, Coordinates]] = None, path: Optional[str] = None):
+        self.entries: Dict[str, Coordinates] = {}
+        for address, coords in (entries if entries is not None else DEFAULT_GAZETTEER).items():
+            self.add(address, coords)
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for address, coords in json.load(f).items():
+                    self.add(address, coords)
+
+    def add(self, address: str, coords: Coordinates):
+        self.entries[normalize_address(address)] = (float(coords[0]), float(coords[1]))
+
+    def lookup(self, key: str) -> Optional[Coordinates]:
+        return self.entries.get(key)
+
+
+class GeocodingService:
+    """Геокодирование без блокировки цикла событий, с постоянным кэшем."""
+
+    def __init__(self, cache_path: Optional[str] = None, backends: Optional[List] = None,
+                 online: bool = True, min_interval: float = 1.0, timeout: float = 10):
+        self.cache_path = cache_path
+        self.cache: Dict[str, Coordinates] = {}
+        # Офлайн-источники: объекты с lookup(нормализованный адрес) -> координаты
+        self.backends = backends if backends is not None else [OfflineGazetteer()]
+        self.nominatim = Nominatim(user_agent="vkusvill-scraper/1.0") if online and Nominatim else None
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._online_lock: Optional[asyncio.Lock] = None
+        self._last_online = 0.0
+        self.stats = {'cache': 0, 'offline': 0, 'online': 0, 'coalesced': 0, 'failed': 0}
+        self._load_cache()
+
+    @classmethod
+    def from_env(cls) -> 'GeocodingService':
+        base = Path(__file__).parent
+        gazetteer = OfflineGazetteer(path=os.getenv("GAZETTEER_PATH"))
+        return cls(
+            cache_path=os.getenv("GEOCODE_CACHE_PATH", str(base / GEOCODE_CACHE_PATH)),
+            backends=[gazetteer],
+            online=os.getenv("GEOCODE_ONLINE", "1") == "1",
+        )
+
+    async def geocode(self, address: str) -> Optional[Coordinates]:
+        """Координаты адреса или None, если адрес не найден."""
+        key = normalize_address(address)
+        coords = self.cache.get(key)
+        if coords is not None:
+            self.stats['cache'] += 1
+            return coords
+        for backend in self.backends:
+            coords = backend.lookup(key)
+            if coords is not None:
+                self.stats['offline'] += 1
+                self.cache[key] = coords
+                return coords
+        task = self._inflight.get(key)
+        if task is not None:
+            # Тот же адрес уже запрашивается - ждем общий результат
+            self.stats['coalesced'] += 1
+            return await asyncio.shield(task)
+        task = asyncio.ensure_future(self._geocode_online(address, key))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _geocode_online(self, address: str, key: str) -> Optional[Coordinates]:
+        if self.nominatim is None:
+            self.stats['failed'] += 1
+            return None
+        if self._online_lock is None:
+            self._online_lock = asyncio.Lock()
+        async with self._online_lock:
+            # Правила Nominatim: не чаще одного запроса в секунду
+            delay = self._last_online + self.min_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                location = await asyncio.to_thread(self.nominatim.geocode, address, timeout=self.timeout)
+            except (GeocoderTimedOut, GeocoderServiceError):
+                location = None
+            finally:
+                self._last_online = time.monotonic()
+        if not location:
+            self.stats['failed'] += 1
+            return None
+        self.stats['online'] += 1
+        coords = (location.latitude, location.longitude)
+        self.cache[key] = coords
+        self._save_cache()
+        return coords
+
+    def _load_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, encoding='utf-8') as f:
+                self.cache = {key: tuple(coords) for key, coords in json.load(f).items()}
+        except (OSError, ValueError):
+            self.cache = {}
+
+    def _save_cache(self):
+        if not self.cache_path:
+            return
+        try:
+            Path(self.cache_path).parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = f"{self.cache_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.cache, f, ensure_ascii=False)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f"⚠️ Не удалось сохранить кэш геокодирования: {e}")
@@ -8,12 +8,13 @@ import asyncio
 import csv
 import json
 import logging
+import os
 import re
 import sys
 import time
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional
 from urllib.parse import urljoin, quote
 
 try:
@@ -21,73 +22,262 @@ try:
 except ImportError:
     HTMLParser = None
 
-# Встроенный AntiBotClient
-import httpx
+from antibot import AntiBotClient, ChallengeDetected, SiteBlocked
+from extraction import ExtractionPool, StrategyStats, listing_price
+from refresh import FRESHNESS_PATH, FreshnessStore, RefreshScheduler
 
 
-class AntiBotClient:
-    """HTTP клиент с поддержкой cookies для обхода защиты."""
+# Номер страницы в ссылках пагинации каталога (?page=N или битриксовый ?PAGEN_1=N)
+PAGE_PARAM_RE = re.compile(r'[?&](?:page|PAGEN_\d+)=(\d+)')
 
-    def __init__(self, concurrency: int = 10, timeout: int = 30):
-        self.semaphore = asyncio.Semaphore(concurrency)
-        self.timeout = timeout
-        self.cookies = {}
-        self.client = None  # Храним клиент
+# Журнал тяжелого обхода для --resume (CRAWL_JOURNAL переопределяет путь)
+CRAWL_JOURNAL_PATH = "data/heavy_journal.jsonl"
+# Журнал старше суток не продолжается: цены и наличие в нем уже устарели
+CRAWL_JOURNAL_MAX_AGE = 24 * 3600
 
-    async def _ensure_client(self):
-        """Создание или переиспользование клиента."""
-        if self.client is None:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'ru-RU,ru;q=0.8,en-US;q=0.5,en;q=0.3',
-                'Accept-Encoding': 'gzip, deflate',
-                'Connection': 'keep-alive',
-                'Upgrade-Insecure-Requests': '1',
-            }
-            self.client = httpx.AsyncClient(
-                timeout=self.timeout,
-                headers=headers,
-                cookies=self.cookies,
-                follow_redirects=True,
-                limits=httpx.Limits(max_keepalive_connections=5, max_connections=10)
-            )
-        return self.client
+# Без этих полей страница карточки считается неполной и загружается еще раз
+REQUIRED_CARD_FIELDS = ('name',)
 
-    async def request(self, method: str, url: str, **kwargs):
-        """Выполнить HTTP запрос с сохранением cookies."""
-        async with self.semaphore:
-            client = await self._ensure_client()
-            try:
-                response = await client.request(method, url, **kwargs)
-                # Обновляем cookies
-                self.cookies.update(response.cookies)
-                return response
-            except httpx.TimeoutException:
-                # При таймауте пересоздаем клиент
-                await self.close()
-                self.client = None
-                raise
+# Статистика стратегий извлечения прошлого обхода (EXTRACTION_STATS переопределяет путь)
+EXTRACTION_STATS_PATH = "data/extraction_stats.json"
+
+# Ключевые слова готовой еды в названии
+READY_FOOD_KEYWORDS = (
+    'суп', 'салат', 'борщ', 'омлет', 'блины', 'каша', 'пицца',
+    'паста', 'котлета', 'запеканка', 'сырники', 'плов', 'лазанья',
+    'крем-суп', 'харчо', 'цезарь', 'винегрет', 'мимоза',
+    'рагу', 'гуляш', 'жаркое', 'биточки', 'тефтели', 'фрикадельки',
+    'голубцы', 'долма', 'манты', 'пельмени', 'вареники', 'хинкали',
+    'шаурма', 'бургер', 'сэндвич', 'рулет', 'пирог', 'киш', 'тарт',
+    'ризотто', 'паэлья', 'карри', 'рамен', 'фо', 'том-ям', 'мисо',
+    'окрошка', 'солянка', 'щи', 'уха', 'рассольник', 'кулеш',
+    'завтрак', 'обед', 'ужин'
+)
+# НЕ готовая еда, даже если в названии есть ключевое слово
+NOT_READY_FOOD_KEYWORDS = (
+    'крем для', 'гель для', 'средство для', 'прокладки', 'подгузники',
+    'шампунь', 'бальзам', 'мыло', 'зубная', 'паста зубная',
+    'чипсы', 'сухарики', 'орехи', 'семечки', 'конфеты', 'шоколад',
+    'молоко', 'кефир', 'йогурт', 'творог', 'сыр', 'масло', 'яйца',
+    'мясо', 'курица', 'говядина', 'свинина', 'рыба', 'филе',
+    'овощи', 'фрукты', 'картофель', 'капуста', 'морковь',
+    'хлеб', 'батон', 'булка', 'багет', 'лаваш'
+)
+# Те же блюда в транслитерации адреса карточки (/goods/sup-kurinyy-....html)
+READY_FOOD_SLUG_KEYWORDS = (
+    'sup', 'salat', 'borshch', 'omlet', 'bliny', 'kasha', 'pitstsa', 'pasta',
+    'kotlet', 'zapekanka', 'syrniki', 'plov', 'lazanya', 'kharcho', 'tsezar',
+    'vinegret', 'ragu', 'gulyash', 'tefteli', 'golubtsy', 'manty', 'pelmeni',
+    'vareniki', 'khinkali', 'shaurma', 'burger', 'sendvich', 'rulet', 'pirog',
+    'rizotto', 'karri', 'ramen', 'okroshka', 'solyanka', 'rassolnik', 'zavtrak',
+)
+NUTRITION_FIELDS = ('kcal_100g', 'protein_100g', 'fat_100g', 'carb_100g')
+
+# Ссылки с уверенностью ниже порога загружаются после остальных и только
+# если лимит товаров еще не набран
+LINK_CONFIDENCE_THRESHOLD = 0.5
+
+
+def load_snapshot(path: Optional[str] = None) -> Dict[str, Dict]:
+    """Записи прошлого обхода по id из CSV (по умолчанию - самый свежий в data/)."""
+    if path is None:
+        data_dir = Path("data")
+        files = list(data_dir.glob("moscow_improved_*.csv")) + list(data_dir.glob("moscow_heavy_*.csv"))
+        if not files:
+            return {}
+        path = max(files, key=lambda p: p.stat().st_mtime)
+    snapshot = {}
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            if row.get('id'):
+                snapshot[row['id']] = row
+    print(f"📚 Снимок прошлого обхода: {path} ({len(snapshot)} товаров)")
+    return snapshot
+
+
+class CrawlJournal:
+    """Журнал тяжелого обхода: JSONL, дописывается по одной записи.
+    
+    Записи: начало обхода (start), найденная ссылка (url), готовая карточка
+    (card), полностью обойденная категория (category), завершение обхода (end). Каждая запись
+    сразу сбрасывается на диск, поэтому после падения процесса теряется не
+    больше карточек, чем было в работе. При возобновлении готовые карточки
+    берутся из журнала, ненагруженные ссылки снова ставятся в очередь,
+    обойденные категории не запрашиваются.
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+        self.resumed = False
+        self._reset()
+    
+    def _reset(self):
+        # url -> (название, цена, категория) в порядке нахождения
+        self.urls: Dict[str, tuple] = {}
+        # url -> запись карточки
+        self.cards: Dict[str, Dict] = {}
+        self.categories = set()
+        self.finished = False
+        # Время начала обхода из записи start (None - журнал без нее)
+        self.started: Optional[float] = None
+        self._valid_size = 0
+    
+    def load(self):
+        """Прочитать журнал; испорченные строки (падение при записи) пропускаются."""
+        self._reset()
+        # Размер файла до конца последней целой записи - хвост за ним отрезается при продолжении
+        self._valid_size = 0
+        if not os.path.exists(self.path):
+            return
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                offset += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(entry, dict):
+                    continue
+                self._valid_size = offset
+                kind = entry.get('t')
+                if kind == 'start':
+                    self.started = entry['ts']
+                elif kind == 'url':
+                    self.urls.setdefault(entry['url'], (entry.get('title', ''), entry.get('price', ''), entry.get('category', '')))
+                elif kind == 'card':
+                    self.cards[entry['url']] = entry['record']
+                elif kind == 'category':
+                    self.categories.add(entry['category'])
+                elif kind == 'end':
+                    self.finished = True
+    
+    def open(self, resume: bool = False, max_age: Optional[float] = CRAWL_JOURNAL_MAX_AGE):
+        """Начать запись: resume - продолжить незавершенный обход, иначе начать заново.
+        
+        Обход, начатый больше max_age секунд назад (или без времени начала),
+        не продолжается - карточки в нем устарели. None - без ограничения.
+        """
+        if resume:
+            self.load()
+        self.resumed = resume and not self.finished and bool(self.urls or self.cards)
+        if self.resumed and max_age is not None:
+            age = time.time() - self.started if self.started is not None else None
+            if age is None or age > max_age:
+                age_text = f"{age / 3600:.1f} ч" if age is not None else "неизвестен"
+                print(f"📓 Журнал {self.path} устарел (возраст {age_text}) - начинаем обход заново")
+                self.resumed = False
+        if not self.resumed:
+            self._reset()
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        if self.resumed:
+            self._cut_torn_tail()
+        self.file = open(self.path, 'a' if self.resumed else 'w', encoding='utf-8')
+        if not self.resumed:
+            self.started = time.time()
+            self._write({'t': 'start', 'ts': self.started})
+        if self.resumed:
+            print(f"📓 Продолжаем обход по журналу {self.path}: готово карточек {len(self.cards)}, "
+                  f"в очереди {len(self.frontier())}, категорий обойдено {len(self.categories)}")
+    
+    def _cut_torn_tail(self):
+        """Отрезать оборванную последнюю запись, чтобы новые не дописывались в ту же строку."""
+        with open(self.path, 'r+b') as f:
+            f.truncate(self._valid_size)
+            if self._valid_size:
+                f.seek(self._valid_size - 1)
+                if f.read(1) != b'\n':
+                    f.seek(0, os.SEEK_END)
+                    f.write(b'\n')
+    
+    def frontier(self) -> List[tuple]:
+        """Найденные, но не загруженные ссылки: (url, название, цена, категория)."""
+        return [(url, *meta) for url, meta in self.urls.items() if url not in self.cards]
+    
+    def _write(self, entry: Dict):
+        if self.file is None:
+            return
+        self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.file.flush()
+    
+    def record_url(self, url: str, title: str, price: str, category: str):
+        if url not in self.urls:
+            self.urls[url] = (title, price, category)
+            self._write({'t': 'url', 'url': url, 'title': title, 'price': price, 'category': category})
+    
+    def record_card(self, url: str, record: Dict):
+        self.cards[url] = record
+        self._write({'t': 'card', 'url': url, 'record': record})
+    
+    def record_category(self, category: str):
+        self.categories.add(category)
+        self._write({'t': 'category', 'category': category})
+    
+    def finish(self):
+        """Результаты сохранены - следующий запуск с --resume начнет заново."""
+        self._write({'t': 'end', 'ts': int(time.time())})
+        self.close()
+    
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
 
-    async def close(self):
-        """Закрытие клиента."""
-        if self.client:
-            await self.client.aclose()
-            self.client = None
 
 class VkusvillHeavyParser:
     """Тяжелый парсер с глубоким анализом каждой карточки."""
     
-    def __init__(self, antibot_client):
+    def __init__(self, antibot_client, card_workers: Optional[int] = None,
+                 extraction_stats: Optional[StrategyStats] = None, extract_workers: Optional[int] = None):
         self.antibot_client = antibot_client
         self.BASE_URL = "https://vkusvill.ru"
+        # Загрузчиков карточек столько, сколько может разрешить контроллер клиента:
+        # фактическую параллельность определяет его адаптивный лимит
+        self.card_workers = card_workers or antibot_client.concurrency.max_limit
+        self.discovery_stats = {'requests': 0, 'legacy_requests': 0}
+        # Инкрементальный обход: что загружено заново, что перенесено из снимка
+        self.incremental_stats = {'new': 0, 'changed': 0, 'incomplete': 0, 'carried': 0}
+        # Классификация ссылок до загрузки карточки
+        self.link_stats = {'confident': 0, 'deferred': 0, 'deferred_fetched': 0, 'rejected_after_fetch': 0}
+        # Загрузка карточки: первая попытка + повтор, если на странице нет обязательных полей
+        self.max_card_fetches = 2
+        # fetches - запросы карточек, refetches - из них повторные из-за неполной страницы
+        self.fetch_stats = {'cards': 0, 'fetches': 0, 'refetches': 0, 'reparses': 0}
+        # Поля, которых нет на загруженной карточке
+        self.absent_fields: Dict[str, int] = {}
+        # Порядок стратегий по полям начинается с выигравших в прошлом обходе
+        self.extraction_stats_path = os.getenv("EXTRACTION_STATS", EXTRACTION_STATS_PATH)
+        self.extraction_stats = extraction_stats or StrategyStats.load(self.extraction_stats_path)
+        # Разбор карточек в отдельных процессах: загрузчики не ждут парсинга
+        # (EXTRACT_WORKERS=0 - разбор в цикле событий, как раньше)
+        if extract_workers is None:
+            extract_workers = int(os.getenv("EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+        self.extractor = ExtractionPool(extract_workers, self.extraction_stats)
+        
+    async def scrape_heavy(self, limit: int = 1500, previous: Optional[Dict[str, Dict]] = None,
+                           journal: Optional[CrawlJournal] = None,
+                           scheduler: Optional[RefreshScheduler] = None) -> List[Dict]:
+        """Тяжелый парсинг с заходом в каждую карточку.
+        
+        previous - записи прошлого обхода по id (load_snapshot). Тогда карточки
+        загружаются только для новых товаров, товаров с изменившимися в каталоге
+        названием или ценой и записей без полного БЖУ; остальные записи
+        переносятся из снимка без запроса.
         
-    async def scrape_heavy(self, limit: int = 1500) -> List[Dict]:
-        """Тяжелый парсинг с заходом в каждую карточку."""
-        print(f"🏗️ Начинаем тяжелый парсинг на {limit} товаров...")
+        journal - журнал обхода (CrawlJournal); если он открыт с возобновлением,
+        готовые карточки и обойденные категории берутся из него.
         
-        # Установка локации для Москвы
-        await self._set_location()
+        scheduler - планировщик обновления (RefreshScheduler) вместе с previous:
+        новые товары загружаются, пока хватает бюджета запросов, известные
+        загружаются по приоритету после обхода каталога, если подошел срок
+        обновления или изменилась плитка; остальные переносятся из снимка.
+        """
+        mode = "инкрементальный" if previous else "тяжелый"
+        print(f"🏗️ Начинаем {mode} парсинг на {limit} товаров...")
+        
+        # Установка локации для Москвы, параллельно прогреваем пул соединений
+        await asyncio.gather(self._set_location(), self.antibot_client.warmup(self.BASE_URL))
         
         # Сбор всех товаров готовой еды
         print("📋 Собираем ВСЕ товары готовой еды...")
@@ -133,141 +323,398 @@ class VkusvillHeavyParser:
             "/goods/gotovaya-eda/khalyal/"
         ]
         
-        for category in ready_food_categories:
+        # Конвейер: категории -> очередь ссылок -> загрузчики карточек -> фильтрация.
+        # Карточки начинают загружаться сразу, как только найдена первая ссылка.
+        # Ссылки классифицируются по названию в каталоге, категории и адресу:
+        # уверенные идут в загрузку по убыванию уверенности, сомнительные
+        # откладываются до конца обхода каталога.
+        url_queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        result_queue: asyncio.Queue = asyncio.Queue()
+        deferred = []
+        sequence = 0
+        # Ссылки, загрузка которых тратит бюджет: url -> запись для переноса,
+        # если бюджета не хватит (None - новый товар, ждет следующего обхода)
+        budgeted: Dict[str, Optional[Dict]] = {}
+        
+        def schedule_url(url: str, title: str, price: str, category: str):
+            """Поставить новую ссылку в очередь загрузки карточек."""
+            nonlocal sequence
+            if url in product_urls:
+                return
+            product_urls.add(url)
+            if journal is not None:
+                journal.record_url(url, title, price, category)
+            if previous is not None:
+                if scheduler is None:
+                    record = self._carry_forward(previous, url, title, price)
+                else:
+                    # Судьбу известной карточки решает планировщик, его счетчики и идут в отчет
+                    product_id = self._extract_id(url)
+                    known = previous.get(product_id)
+                    record = None
+                    if known is None:
+                        # Бюджет спишется, когда начнется загрузка карточки
+                        budgeted[url] = None
+                    else:
+                        listing_changed = self._listing_changed(known, title, price)
+                        priority = scheduler.priority(product_id, known, listing_changed)
+                        if priority is not None:
+                            # Решение о загрузке - после обхода каталога, по приоритету
+                            scheduler.offer(priority, (url, title, category, known))
+                            return
+                        record = dict(known)
+                if record is not None:
+                    # Неизменившийся товар - сразу в результат, без загрузки карточки
+                    carry(url, record)
+                    return
+            sequence += 1
+            confidence = self._link_confidence(url, title, category)
+            if confidence >= LINK_CONFIDENCE_THRESHOLD:
+                self.link_stats['confident'] += 1
+                url_queue.put_nowait((-confidence, sequence, url))
+            else:
+                self.link_stats['deferred'] += 1
+                deferred.append((-confidence, sequence, url))
+        
+        def carry(url: str, record: Dict):
+            if journal is not None:
+                journal.record_card(url, record)
+            result_queue.put_nowait(record)
+        
+        async def discover_category(category: str):
             try:
-                urls = await self._get_category_products(category, 500)
-                product_urls.update(urls)
+                urls = await self._get_category_products(
+                    category, 500, on_url=lambda url, title, price: schedule_url(url, title, price, category))
                 print(f"   {category}: +{len(urls)} товаров")
+                if journal is not None:
+                    journal.record_category(category)
+            except SiteBlocked:
+                raise
             except Exception as e:
                 print(f"   ❌ {category}: {e}")
         
+        async def discovery():
+            nonlocal sequence
+            # Все категории обходятся параллельно, запросы ограничивают лимиты клиента
+            await asyncio.gather(*(discover_category(category) for category in categories))
+            saved = self.discovery_stats['legacy_requests'] - self.discovery_stats['requests']
+            print(f"📦 Всего найдено {len(product_urls)} ссылок на товары")
+            print(f"   Запросов каталога: {self.discovery_stats['requests']} (сэкономлено ~{max(saved, 0)})")
+            print(f"   Похоже на готовую еду: {self.link_stats['confident']}, отложено сомнительных: {self.link_stats['deferred']}")
+            if previous is not None and scheduler is None:
+                print(f"   Снимок: {self.incremental_stats}")
+            if scheduler is not None and previous is not None:
+                # Оставшийся бюджет - самым срочным известным товарам, после новых
+                for url, title, category, known in scheduler.select():
+                    sequence += 1
+                    budgeted[url] = dict(known)
+                    url_queue.put_nowait((0, sequence, url))
+                print(f"   Обновление: {scheduler.stats}")
+            # Сомнительные ссылки - после всех уверенных; сигнал завершения - последним
+            for item in deferred:
+                url_queue.put_nowait(item)
+            for _ in range(self.card_workers):
+                url_queue.put_nowait((1, 0, None))
         
-        print(f"📦 Всего найдено {len(product_urls)} ссылок на товары")
+        async def card_worker():
+            while True:
+                priority, _, url = await url_queue.get()
+                if url is None:
+                    return
+                refreshing = False
+                if url in budgeted:
+                    fallback = budgeted.pop(url)
+                    refreshing = fallback is not None
+                    admitted = scheduler.admit_due() if refreshing else scheduler.admit_new()
+                    if not admitted:
+                        if refreshing:
+                            carry(url, fallback)
+                        continue
+                if not refreshing and -priority < LINK_CONFIDENCE_THRESHOLD:
+                    self.link_stats['deferred_fetched'] += 1
+                result = await self._extract_full_product(url)
+                # Неудачная загрузка не записывается - при возобновлении карточка повторится
+                if result and journal is not None:
+                    journal.record_card(url, result)
+                if result and scheduler is not None:
+                    product_id = self._extract_id(url)
+                    scheduler.store.observe(product_id, result, (previous or {}).get(product_id))
+                await result_queue.put(result)
+        
+        async def supervised(stage, finished: bool):
+            """Ошибка этапа уходит потребителю, загрузчик всегда сообщает о завершении."""
+            try:
+                await stage()
+            except Exception as e:
+                result_queue.put_nowait(e)
+            finally:
+                if finished:
+                    result_queue.put_nowait(None)
         
-        # Берем максимальное количество товаров
-        product_list = list(product_urls)[:limit * 5]  # Увеличиваем запас
         products = []
+        processed = 0
+        finished_workers = 0
+        categories = ready_food_categories
         
-        # Парсим товары батчами
-        batch_size = 8
-        semaphore = asyncio.Semaphore(6)
+        if journal is not None and journal.resumed:
+            # Готовые карточки - из журнала, незагруженные ссылки - снова в очередь
+            for url, record in journal.cards.items():
+                product_urls.add(url)
+                if self._is_ready_food(record) and len(products) < limit:
+                    products.append(record)
+            for url, title, price, category in journal.frontier():
+                schedule_url(url, title, price, category)
+            categories = [category for category in ready_food_categories if category not in journal.categories]
+            if len(products) >= limit:
+                print(f"🎯 Лимит {limit} товаров набран по журналу")
+                return products
         
-        for i in range(0, len(product_list), batch_size):
-            batch = product_list[i:i + batch_size]
-            print(f"🔍 Товары {i+1}-{min(i+batch_size, len(product_list))}/{len(product_list)}")
-            
-            async def process_product(url):
-                async with semaphore:
-                    return await self._extract_full_product(url)
-            
-            tasks = [process_product(url) for url in batch]
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            
-            for result in results:
-                if isinstance(result, dict) and result:
-                    if self._is_ready_food(result):
-                        products.append(result)
-                        
-                        # Проверяем лимит
-                        if len(products) >= limit:
-                            print(f"🎯 Достигнут лимит {limit} товаров")
-                            return products
-            
-            await asyncio.sleep(1)
+        tasks = [asyncio.create_task(supervised(discovery, False))]
+        tasks += [asyncio.create_task(supervised(card_worker, True)) for _ in range(self.card_workers)]
+        
+        try:
+            while finished_workers < self.card_workers:
+                result = await result_queue.get()
+                if result is None:
+                    finished_workers += 1
+                    continue
+                if isinstance(result, Exception):
+                    # Сайт блокирует или этап конвейера упал - дальнейшие запросы бессмысленны
+                    raise result
+                
+                processed += 1
+                if processed % 10 == 0:
+                    print(f"🔍 Обработано карточек: {processed}/{len(product_urls)}, готовой еды: {len(products)}")
+                
+                if isinstance(result, dict) and result and not self._is_ready_food(result):
+                    self.link_stats['rejected_after_fetch'] += 1
+                elif isinstance(result, dict) and result:
+                    products.append(result)
+                    
+                    # Проверяем лимит
+                    if len(products) >= limit:
+                        print(f"🎯 Достигнут лимит {limit} товаров")
+                        return products
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.extractor.close()
+            # Следующий обход начнет с выигравших стратегий
+            self._save_extraction_stats()
+            if scheduler is not None:
+                self._save_freshness(scheduler.store)
         
         print(f"🏁 Тяжелый парсинг завершен: {len(products)} товаров с полными данными")
+        client_metrics = self.antibot_client.metrics()
+        print(f"📈 Параллельность клиента: {client_metrics['concurrency']}")
+        print(f"🔌 Пул соединений: {client_metrics['pool']}")
+        print(f"🧮 Разбор карточек: {self.extractor.metrics()}")
+        print(f"♻️ Загрузки карточек: {self.fetch_stats}")
+        print(f"🏷️ Классификация ссылок: {self.link_stats}")
+        if previous is not None and scheduler is None:
+            print(f"🧷 Инкрементальный обход: {self.incremental_stats}")
+        if scheduler is not None:
+            print(f"🗓️ Обновление по расписанию: {scheduler.stats}")
+        if self.absent_fields:
+            print(f"🕳️ Нет на странице: {self.absent_fields}")
+        if client_metrics['cache']:
+            print(f"💾 Кэш HTTP: {client_metrics['cache']}")
+        if client_metrics['challenge']['challenges']:
+            print(f"🚧 Страницы проверки: {client_metrics['challenge']}")
         return products
     
+    def _save_freshness(self, store: FreshnessStore):
+        """Сохранить метаданные свежести карточек для следующего обхода."""
+        try:
+            store.save()
+        except OSError as e:
+            print(f"⚠️ Не удалось сохранить метаданные свежести: {e}")
+    
+    def _save_extraction_stats(self):
+        """Сохранить статистику стратегий извлечения для следующего обхода."""
+        if not self.extraction_stats_path:
+            return
+        try:
+            self.extraction_stats.save(self.extraction_stats_path)
+        except OSError as e:
+            print(f"⚠️ Не удалось сохранить статистику извлечения: {e}")
+    
     async def _set_location(self):
         """Установка локации для Москвы."""
         try:
+            session = self.antibot_client.session
+            if session.location == "55.7558,37.6176":
+                print("📍 Локация уже установлена: Москва (центр)")
+                return
             location_url = f"{self.BASE_URL}/api/location?city=Москва&lat=55.7558&lon=37.6176"
             await self.antibot_client.request(method="GET", url=location_url)
+            self.antibot_client.location_key = "55.7558,37.6176"
+            session.location = "55.7558,37.6176"
             print("📍 Локация установлена: Москва (центр)")
+        except SiteBlocked:
+            raise
         except Exception as e:
             print(f"⚠️ Ошибка установки локации: {e}")
     
-    async def _get_category_products(self, category: str, max_products: int) -> List[str]:
-        """Получить ВСЕ товары из категории через пагинацию."""
+    async def _get_category_products(self, category: str, max_products: int,
+                                     on_url: Optional[Callable[[str, str, str], None]] = None) -> List[str]:
+        """Получить ВСЕ товары из категории через пагинацию.
+        
+        Число страниц берется из пагинации первой страницы, остальные страницы
+        загружаются параллельно. Если пагинации нет, страницы перебираются
+        по одной до первой пустой. on_url(url, название, цена) вызывается для
+        каждой новой ссылки сразу после ее нахождения.
+        
+        Страница проверки вместо страницы каталога - не конец категории:
+        найденные ссылки остаются, но после обхода поднимается
+        ChallengeDetected, и категория не считается пройденной.
+        """
         product_urls = set()
+        challenge: Optional[ChallengeDetected] = None
+        
+        parser = await self._fetch_catalog_page(category, 1)
+        if parser is None:
+            return []
+        new_count = self._collect_page_links(parser, product_urls, max_products, on_url)
+        pages_with_products = 1 if new_count else 0
+        page_count = min(self._detect_page_count(parser), 99)
         
-        # Обычные страницы пагинации (page=1,2,3...)
-        for page_num in range(1, 100):  # До 100 страниц
+        if new_count and page_count > 1:
+            # Известно число страниц - грузим оставшиеся параллельно
+            tasks = [asyncio.ensure_future(self._fetch_catalog_page(category, page_num))
+                     for page_num in range(2, page_count + 1)]
             try:
-                url = f"{self.BASE_URL}{category}?page={page_num}"
-                response = await self.antibot_client.request(method="GET", url=url)
-                
-                if response.status_code != 200:
+                for next_page in asyncio.as_completed(tasks):
+                    try:
+                        page_parser = await next_page
+                    except SiteBlocked:
+                        raise
+                    except ChallengeDetected as e:
+                        challenge = challenge or e
+                        continue
+                    except Exception:
+                        continue
+                    if page_parser is not None and len(product_urls) < max_products:
+                        if self._collect_page_links(page_parser, product_urls, max_products, on_url):
+                            pages_with_products += 1
+            finally:
+                # При отмене обхода (или SiteBlocked) оставшиеся страницы не загружаются
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        elif new_count:
+            # Пагинация не найдена - перебираем страницы до последней
+            for page_num in range(2, 100):
+                if len(product_urls) >= max_products:
                     break
-                    
-                parser = HTMLParser(response.text)
-                links = parser.css('a[href*="/goods/"][href$=".html"]')
-                
-                if not links:
+                try:
+                    page_parser = await self._fetch_catalog_page(category, page_num)
+                except SiteBlocked:
+                    raise
+                except ChallengeDetected as e:
+                    challenge = e
                     break
-
-                page_count = 0
-                for link in links:
-                    href = link.attributes.get('href')
-                    if href and '.html' in href and '/goods/' in href:
-                        full_url = urljoin(self.BASE_URL, href)
-                        if full_url not in product_urls:
-                            product_urls.add(full_url)
-                            page_count += 1
-
-                if page_count == 0:  # Нет новых товаров - конец
+                except Exception:
                     break
-                    
-                if len(product_urls) >= max_products:
+                if page_parser is None:
                     break
-                    
-                await asyncio.sleep(0.2)
-                
-            except Exception:
-                break
+                if not self._collect_page_links(page_parser, product_urls, max_products, on_url):
+                    break
+                pages_with_products += 1
         
-        # Дополнительная загрузка
-        if len(product_urls) < max_products:
-            await self._load_more_products(category, product_urls, max_products)
+        # Прежний обход: страницы 1..N+1 последовательно и повторная загрузка
+        # страницы 2 в _load_more_products, если товаров меньше max_products
+        legacy = pages_with_products + 1
+        if len(product_urls) < max_products and pages_with_products:
+            legacy += 1
+        self.discovery_stats['legacy_requests'] += legacy
         
+        if challenge is not None:
+            # Категория пройдена не полностью - в журнал как обойденная не попадет
+            raise challenge
         return list(product_urls)
     
-    async def _load_more_products(self, category: str, product_urls: set, max_products: int):
-        """Простая загрузка дополнительных товаров через пагинацию."""
-        # Пробуем загрузить больше страниц через обычную пагинацию
-        for page_num in range(2, 20):  # Страницы 2-19
-            try:
-                url = f"{self.BASE_URL}{category}?page={page_num}"
-                response = await self.antibot_client.request(method="GET", url=url)
-                
-                if response.status_code != 200:
-                    break
-                    
-                parser = HTMLParser(response.text)
-                links = parser.css('a[href*="/goods/"][href$=".html"]')
-                
-                if not links:
-                    break
-
-                page_count = 0
-                for link in links:
-                    href = link.attributes.get('href')
-                    if href and '.html' in href and '/goods/' in href:
-                        full_url = urljoin(self.BASE_URL, href)
-                        if full_url not in product_urls:
-                            product_urls.add(full_url)
-                            page_count += 1
-
-                if page_count == 0:  # Нет новых товаров - конец
-                    break
-                    
-                if len(product_urls) >= max_products:
-                    break
-                    
-                await asyncio.sleep(0.2)
-                
-            except Exception:
+    async def _fetch_catalog_page(self, category: str, page_num: int):
+        """Загрузить страницу каталога (None - страница недоступна).
+        
+        Параллельность и частоту запросов каталога ограничивает клиент:
+        адаптивный лимит и token bucket класса 'catalog'.
+        """
+        url = f"{self.BASE_URL}{category}?page={page_num}"
+        self.discovery_stats['requests'] += 1
+        response = await self.antibot_client.request(method="GET", url=url)
+        if response.status_code != 200 or not HTMLParser:
+            return None
+        return HTMLParser(response.text)
+    
+    def _detect_page_count(self, parser) -> int:
+        """Число страниц категории по ссылкам пагинации (0 - пагинация не найдена)."""
+        page_count = 0
+        for link in parser.css('a[href*="page"], a[href*="PAGEN"]'):
+            match = PAGE_PARAM_RE.search(link.attributes.get('href') or '')
+            if match:
+                page_count = max(page_count, int(match.group(1)))
+        return page_count
+    
+    def _collect_page_links(self, parser, product_urls: set, max_products: int,
+                            on_url: Optional[Callable[[str, str, str], None]] = None) -> int:
+        """Добавить ссылки на товары со страницы каталога, вернуть число новых."""
+        page_count = 0
+        for link in parser.css('a[href*="/goods/"][href$=".html"]'):
+            if len(product_urls) >= max_products:
+                break
+            href = link.attributes.get('href')
+            if href and '.html' in href and '/goods/' in href:
+                full_url = urljoin(self.BASE_URL, href)
+                if full_url not in product_urls:
+                    product_urls.add(full_url)
+                    page_count += 1
+                    if on_url:
+                        title = link.attributes.get('title') or link.text(strip=True)
+                        on_url(full_url, title, self._listing_price(link))
+        return page_count
+    
+    def _listing_price(self, link) -> str:
+        """Цена из плитки товара, в которой находится ссылка ('' - не найдена)."""
+        node = link.parent
+        for _ in range(5):
+            if node is None:
                 break
+            # Подниматься выше плитки нельзя - там цены других товаров
+            if 'card' in (node.attributes.get('class') or '').lower():
+                # Текущая цена, а не зачеркнутая старая или цена за килограмм
+                return listing_price(node)
+            node = node.parent
+        return ''
+    
+    def _carry_forward(self, previous: Dict[str, Dict], url: str, title: str, price: str) -> Optional[Dict]:
+        """Запись прошлого обхода, если карточку можно не загружать (None - загружать)."""
+        record = previous.get(self._extract_id(url))
+        if record is None:
+            self.incremental_stats['new'] += 1
+            return None
+        if not record.get('name') or not all(record.get(field) for field in NUTRITION_FIELDS):
+            self.incremental_stats['incomplete'] += 1
+            return None
+        if self._listing_changed(record, title, price):
+            self.incremental_stats['changed'] += 1
+            return None
+        self.incremental_stats['carried'] += 1
+        return dict(record)
+    
+    def _listing_changed(self, record: Dict, title: str, price: str) -> bool:
+        """Отличаются ли название или цена в плитке каталога от записи."""
+        # Название в плитке может быть обрезано - сравниваем по началу
+        listed = " ".join(title.lower().split())
+        known = " ".join(str(record.get('name') or '').lower().split())
+        changed = bool(listed) and bool(known) and not (known.startswith(listed) or listed.startswith(known))
+        if price and record.get('price'):
+            try:
+                changed = changed or abs(float(price) - float(record['price'])) > 0.001
+            except ValueError:
+                changed = True
+        return changed
     
     async def _search_products(self, search_term: str, max_results: int) -> List[str]:
         """Поиск товаров через поисковую систему сайта."""
@@ -396,10 +843,6 @@ class VkusvillHeavyParser:
                         if response.status_code == 200:
                             product_urls.add(test_url)
                             break
-                            
-                    # Небольшая пауза
-                    if len(product_urls) % 50 == 0:
-                        await asyncio.sleep(1)
                         
                 except Exception:
                     continue
@@ -414,498 +857,187 @@ class VkusvillHeavyParser:
         name = product.get('name', '').lower()
         url = product.get('url', '').lower()
         
-        # Ключевые слова готовой еды
-        ready_food_keywords = [
-            'суп', 'салат', 'борщ', 'омлет', 'блины', 'каша', 'пицца',
-            'паста', 'котлета', 'запеканка', 'сырники', 'плов', 'лазанья',
-            'крем-суп', 'харчо', 'цезарь', 'винегрет', 'мимоза',
-            'рагу', 'гуляш', 'жаркое', 'биточки', 'тефтели', 'фрикадельки',
-            'голубцы', 'долма', 'манты', 'пельмени', 'вареники', 'хинкали',
-            'шаурма', 'бургер', 'сэндвич', 'рулет', 'пирог', 'киш', 'тарт',
-            'ризотто', 'паэлья', 'карри', 'рамен', 'фо', 'том-ям', 'мисо',
-            'окрошка', 'солянка', 'щи', 'уха', 'рассольник', 'кулеш',
-            'завтрак', 'обед', 'ужин'
-        ]
-        
-        # Исключаем НЕ готовую еду
-        exclude_keywords = [
-            'крем для', 'гель для', 'средство для', 'прокладки', 'подгузники',
-            'шампунь', 'бальзам', 'мыло', 'зубная', 'паста зубная',
-            'чипсы', 'сухарики', 'орехи', 'семечки', 'конфеты', 'шоколад',
-            'молоко', 'кефир', 'йогурт', 'творог', 'сыр', 'масло', 'яйца',
-            'мясо', 'курица', 'говядина', 'свинина', 'рыба', 'филе',
-            'овощи', 'фрукты', 'картофель', 'капуста', 'морковь',
-            'хлеб', 'батон', 'булка', 'багет', 'лаваш'
-        ]
-        
         # Проверяем URL на готовую еду
         if 'gotovaya-eda' in url:
             return True
         
         # Проверяем название на ключевые слова готовой еды
-        if any(keyword in name for keyword in ready_food_keywords):
+        if any(keyword in name for keyword in READY_FOOD_KEYWORDS):
             # Дополнительно проверяем что это не исключение
-            if not any(exclude in name for exclude in exclude_keywords):
+            if not any(exclude in name for exclude in NOT_READY_FOOD_KEYWORDS):
                 return True
         
         return False
     
-    async def _extract_full_product(self, url: str, retry_count: int = 0) -> Optional[Dict]:
-        """Полное извлечение товара со всеми данными с retry механизмом."""
-        max_retries = 2  # Максимум 2 повторных попытки
+    def _link_confidence(self, url: str, title: str, category: str) -> float:
+        """Насколько вероятно, что карточка пройдет _is_ready_food, - до ее загрузки.
         
+        Название в каталоге обычно совпадает с названием в карточке, поэтому
+        проверка по нему почти точно предсказывает результат. Без названия
+        решают транслитерация блюда в адресе и категория готовой еды.
+        """
+        slug = url.lower().rsplit('/', 1)[-1]
+        if title:
+            if self._is_ready_food({'name': title, 'url': url}):
+                return 1.0
+            return 0.1
+        if 'gotovaya-eda' in url.lower():
+            return 1.0
+        if any(keyword in slug for keyword in READY_FOOD_SLUG_KEYWORDS):
+            return 0.8
+        if 'gotovaya-eda' in category:
+            return 0.5
+        return 0.2
+    
+    async def _fetch_card(self, url: str):
+        """Один запрос карточки: сетевые сбои повторяет клиент, паузы после 429 и проверок - тоже."""
+        self.fetch_stats['fetches'] += 1
         try:
             response = await self.antibot_client.request(method="GET", url=url)
-            if response.status_code != 200 or not HTMLParser:
-                print(f"      ❌ HTTP {response.status_code} для {url}")
-                return None
-                
-            parser = HTMLParser(response.text)
-            page_text = response.text
-            
-            # Базовые данные
-            product = {
-                'id': self._extract_id(url),
-                'name': self._extract_name(parser, page_text),
-                'price': self._extract_price(parser, page_text),
-                'category': 'Готовая еда',
-                'url': url,
-                'shop': 'vkusvill_heavy',
-                'photo': self._extract_photo(parser),
-                'composition': self._extract_composition(parser, page_text),
-                'tags': '',
-                'portion_g': self._extract_portion_weight(parser, page_text)
-            }
-            
-            # Расширенное извлечение БЖУ
-            nutrition = self._extract_bju_comprehensive(parser, page_text)
-            product.update(nutrition)
-            
-            # Детальная статистика по полям
-            filled_bju = sum(1 for field in ['kcal_100g', 'protein_100g', 'fat_100g', 'carb_100g'] if product.get(field))
-            has_composition = bool(product.get('composition'))
-            
-            # Краткие логи
-            print(f"      📦 {product['name'][:40]}... БЖУ:{filled_bju}/4 Состав:{'✓' if has_composition else '✗'} Цена:{product['price'] or '?'}")
-            
-            # Retry для состава
-            if not has_composition and retry_count < max_retries:
-                await asyncio.sleep(0.5)
-                return await self._extract_full_product(url, retry_count + 1)
-            
-            # Проверка базовых данных
-            if not product['name']:
-                print(f"      ❌ Нет названия для {url}")
-                return None
-            
-            return product
-            
+        except SiteBlocked:
+            raise
+        except ChallengeDetected as e:
+            # Сразу повторять бессмысленно - цепь проверок клиента решит, когда продолжать
+            print(f"      🚧 Страница проверки для {url}: {e.reason}")
+            return None
         except Exception as e:
-            if retry_count < max_retries:
-                await asyncio.sleep(1)
-                return await self._extract_full_product(url, retry_count + 1)
+            print(f"      ❌ Не удалось загрузить {url}: {e}")
+            return None
+        if response.status_code != 200:
+            print(f"      ❌ HTTP {response.status_code} для {url}")
             return None
+        return response
     
-    def _extract_id(self, url: str) -> str:
-        """ID товара из URL."""
-        match = re.search(r'/goods/([^/]+)\.html', url)
-        return match.group(1) if match else str(hash(url))[-8:]
+    async def _parse_card(self, response, url: str) -> Optional[Dict]:
+        """Поля карточки по таблице правил extraction.FIELD_RULES - в пуле процессов."""
+        for attempt in range(2):
+            try:
+                fields, _ = await self.extractor.extract(response.content, url, response.encoding)
+                return fields
+            except Exception as e:
+                if attempt:
+                    print(f"      ❌ Ошибка разбора {url}: {e}")
+                    return None
+                # Сбой разбора - повторяем разбор того же ответа, а не загрузку
+                self.fetch_stats['reparses'] += 1
     
-    def _extract_name(self, parser, page_text: str) -> str:
-        """Название товара."""
-        selectors = ['h1', '.product-title', '.goods-title']
-        for selector in selectors:
-            element = parser.css_first(selector)
-            if element and element.text(strip=True):
-                return element.text(strip=True)[:150]
-        return ""
-    
-    def _extract_price(self, parser, page_text: str) -> str:
-        """Цена товара - улучшенное извлечение."""
-        # Расширенные селекторы для цены
-        selectors = [
-            '.price', '.product-price', '.cost', '.goods-price',
-            '[data-testid*="price"]', '[class*="price"]', 
-            '.js-product-price', '.current-price'
-        ]
-        
-        for selector in selectors:
-            elements = parser.css(selector)
-            for element in elements:
-                price_text = element.text(strip=True)
-                # Ищем числа в тексте цены
-                numbers = re.findall(r'(\d+(?:[.,]\d+)?)', price_text)
-                for num in numbers:
-                    try:
-                        price_val = float(num.replace(',', '.'))
-                        if 10 <= price_val <= 10000:  # Разумный диапазон цен
-                            return num.replace(',', '.')
-                    except ValueError:
-                        continue
+    async def _extract_full_product(self, url: str) -> Optional[Dict]:
+        """Полное извлечение товара со всеми данными.
         
-        # Поиск в JSON данных
-        json_patterns = [
-            r'"price"\s*:\s*"?(\d+(?:[.,]\d+)?)"?',
-            r'"cost"\s*:\s*"?(\d+(?:[.,]\d+)?)"?',
-            r'"currentPrice"\s*:\s*"?(\d+(?:[.,]\d+)?)"?'
-        ]
-        for pattern in json_patterns:
-            match = re.search(pattern, page_text, re.I)
-            if match:
-                try:
-                    price_val = float(match.group(1).replace(',', '.'))
-                    if 10 <= price_val <= 10000:
-                        return match.group(1).replace(',', '.')
-                except ValueError:
-                    continue
+        Страница загружается повторно, только если ответ 200 пришел без
+        обязательных полей (REQUIRED_CARD_FIELDS) - например, обрезанный.
+        Сетевые сбои повторяет клиент. Поле, которого нет на полученной
+        странице после всех стратегий, записывается как отсутствующее -
+        повторная загрузка той же карточки его не даст.
+        """
+        if not HTMLParser:
+            return None
+        fields = None
+        for fetch in range(self.max_card_fetches):
+            if fetch:
+                self.fetch_stats['refetches'] += 1
+                if self.antibot_client.cache:
+                    # Неполная страница не должна вернуться из кэша
+                    self.antibot_client.cache.invalidate(url, self.antibot_client.location_key)
+            response = await self._fetch_card(url)
+            if response is None:
+                return None
+            fields = await self._parse_card(response, url)
+            if fields is None:
+                return None
+            if all(fields.get(field) for field in REQUIRED_CARD_FIELDS):
+                break
+        self.fetch_stats['cards'] += 1
         
-        # Поиск по тексту страницы
-        text_patterns = [
-            r'(\d+(?:[.,]\d+)?)\s*руб',
-            r'(\d+(?:[.,]\d+)?)\s*₽',
-            r'цена[:\s]*(\d+(?:[.,]\d+)?)',
-            r'стоимость[:\s]*(\d+(?:[.,]\d+)?)'
-        ]
-        for pattern in text_patterns:
-            matches = re.finditer(pattern, page_text, re.I)
-            for match in matches:
-                try:
-                    price_val = float(match.group(1).replace(',', '.'))
-                    if 10 <= price_val <= 10000:
-                        return match.group(1).replace(',', '.')
-                except ValueError:
-                    continue
+        # Базовые данные
+        product = {
+            'id': self._extract_id(url),
+            'name': fields['name'],
+            'price': fields['price'],
+            'category': 'Готовая еда',
+            'url': url,
+            'shop': 'vkusvill_heavy',
+            'photo': fields['photo'],
+            'composition': fields['composition'],
+            'tags': '',
+            'portion_g': fields['portion_g'],
+            'kcal_100g': fields['kcal_100g'],
+            'protein_100g': fields['protein_100g'],
+            'fat_100g': fields['fat_100g'],
+            'carb_100g': fields['carb_100g'],
+        }
         
-        return ""
-    
-    def _extract_photo(self, parser) -> str:
-        """Фото товара - улучшенное извлечение."""
-        # Расширенные селекторы для фото
-        selectors = [
-            'img',  # Все изображения для начала
-            'img[src*="product"]', 
-            '.product-image img',
-            '[data-testid*="image"] img',
-            '.gallery img',
-            '.main-image img',
-            'img[alt*="product"]',
-            'img[src*="goods"]',
-            'img[data-src*="product"]',
-            'img[data-src*="goods"]'
-        ]
+        for field, value in fields.items():
+            if not value:
+                self.absent_fields[field] = self.absent_fields.get(field, 0) + 1
         
-        for selector in selectors:
-            elements = parser.css(selector)
-            for element in elements:
-                # Проверяем src и data-src
-                src = element.attributes.get('src') or element.attributes.get('data-src')
-                if src:
-                    # Проверяем что это изображение товара (не иконка, не логотип)
-                    if any(keyword in src.lower() for keyword in ['product', 'goods', 'catalog', 'upload', 'resize']):
-                        # Проверяем что это не маленькая иконка
-                        width = element.attributes.get('width')
-                        height = element.attributes.get('height')
-                        if width and height:
-                            try:
-                                w, h = int(width), int(height)
-                                if w < 50 or h < 50:  # Пропускаем маленькие изображения
-                                    continue
-                            except ValueError:
-                                pass
-                        
-                        # Пропускаем системные изображения
-                        if any(skip in src.lower() for skip in ['icon', 'logo', 'banner', 'button', 'svg']):
-                            continue
-                        
-                        full_url = urljoin(self.BASE_URL, src)
-                        # Проверяем что URL валидный
-                        if full_url.startswith('http'):
-                            return full_url
-                    
-                    # Если не нашли по ключевым словам, берем любое большое изображение
-                    elif src.startswith('/') and any(ext in src.lower() for ext in ['.jpg', '.jpeg', '.png', '.webp']):
-                        width = element.attributes.get('width')
-                        height = element.attributes.get('height')
-                        if width and height:
-                            try:
-                                w, h = int(width), int(height)
-                                if w >= 100 and h >= 100:  # Берем только большие изображения
-                                    full_url = urljoin(self.BASE_URL, src)
-                                    return full_url
-                            except ValueError:
-                                pass
-        
-        return ""
-    
-    def _extract_composition(self, parser, page_text: str) -> str:
-        """Состав товара - простое извлечение."""
-        # Поиск по ключевому слову "Состав"
-        elements = parser.css('div, p, span, td, li')
-        for element in elements:
-            text = element.text().strip()
-            text_lower = text.lower()
-            
-            if 'состав' in text_lower and len(text) > 10:
-                if not any(word in text_lower for word in ['меню', 'каталог', 'корзина', 'вкусвилл', 'доставки', 'выберите']):
-                    if text_lower.startswith('состав'):
-                        return text[:800]
-                    elif len(text) < 800:
-                        return text[:500]
-        
-        return ""
-    
-    def _extract_portion_weight(self, parser, page_text: str) -> str:
-        """Вес порции."""
-        patterns = [r'(\d+(?:[.,]\d+)?)\s*(?:г|гр|грам)']
-        for pattern in patterns:
-            matches = re.finditer(pattern, page_text, re.I)
-            for match in matches:
-                weight = float(match.group(1).replace(',', '.'))
-                if 10 <= weight <= 2000:
-                    return f"{weight}г"
-        return ""
-    
-    def _extract_bju_comprehensive(self, parser, page_text: str) -> Dict[str, str]:
-        """Максимально полное извлечение БЖУ с детальными логами."""
-        nutrition = {'kcal_100g': '', 'protein_100g': '', 'fat_100g': '', 'carb_100g': ''}
-        # Метод 1: Поиск в JSON-LD
-        self._extract_nutrition_from_jsonld(page_text, nutrition)
-        
-        # Метод 2: Поиск в таблицах
-        self._extract_nutrition_from_tables(parser, nutrition)
-        
-        # Метод 3: Поиск в элементах страницы (улучшенный)
-        bju_elements_found = 0
-        elements = parser.css('div, span, p, td, th, li')
-        for element in elements:
-            text = element.text().lower()
-            original_text = element.text()
-            
-            # Пропускаем элементы с слишком большим количеством чисел (скорее всего мусор)
-            numbers_count = len(re.findall(r'\d+', original_text))
-            if numbers_count > 10:
-                continue
-                
-            if any(word in text for word in ['ккал', 'белки', 'жиры', 'углеводы', 'энергетическая', 'калорийность', 'пищевая', 'ценность', 'состав']):
-                bju_elements_found += 1
-                
-                # Ищем число РЯДОМ с ключевым словом
-                if ('ккал' in text or 'калорийность' in text or 'энергетическая' in text) and not nutrition['kcal_100g']:
-                    # Паттерны для поиска калорий (включая структуру ВкусВилл)
-                    kcal_patterns = [
-                        r'(\d+(?:[.,]\d+)?)\s*ккал',  # "189.6 Ккал"
-                        r'ккал[:\s]*(\d+(?:[.,]\d+)?)',
-                        r'калорийность[:\s]*(\d+(?:[.,]\d+)?)',
-                        r'энергетическая\s+ценность[:\s]*(\d+(?:[.,]\d+)?)',
-                        r'(\d+(?:[.,]\d+)?)\s+ккал'  # "189.6 Ккал" с пробелом
-                    ]
-                    for pattern in kcal_patterns:
-                        match = re.search(pattern, text)
-                        if match:
-                            try:
-                                val = float(match.group(1).replace(',', '.'))
-                                if 10 <= val <= 900:
-                                    nutrition['kcal_100g'] = match.group(1).replace(',', '.')
-                                    break
-                            except ValueError:
-                                continue
-                
-                if 'белк' in text and not nutrition['protein_100g']:
-                    protein_patterns = [
-                        r'(\d+(?:[.,]\d+)?)\s+белки,\s*г',  # "11 Белки, г"
-                        r'белк[иа][:\s]*(\d+(?:[.,]\d+)?)',
-                        r'белок[:\s]*(\d+(?:[.,]\d+)?)',
-                        r'(\d+(?:[.,]\d+)?)\s*г\s*белк'
-                    ]
-                    for pattern in protein_patterns:
-                        match = re.search(pattern, text)
-                        if match:
-                            try:
-                                val = float(match.group(1).replace(',', '.'))
-                                if 0 <= val <= 100:
-                                    nutrition['protein_100g'] = match.group(1).replace(',', '.')
-                                    break
-                            except ValueError:
-                                continue
-                
-                if 'жир' in text and not nutrition['fat_100g']:
-                    fat_patterns = [
-                        r'(\d+(?:[.,]\d+)?)\s+жиры,\s*г',  # "7.6 Жиры, г"
-                        r'жир[ыа][:\s]*(\d+(?:[.,]\d+)?)',
-                        r'жир[:\s]*(\d+(?:[.,]\d+)?)',
-                        r'(\d+(?:[.,]\d+)?)\s*г\s*жир'
-                    ]
-                    for pattern in fat_patterns:
-                        match = re.search(pattern, text)
-                        if match:
-                            try:
-                                val = float(match.group(1).replace(',', '.'))
-                                if 0 <= val <= 100:
-                                    nutrition['fat_100g'] = match.group(1).replace(',', '.')
-                                    break
-                            except ValueError:
-                                continue
-                
-                if 'углевод' in text and not nutrition['carb_100g']:
-                    carb_patterns = [
-                        r'(\d+(?:[.,]\d+)?)\s+углеводы,\s*г',  # "19.3 Углеводы, г"
-                        r'углевод[ыа][:\s]*(\d+(?:[.,]\d+)?)',
-                        r'углевод[:\s]*(\d+(?:[.,]\d+)?)',
-                        r'(\d+(?:[.,]\d+)?)\s*г\s*углевод'
-                    ]
-                    for pattern in carb_patterns:
-                        match = re.search(pattern, text)
-                        if match:
-                            try:
-                                val = float(match.group(1).replace(',', '.'))
-                                if 0 <= val <= 100:
-                                    nutrition['carb_100g'] = match.group(1).replace(',', '.')
-                                    break
-                            except ValueError:
-                                continue
-        
-        # Метод 4: Поиск по регулярным выражениям в тексте
-        patterns = {
-            'kcal_100g': [
-                r'(\d+(?:[.,]\d+)?)\s+ккал',  # "189.6 Ккал" - основной паттерн ВкусВилл
-                r'(\d+(?:[.,]\d+)?)\s*ккал',
-                r'калорийность[:\s]*(\d+(?:[.,]\d+)?)',
-                r'энергетическая\s+ценность[:\s]*(\d+(?:[.,]\d+)?)',
-                r'энергия[:\s]*(\d+(?:[.,]\d+)?)\s*ккал'
-            ],
-            'protein_100g': [
-                r'(\d+(?:[.,]\d+)?)\s+белки,\s*г',  # "11 Белки, г" - основной паттерн ВкусВилл
-                r'белки[:\s]*(\d+(?:[.,]\d+)?)',
-                r'белок[:\s]*(\d+(?:[.,]\d+)?)',
-                r'протеин[:\s]*(\d+(?:[.,]\d+)?)'
-            ],
-            'fat_100g': [
-                r'(\d+(?:[.,]\d+)?)\s+жиры,\s*г',  # "7.6 Жиры, г" - основной паттерн ВкусВилл
-                r'жиры[:\s]*(\d+(?:[.,]\d+)?)',
-                r'жир[:\s]*(\d+(?:[.,]\d+)?)'
-            ],
-            'carb_100g': [
-                r'(\d+(?:[.,]\d+)?)\s+углеводы,\s*г',  # "19.3 Углеводы, г" - основной паттерн ВкусВилл
-                r'углеводы[:\s]*(\d+(?:[.,]\d+)?)',
-                r'углевод[:\s]*(\d+(?:[.,]\d+)?)'
-            ]
-        }
+        # Детальная статистика по полям
+        filled_bju = sum(1 for field in ['kcal_100g', 'protein_100g', 'fat_100g', 'carb_100g'] if product.get(field))
+        has_composition = bool(product.get('composition'))
         
-        for field, field_patterns in patterns.items():
-            if nutrition[field]:
-                continue
-            for pattern in field_patterns:
-                matches = list(re.finditer(pattern, page_text, re.I))
-                for match in matches:
-                    try:
-                        value = float(match.group(1).replace(',', '.'))
-                        if field == 'kcal_100g' and 10 <= value <= 900:
-                            nutrition[field] = str(value)
-                            break
-                        elif field != 'kcal_100g' and 0 <= value <= 100:
-                            nutrition[field] = str(value)
-                            break
-                    except ValueError:
-                        continue
-                if nutrition[field]:
-                    break
+        # Краткие логи
+        print(f"      📦 {product['name'][:40]}... БЖУ:{filled_bju}/4 Состав:{'✓' if has_composition else '✗'} Цена:{product['price'] or '?'}")
         
-        # Простая статистика БЖУ
-        filled_total = sum(1 for v in nutrition.values() if v)
+        # Проверка базовых данных
+        if not product['name']:
+            print(f"      ❌ Нет названия для {url}")
+            return None
         
-        return nutrition
-    
-    def _extract_nutrition_from_jsonld(self, page_text: str, nutrition: Dict[str, str]):
-        """Извлечение БЖУ из JSON-LD."""
-        try:
-            blocks = re.findall(r'<script[^>]+type=["\']application/ld\+json["\'][^>]*>(.*?)</script>', page_text, re.S|re.I)
-            for raw in blocks:
-                try:
-                    data = json.loads(raw)
-                    print(f"         JSON-LD блок найден")
-                    
-                    def visit(obj):
-                        if isinstance(obj, dict):
-                            if obj.get('@type') in ('NutritionInformation', 'Nutrition'):
-                                print(f"         Найден NutritionInformation блок!")
-                                kcal = obj.get('calories') or obj.get('energy')
-                                protein = obj.get('proteinContent')
-                                fat = obj.get('fatContent')
-                                carb = obj.get('carbohydrateContent')
-                                
-                                if kcal: nutrition['kcal_100g'] = str(kcal)
-                                if protein: nutrition['protein_100g'] = str(protein)
-                                if fat: nutrition['fat_100g'] = str(fat)
-                                if carb: nutrition['carb_100g'] = str(carb)
-                            
-                            for v in obj.values():
-                                visit(v)
-                        elif isinstance(obj, list):
-                            for v in obj:
-                                visit(v)
-                    
-                    visit(data)
-                except:
-                    continue
-        except:
-            pass
+        return product
     
-    def _extract_nutrition_from_tables(self, parser, nutrition: Dict[str, str]):
-        """Извлечение БЖУ из таблиц."""
-        try:
-            tables = parser.css('table')
-            print(f"         Найдено таблиц: {len(tables)}")
-            for i, table in enumerate(tables):
-                print(f"         Анализируем таблицу {i+1}")
-                rows = table.css('tr')
-                for row in rows:
-                    cells = row.css('td, th')
-                    if len(cells) >= 2:
-                        header = cells[0].text().lower()
-                        value_text = cells[1].text()
-                        
-                        # Извлечение числа
-                        num_match = re.search(r'(\d+(?:[.,]\d+)?)', value_text)
-                        if num_match:
-                            value = num_match.group(1).replace(',', '.')
-                            print(f"         Строка таблицы: '{header}' = '{value}'")
-                            
-                            if ('ккал' in header or 'калорийность' in header) and not nutrition['kcal_100g']:
-                                nutrition['kcal_100g'] = value
-                                print(f"         ✅ Из таблицы ккал: {value}")
-                            elif 'белк' in header and not nutrition['protein_100g']:
-                                nutrition['protein_100g'] = value
-                                print(f"         ✅ Из таблицы белки: {value}")
-                            elif 'жир' in header and not nutrition['fat_100g']:
-                                nutrition['fat_100g'] = value
-                                print(f"         ✅ Из таблицы жиры: {value}")
-                            elif 'углевод' in header and not nutrition['carb_100g']:
-                                nutrition['carb_100g'] = value
-                                print(f"         ✅ Из таблицы углеводы: {value}")
-        except:
-            pass
+    def _extract_id(self, url: str) -> str:
+        """ID товара из URL."""
+        match = re.search(r'/goods/([^/]+)\.html', url)
+        return match.group(1) if match else str(hash(url))[-8:]
 
 
 async def main():
     """Главная функция тяжелого парсера."""
-    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 1500
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    limit = int(args[0]) if args else 1500
+    # --incremental: загружать только новые и изменившиеся карточки
+    incremental = "--incremental" in sys.argv
+    # --resume: продолжить оборвавшийся обход по журналу
+    resume = "--resume" in sys.argv
+    # --budget=N: не больше N карточек за обход, по расписанию обновления (включает --incremental)
+    budget = next((int(arg.split("=", 1)[1]) for arg in sys.argv if arg.startswith("--budget=")), None)
+    incremental = incremental or budget is not None
     
     print("🏗️ ТЯЖЕЛЫЙ ПАРСЕР ВКУСВИЛЛА - МОСКВА")
     print("=" * 50)
     print(f"🎯 Цель: {limit} товаров с полными данными")
     print("📍 Местоположение: Москва")
-    print("⚡ Режим: Глубокий анализ каждой карточки")
+    if budget is not None:
+        print(f"⚡ Режим: Обновление по расписанию, не больше {budget} карточек")
+    elif incremental:
+        print("⚡ Режим: Только новые и изменившиеся карточки")
+    else:
+        print("⚡ Режим: Глубокий анализ каждой карточки")
     print()
     
     logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
     
-    antibot_client = AntiBotClient(concurrency=8, timeout=60)
+    # HTTP_CACHE_DIR включает дисковый кэш страниц между запусками
+    antibot_client = AntiBotClient(
+        timeout=60,
+        cache_dir=os.getenv("HTTP_CACHE_DIR"),
+        http2=os.getenv("HTTP2") == "1",
+        hedge=os.getenv("HEDGE", "1") == "1",
+    )
+    
+    journal = CrawlJournal(os.getenv("CRAWL_JOURNAL", CRAWL_JOURNAL_PATH))
     
     try:
         parser = VkusvillHeavyParser(antibot_client)
         
         start_time = time.time()
-        products = await parser.scrape_heavy(limit)
+        previous = load_snapshot() if incremental else None
+        scheduler = None
+        if budget is not None:
+            store = FreshnessStore.load(os.getenv("FRESHNESS_PATH", FRESHNESS_PATH))
+            scheduler = RefreshScheduler(store, budget)
+        journal.open(resume=resume)
+        products = await parser.scrape_heavy(limit, previous=previous or None, journal=journal, scheduler=scheduler)
         end_time = time.time()
         
         if not products:
@@ -988,16 +1120,53 @@ async def main():
         print(f"   • Хорошее (БЖУ 2+ ИЛИ состав): {quality_stats['good']} ({quality_stats['good']/len(products)*100:.1f}%)")
         print(f"   • Плохое (БЖУ <2 И нет состава): {quality_stats['poor']} ({quality_stats['poor']/len(products)*100:.1f}%)")
         print()
+        print(f"🧩 СТРАТЕГИИ ИЗВЛЕЧЕНИЯ (порядок, доля попаданий, среднее время):")
+        for field, field_report in parser.extraction_stats.report().items():
+            fill_rate = field_report['fill_rate']
+            filled = f"{fill_rate*100:.1f}%" if fill_rate is not None else "-"
+            strategies = ", ".join(
+                f"{name} {info['hit_rate']*100:.0f}%/{info['avg_ms']}мс"
+                for name, info in field_report['strategies'].items()
+            )
+            print(f"   • {field} ({filled}): {strategies}")
+        print()
+        fetch_stats = parser.fetch_stats
+        print(f"♻️ ЗАГРУЗКИ КАРТОЧЕК:")
+        print(f"   • Карточек: {fetch_stats['cards']}, запросов: {fetch_stats['fetches']} (повторов из-за неполной страницы: {fetch_stats['refetches']})")
+        print(f"   • Повторов сетевых сбоев в клиенте: {antibot_client.metrics()['retries']['retries']}")
+        if previous and scheduler is None:
+            incremental_stats = parser.incremental_stats
+            print(f"   • Перенесено из снимка без загрузки: {incremental_stats['carried']} "
+                  f"(новых: {incremental_stats['new']}, изменившихся: {incremental_stats['changed']}, "
+                  f"без полного БЖУ: {incremental_stats['incomplete']})")
+        if scheduler is not None:
+            refresh_stats = scheduler.stats
+            print(f"   • По расписанию: загружено {scheduler.used} из бюджета {budget} "
+                  f"(новых: {refresh_stats['new']}, обновлено: {refresh_stats['fetched']}, "
+                  f"отложено до следующего обхода: {refresh_stats['carried'] + refresh_stats['new_skipped']})")
+            print(f"   • Перенесено из снимка без загрузки: {refresh_stats['not_due'] + refresh_stats['carried']} "
+                  f"(срок не подошел: {refresh_stats['not_due']}, не хватило бюджета: {refresh_stats['carried']})")
+        if parser.absent_fields:
+            print(f"   • Нет на странице: {parser.absent_fields}")
+        print()
         print(f"⏱️  Время выполнения: {duration/60:.1f} минут")
         print(f"💾 Файлы сохранены:")
         print(f"   • CSV: {csv_file}")
         print(f"   • JSONL: {jsonl_file}")
+        print(f"   • Статистика извлечения: {parser.extraction_stats_path}")
+        # Результаты на диске - журнал больше не нужен для возобновления
+        journal.finish()
             
     except KeyboardInterrupt:
         print("\n⚠️ Парсинг прерван пользователем")
+    except SiteBlocked as e:
+        print(f"🛑 Парсинг остановлен: {e}")
     except Exception as e:
         print(f"❌ Ошибка тяжелого парсинга: {e}")
     finally:
+        if journal.file is not None:
+            journal.close()
+            print(f"📓 Прогресс сохранен в {journal.path}, продолжить: python3 moscow_improved.py {limit} --resume")
         await antibot_client.close()
 
 
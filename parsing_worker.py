@@ -10,13 +10,14 @@ import sys
 import time
 import pandas as pd
 from pathlib import Path
+from contextlib import asynccontextmanager
 from datetime import datetime
 from typing import Dict, Any, Optional
 
 current_dir = Path(__file__).parent
 sys.path.insert(0, str(current_dir))
 
-from address import VkusvillFastParser, AntiBotClient, get_location_from_address
+from address import VkusvillFastParser, AntiBotClient, SiteBlocked, get_location_from_address
 
 import redis.asyncio as aioredis
 from tenacity import retry, stop_after_attempt, wait_exponential
@@ -65,11 +66,17 @@ class ParsingWorker:
             "tasks_processed": 0,
             "tasks_success": 0,
             "tasks_error": 0,
+            "tasks_blocked": 0,
             "total_time": 0,
             "start_time": datetime.now().isoformat()
         }
         self.reconnect_attempts = 0
         self.max_reconnect_attempts = 10
+        # Задачи для разных адресов выполняются параллельно, каждая в своей сессии
+        self.task_slots = asyncio.Semaphore(int(os.getenv("PARSER_TASKS", "2")))
+        # Полный обход - только один: общие журнал, метаданные свежести и CSV
+        self.full_parsing_lock = asyncio.Lock()
+        self.active_tasks = set()
 
     @retry(
         stop=stop_after_attempt(5),
@@ -100,6 +107,8 @@ class ParsingWorker:
             # Проверяем соединение
             await self.redis.ping()
             logger.info("✅ Подключено к Redis")
+            if self.parser and self.parser.availability_cache:
+                self.parser.availability_cache.redis = self.redis
             self.reconnect_attempts = 0
             return True
 
@@ -124,8 +133,15 @@ class ParsingWorker:
             await self.connect_redis()
 
             # Инициализация парсера
-            self.antibot_client = AntiBotClient(concurrency=10, timeout=30)
+            self.antibot_client = AntiBotClient(
+                timeout=30,
+                cache_dir=os.getenv("HTTP_CACHE_DIR"),
+                http2=os.getenv("HTTP2") == "1",
+            )
             self.parser = VkusvillFastParser(self.antibot_client)
+            if self.parser.availability_cache:
+                # Доступность по ячейкам - общая для воркеров через Redis
+                self.parser.availability_cache.redis = self.redis
 
             # Загрузка базовой таблицы
             if self.base_csv_path.exists():
@@ -170,6 +186,9 @@ class ParsingWorker:
 
                 stats_data = {
                     **self.stats,
+                    "http": self.antibot_client.metrics() if self.antibot_client else {},
+                    "availability": ({**self.parser.availability_cache.stats, **self.parser.zone_stats}
+                                     if self.parser and self.parser.availability_cache else {}),
                     "avg_time": avg_time,
                     "uptime": (datetime.now() - datetime.fromisoformat(self.stats["start_time"])).total_seconds()
                 }
@@ -186,6 +205,31 @@ class ParsingWorker:
                 logger.error(f"Ошибка heartbeat: {e}")
                 await asyncio.sleep(60)
 
+    async def schedule_refresh(self, every: float, budget: int):
+        """Фоновое обновление: раз в every секунд ставит в очередь обход с бюджетом.
+
+        Задача проходит через общую очередь и слоты, поэтому не мешает
+        пользовательским задачам. Полные обходы выполняются по одному
+        (full_parsing_lock), а пока обновление в очереди или выполняется,
+        следующее не ставится.
+        """
+        while True:
+            await asyncio.sleep(every)
+            try:
+                await self.ensure_redis_connection()
+                # Предыдущее обновление еще в очереди или выполняется - не дублируем
+                if await self.redis.get("parser:refresh_pending"):
+                    continue
+                task_id = f"refresh_{int(time.time())}"
+                task = {"task_id": task_id, "user_id": None, "mode": "full",
+                        "incremental": True, "budget": budget}
+                # Ключ снимается по завершении задачи; срок - на случай падения воркера
+                await self.redis.set("parser:refresh_pending", task_id, ex=max(int(every), 6 * 3600))
+                await self.redis.lpush(self.parsing_queue, json.dumps(task))
+                logger.info(f"🗓️ Обновление по расписанию {task_id}: бюджет {budget} карточек")
+            except Exception as e:
+                logger.error(f"Ошибка планирования обновления: {e}")
+
     async def process_task(self, task: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Обработка одной задачи парсинга"""
         task_id = task.get("task_id")
@@ -206,7 +250,9 @@ class ParsingWorker:
                 return None
 
             if mode == "full":
-                result_df = await self.run_full_parsing()
+                async with self._full_parsing_turn(task_id):
+                    result_df = await self.run_full_parsing(incremental=task.get("incremental", True),
+                                                            budget=task.get("budget"))
             else:
                 result_df = await self.run_fast_parsing(task)
 
@@ -220,6 +266,18 @@ class ParsingWorker:
             self.stats["tasks_success"] += 1
             logger.info(f"✅ Задача {task_id} выполнена успешно")
 
+        except SiteBlocked as e:
+            logger.error(f"🛑 Задача {task_id}: сайт блокирует парсер: {e}")
+
+            result = {
+                "status": "error",
+                "data": None,
+                "error_message": f"Сайт временно блокирует парсер: {e}"
+            }
+
+            self.stats["tasks_error"] += 1
+            self.stats["tasks_blocked"] += 1
+
         except Exception as e:
             logger.error(f"❌ Ошибка обработки задачи {task_id}: {e}")
 
@@ -237,6 +295,27 @@ class ParsingWorker:
 
         return result
 
+    @asynccontextmanager
+    async def _full_parsing_turn(self, task_id: str):
+        """Очередь полных обходов: следующий начинается после завершения предыдущего.
+
+        Пока задача ждет, ее слот отдается быстрым задачам.
+        """
+        if self.full_parsing_lock.locked():
+            logger.info(f"⏳ Задача {task_id}: полный обход уже выполняется, ждем его завершения")
+            self.task_slots.release()
+            try:
+                await self.full_parsing_lock.acquire()
+            finally:
+                # Слот освобождается в handle_task - занимаем его обратно
+                await self.task_slots.acquire()
+        else:
+            await self.full_parsing_lock.acquire()
+        try:
+            yield
+        finally:
+            self.full_parsing_lock.release()
+
     async def run_fast_parsing(self, task: Dict[str, Any]) -> Optional[pd.DataFrame]:
         """Быстрый парсинг по геолокации"""
         coordinates = task.get("coordinates", {})
@@ -250,12 +329,15 @@ class ParsingWorker:
             city = "Москва"
             coords = f"{lat},{lon}"
 
-            products = await self.parser.scrape_fast(
-                city=city,
-                coords=coords,
-                address=address,
-                limit=1500
-            )
+            # Своя сессия (cookies и локация) на координаты: параллельные задачи
+            # не мешают друг другу, повторный адрес не выставляет локацию заново
+            async with self.antibot_client.lease(coords):
+                products = await self.parser.scrape_fast(
+                    city=city,
+                    coords=coords,
+                    address=address,
+                    limit=1500
+                )
 
             if products:
                 df = pd.DataFrame(products)
@@ -267,30 +349,60 @@ class ParsingWorker:
                     return self.base_df.head(100)
                 return pd.DataFrame()
 
+        except SiteBlocked:
+            raise
         except Exception as e:
             logger.error(f"Ошибка быстрого парсинга: {e}")
             if self.base_df is not None:
                 return self.base_df.head(100)
             raise
 
-    async def run_full_parsing(self) -> Optional[pd.DataFrame]:
-        """Полный парсинг всех продуктов"""
+    async def run_full_parsing(self, incremental: bool = True, budget: Optional[int] = None) -> Optional[pd.DataFrame]:
+        """Полный парсинг всех продуктов.
+
+        incremental - карточки загружаются только для новых и изменившихся
+        товаров, остальное переносится из базового файла.
+        budget - не больше budget карточек за обход, по расписанию обновления.
+        """
         logger.info("🔄 Запуск полного парсинга...")
 
+        journal = None
         try:
             # Динамический импорт с обработкой ошибок
             try:
-                from moscow_improved import VkusvillHeavyParser
+                from moscow_improved import (CRAWL_JOURNAL_MAX_AGE, CRAWL_JOURNAL_PATH, CrawlJournal,
+                                             VkusvillHeavyParser, load_snapshot)
+                from refresh import FRESHNESS_PATH, FreshnessStore, RefreshScheduler
             except ImportError:
                 # Если moscow_improved недоступен, используем moscow
                 try:
                     from moscow import VkusvillHeavyParser
+                    load_snapshot = CrawlJournal = RefreshScheduler = None
                 except ImportError:
                     logger.error("Не найден модуль для тяжелого парсинга")
                     return self.base_df
 
             heavy_parser = VkusvillHeavyParser(self.antibot_client)
-            products = await heavy_parser.scrape_heavy(limit=1500)
+            previous = None
+            if incremental and load_snapshot and self.base_csv_path:
+                previous = load_snapshot(str(self.base_csv_path)) or None
+            # После перезапуска воркера обход продолжается по журналу, если он
+            # не старше периода обновления (без расписания - суток)
+            if CrawlJournal:
+                journal = CrawlJournal(str(Path(__file__).parent / CRAWL_JOURNAL_PATH))
+                refresh_every = float(os.getenv("REFRESH_EVERY", "0"))
+                journal.open(resume=True, max_age=refresh_every or CRAWL_JOURNAL_MAX_AGE)
+            scheduler = None
+            if budget is not None and RefreshScheduler:
+                store = FreshnessStore.load(os.getenv("FRESHNESS_PATH", str(Path(__file__).parent / FRESHNESS_PATH)))
+                scheduler = RefreshScheduler(store, budget)
+            if previous or journal:
+                if previous:
+                    logger.info(f"🧷 Инкрементальный парсинг от {self.base_csv_path}")
+                products = await heavy_parser.scrape_heavy(limit=1500, previous=previous, journal=journal,
+                                                           scheduler=scheduler)
+            else:
+                products = await heavy_parser.scrape_heavy(limit=1500)
 
             if products:
                 df = pd.DataFrame(products)
@@ -302,6 +414,9 @@ class ParsingWorker:
                 new_csv_path = data_path / f"moscow_improved_{timestamp}.csv"
                 df.to_csv(new_csv_path, index=False, encoding='utf-8')
                 logger.info(f"💾 Сохранено в {new_csv_path}")
+                if journal:
+                    # Результат сохранен - следующий обход начнется с нуля
+                    journal.finish()
 
                 self.base_df = df
                 self.base_csv_path = new_csv_path
@@ -316,11 +431,48 @@ class ParsingWorker:
                 logger.warning("Полный парсинг не вернул результатов")
                 return self.base_df
 
+        except SiteBlocked:
+            raise
         except Exception as e:
             logger.error(f"Ошибка полного парсинга: {e}")
             import traceback
             traceback.print_exc()
             return self.base_df
+        finally:
+            if journal:
+                # Незавершенный журнал остается для продолжения после перезапуска
+                journal.close()
+
+    async def handle_task(self, task_json: str):
+        """Обработка задачи и сохранение результата в Redis."""
+        task = {}
+        try:
+            task = json.loads(task_json)
+            result = await self.process_task(task)
+
+            if result:
+                task_id = task.get("task_id")
+                result_key = f"{self.results_queue_prefix}{task_id}"
+
+                await self.ensure_redis_connection()
+                await self.redis.set(
+                    result_key,
+                    json.dumps(result),
+                    ex=300
+                )
+
+                logger.info(f"📤 Результат сохранен: {result_key}")
+
+            if str(task.get("task_id", "")).startswith("refresh_"):
+                # Обновление завершено - планировщик может ставить следующее
+                await self.ensure_redis_connection()
+                await self.redis.delete("parser:refresh_pending")
+
+        except Exception as e:
+            logger.error(f"Ошибка сохранения результата задачи {task.get('task_id')}: {e}")
+
+        finally:
+            self.task_slots.release()
 
     async def run(self):
         """Основной цикл с улучшенной обработкой ошибок"""
@@ -329,6 +481,11 @@ class ParsingWorker:
         # Запускаем heartbeat в фоне
         asyncio.create_task(self.send_heartbeat())
 
+        # REFRESH_EVERY=N (секунд) - непрерывное обновление карточек с бюджетом REFRESH_BUDGET
+        refresh_every = float(os.getenv("REFRESH_EVERY", "0"))
+        if refresh_every > 0:
+            asyncio.create_task(self.schedule_refresh(refresh_every, int(os.getenv("REFRESH_BUDGET", "300"))))
+
         consecutive_errors = 0
         max_consecutive_errors = 10
 
@@ -336,30 +493,26 @@ class ParsingWorker:
             try:
                 await self.ensure_redis_connection()
 
-                # Блокирующее чтение из очереди
-                result = await self.redis.brpop(["parsing_queue"], timeout=5)
+                # Берем задачу из очереди, только когда есть свободный слот
+                await self.task_slots.acquire()
+                try:
+                    # Блокирующее чтение из очереди
+                    result = await self.redis.brpop(["parsing_queue"], timeout=5)
+                except BaseException:
+                    self.task_slots.release()
+                    raise
 
                 if result:
                     _, task_json = result
-                    task = json.loads(task_json)
 
-                    # Обрабатываем задачу
-                    result = await self.process_task(task)
-
-                    if result:
-                        task_id = task.get("task_id")
-                        result_key = f"{self.results_queue_prefix}{task_id}"
-
-                        await self.ensure_redis_connection()
-                        await self.redis.set(
-                            result_key,
-                            json.dumps(result),
-                            ex=300
-                        )
-
-                        logger.info(f"📤 Результат сохранен: {result_key}")
+                    # Обрабатываем задачу в фоне, цикл сразу ждет следующую
+                    job = asyncio.create_task(self.handle_task(task_json))
+                    self.active_tasks.add(job)
+                    job.add_done_callback(self.active_tasks.discard)
+                else:
+                    self.task_slots.release()
 
-                    consecutive_errors = 0
+                consecutive_errors = 0
 
             except asyncio.TimeoutError:
                 # Таймаут - это нормально
@@ -0,0 +1,180 @@
+"""
+refresh.py - Планировщик обновления карточек по наблюдаемой частоте изменений.
+
+Цены и наличие готовой еды меняются каждый день, состав и БЖУ - почти никогда.
+FreshnessStore хранит для каждого товара, когда карточка загружалась и когда
+менялась, и сколько раз менялось каждое поле. Интервал обновления товара
+удваивается после каждой загрузки без изменений (до max_interval) и
+сокращается вдвое, когда карточка изменилась.
+
+RefreshScheduler выбирает, какие карточки загрузить за один обход в пределах
+бюджета запросов: сначала новые товары, затем товары с изменившимися в
+каталоге названием или ценой, записи с пустыми полями и часто менявшиеся
+товары, у которых подошел срок. Остальные записи переносятся из прошлого
+обхода без запроса.
+"""
+
+import json
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+# Поля записи, изменения которых учитываются
+TRACKED_FIELDS = (
+    'name', 'price', 'photo', 'composition', 'portion_g',
+    'kcal_100g', 'protein_100g', 'fat_100g', 'carb_100g',
+)
+NUTRITION_FIELDS = ('kcal_100g', 'protein_100g', 'fat_100g', 'carb_100g')
+
+DAY = 24 * 3600
+
+# Метаданные свежести между обходами (FRESHNESS_PATH переопределяет путь)
+FRESHNESS_PATH = "data/freshness.json"
+
+
+class FreshnessStore:
+    """Метаданные свежести по id товара, JSON-файл между запусками."""
+
+    def __init__(self, path: Optional[str] = None, min_interval: float = DAY, max_interval: float = 32 * DAY):
+        self.path = path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # id -> {first_seen, last_fetched, last_changed, interval, fetches,
+        #        changes: {поле: {'count': изменений, 'last': когда}}}
+        self.items: Dict[str, Dict] = {}
+
+    @classmethod
+    def load(cls, path: Optional[str], **kwargs) -> 'FreshnessStore':
+        store = cls(path, **kwargs)
+        if not path or not os.path.exists(path):
+            return store
+        try:
+            with open(path, encoding='utf-8') as f:
+                store.items = json.load(f).get('items', {})
+        except (OSError, ValueError):
+            store.items = {}
+        return store
+
+    def save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'items': self.items}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def observe(self, product_id: str, record: Dict, old: Optional[Dict], now: Optional[float] = None) -> List[str]:
+        """Учесть загруженную карточку; вернуть изменившиеся поля."""
+        now = now or time.time()
+        item = self.items.get(product_id)
+        if item is None:
+            item = self.items[product_id] = {
+                'first_seen': now, 'last_fetched': None, 'last_changed': None,
+                'interval': self.min_interval, 'fetches': 0, 'changes': {},
+            }
+        changed = []
+        if old is not None:
+            changed = [field for field in TRACKED_FIELDS
+                       if str(record.get(field) or '') != str(old.get(field) or '')]
+        item['fetches'] += 1
+        item['last_fetched'] = now
+        if changed:
+            item['last_changed'] = now
+            for field in changed:
+                history = item['changes'].setdefault(field, {'count': 0, 'last': None})
+                history['count'] += 1
+                history['last'] = now
+            item['interval'] = max(self.min_interval, item['interval'] / 2)
+        elif old is not None:
+            # Без изменений - следующая проверка вдвое позже
+            item['interval'] = min(self.max_interval, item['interval'] * 2)
+        return changed
+
+    def volatility(self, product_id: str) -> float:
+        """Доля загрузок, на которых карточка менялась (0..1)."""
+        item = self.items.get(product_id)
+        if not item or not item['fetches']:
+            return 0.0
+        changed_fetches = max((history['count'] for history in item['changes'].values()), default=0)
+        return min(changed_fetches / item['fetches'], 1.0)
+
+    def overdue(self, product_id: str, now: Optional[float] = None) -> Optional[float]:
+        """Насколько просрочено обновление в интервалах (< 0 - еще рано, None - не загружалась)."""
+        item = self.items.get(product_id)
+        if not item or not item['last_fetched']:
+            return None
+        now = now or time.time()
+        return (now - item['last_fetched']) / item['interval'] - 1
+
+
+class RefreshScheduler:
+    """Выбор карточек для загрузки в пределах бюджета запросов на обход.
+
+    Бюджет расходуется, когда загрузка карточки действительно начинается:
+    новые товары (admit_new) идут в загрузку первыми, пока есть бюджет.
+    Известные товары становятся кандидатами (offer), если изменилась
+    плитка в каталоге, в записи пусто или подошел срок; после обхода
+    каталога кандидаты упорядочиваются по приоритету (select) и получают
+    оставшийся бюджет (admit_due), прочие переносятся из прошлого обхода.
+    """
+
+    def __init__(self, store: FreshnessStore, budget: Optional[int] = None):
+        self.store = store
+        self.budget = budget
+        self.used = 0
+        self.candidates: List[Tuple[float, int, object]] = []
+        # not_due - известные товары, перенесенные без загрузки: срок обновления не подошел
+        self.stats = {'budget': budget, 'new': 0, 'new_skipped': 0, 'due': 0, 'not_due': 0,
+                      'fetched': 0, 'carried': 0}
+
+    def take(self) -> bool:
+        """Занять запрос из бюджета (False - бюджет исчерпан)."""
+        if self.budget is not None and self.used >= self.budget:
+            return False
+        self.used += 1
+        return True
+
+    def admit_new(self) -> bool:
+        """Начать загрузку нового товара (False - бюджет исчерпан, ждет следующего обхода)."""
+        if self.take():
+            self.stats['new'] += 1
+            return True
+        self.stats['new_skipped'] += 1
+        return False
+
+    def priority(self, product_id: str, record: Dict, listing_changed: bool, now: Optional[float] = None) -> Optional[float]:
+        """Приоритет загрузки известного товара; None - загружать не нужно."""
+        incomplete = not record.get('name') or not all(record.get(field) for field in NUTRITION_FIELDS)
+        overdue = self.store.overdue(product_id, now)
+        if listing_changed:
+            return 3.0
+        if overdue is None:
+            # Товар из снимка, которого еще нет в метаданных: срок считаем подошедшим
+            overdue = 0.0
+        if overdue < 0:
+            self.stats['not_due'] += 1
+            return None
+        # Пустые поля важнее, часто менявшиеся - раньше стабильных
+        return (2.0 if incomplete else 1.0) + self.store.volatility(product_id) + min(overdue, 1.0) / 10
+
+    def offer(self, priority: float, item):
+        self.stats['due'] += 1
+        self.candidates.append((priority, len(self.candidates), item))
+
+    def admit_due(self) -> bool:
+        """Начать загрузку кандидата (False - бюджет исчерпан, запись переносится)."""
+        if self.take():
+            self.stats['fetched'] += 1
+            return True
+        self.stats['carried'] += 1
+        return False
+
+    def select(self) -> List:
+        """Кандидаты по убыванию приоритета; бюджет на них тратит admit_due."""
+        self.candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+        ranked = [item for _, _, item in self.candidates]
+        self.candidates = []
+        return ranked
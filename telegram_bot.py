@@ -72,8 +72,8 @@ class VkusvillSimpleBot:
 • Качество: 95%+ БЖУ данных
 
 🔍 **Глубокий парсер** `/deep`
-• Формат: `/deep количество`
-• Время: 15-40 минут
+• Формат: `/deep количество [full]`
+• Время: несколько минут (только новые и изменившиеся товары), `full` - 15-40 минут
 • Качество: 91%+ БЖУ данных
 
 📍 **Способы указания места:**
@@ -187,18 +187,23 @@ class VkusvillSimpleBot:
                 await update.message.reply_text("❌ Количество должно быть числом!")
                 return
             
+            # full - все карточки заново, иначе только новые и изменившиеся
+            full = len(context.args) > 1 and context.args[1].lower() == "full"
+            
             # Отправляем сообщение о начале
             status_msg = await update.message.reply_text(
                 f"🔍 **ГЛУБОКИЙ ПАРСИНГ ЗАПУЩЕН**\n\n"
                 f"🎯 Товаров: {limit}\n"
-                f"⏱️ Время: 15-40 минут\n"
-                f"🔄 Парсим сайт заново...",
+                + ("⏱️ Время: 15-40 минут\n"
+                   "🔄 Парсим сайт заново..." if full else
+                   "⏱️ Время: несколько минут\n"
+                   "🔄 Загружаем только новые и изменившиеся товары..."),
                 parse_mode='Markdown'
             )
             
             # Запуск глубокого парсера
             start_time = time.time()
-            result = await self._run_deep_parser(limit)
+            result = await self._run_deep_parser(limit, incremental=not full)
             end_time = time.time()
             
             if result['success']:
@@ -361,10 +366,12 @@ class VkusvillSimpleBot:
         except Exception as e:
             return {'success': False, 'error': str(e)}
     
-    async def _run_deep_parser(self, limit: int) -> dict:
+    async def _run_deep_parser(self, limit: int, incremental: bool = True) -> dict:
         """Запуск глубокого парсера moscow_improved.py."""
         try:
             cmd = [sys.executable, "moscow_improved.py", str(limit)]
+            if incremental:
+                cmd.append("--incremental")
             
             # Запуск процесса
             process = await asyncio.create_subprocess_exec(
@@ -0,0 +1,415 @@
+"""Механизмы AntiBotClient по отдельности, без сети."""
+
+import asyncio
+import time
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+
+from antibot import (  # noqa: E402
+    CHALLENGE_MAX_BYTES, AIMDConcurrencyController, AntiBotClient, ChallengeCircuit, ChallengeDetected,
+    SiteBlocked, TokenBucket, detect_challenge,
+)
+
+
+FAST_LIMITS = {'catalog': (1000.0, 100), 'card': (1000.0, 100), 'ajax': (1000.0, 100)}
+CARD = "https://vkusvill.ru/goods/sup-1.html"
+
+
+def _saturate(controller):
+    """Занять все слоты контроллера (без ожидания)."""
+    return [time.monotonic() for _ in range(int(controller.limit))]
+
+
+def test_limit_grows_additively_only_when_saturated_and_healthy():
+    controller = AIMDConcurrencyController(initial_limit=4, max_limit=6)
+    # Лимит не используется полностью - не растет
+    controller.in_flight = 1
+    controller.release(time.monotonic(), 'ok', latency=0.1)
+    assert controller.limit == 4
+    # Около limit успешных ответов при полной загрузке добавляют один слот
+    for _ in range(5):
+        controller.in_flight = int(controller.limit)
+        controller.release(time.monotonic(), 'ok', latency=0.1)
+    assert int(controller.limit) == 5
+    for _ in range(100):
+        controller.in_flight = int(controller.limit)
+        controller.release(time.monotonic(), 'ok', latency=0.1)
+    assert controller.limit == 6
+
+
+def test_slow_responses_stop_growth():
+    controller = AIMDConcurrencyController(initial_limit=4)
+    controller.in_flight = 4
+    controller.release(time.monotonic(), 'ok', latency=0.1)
+    before = controller.limit
+    for _ in range(20):
+        controller.in_flight = int(controller.limit)
+        controller.release(time.monotonic(), 'ok', latency=1.0)
+    assert controller.limit == before
+
+
+def test_overload_halves_limit_once_per_wave_and_pauses():
+    controller = AIMDConcurrencyController(initial_limit=16, min_limit=2)
+    started = _saturate(controller)
+    controller.in_flight = len(started)
+    controller.release(started[0], 'throttled', retry_after=3)
+    assert controller.limit == 8
+    # Запросы той же волны уже учтены в снижении
+    for moment in started[1:]:
+        controller.release(moment, 'timeout')
+    assert controller.limit == 8
+    assert controller.stats['decreases'] == 1
+    assert controller.metrics()['paused_for'] >= 2.9
+    # Новые перегрузки не опускают лимит ниже минимального
+    for _ in range(5):
+        controller.in_flight += 1
+        controller.release(time.monotonic(), 'throttled')
+    assert controller.limit == 2
+
+
+def test_challenge_lowers_limit_without_pause_and_errors_keep_it():
+    controller = AIMDConcurrencyController(initial_limit=8)
+    controller.in_flight = 2
+    controller.release(time.monotonic(), 'error')
+    assert controller.limit == 8
+    controller.release(time.monotonic(), 'challenge')
+    assert controller.limit == 4
+    assert controller.metrics()['paused_for'] == 0
+
+
+def test_acquire_waits_for_free_slot():
+    async def scenario():
+        controller = AIMDConcurrencyController(initial_limit=2, min_limit=2)
+        first = await controller.acquire()
+        await controller.acquire()
+        waiting = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        assert controller.metrics()['waiting'] == 1
+        controller.release(first, 'ok', latency=0.01)
+        await asyncio.wait_for(waiting, 1)
+        return controller.in_flight
+
+    assert asyncio.run(scenario()) == 2
+
+
+def test_cancelled_waiter_passes_slot_on():
+    async def scenario():
+        controller = AIMDConcurrencyController(initial_limit=2, min_limit=2)
+        started = [await controller.acquire(), await controller.acquire()]
+        cancelled = asyncio.ensure_future(controller.acquire())
+        waiting = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0.01)
+        controller.release(started[0], 'ok', latency=0.01)
+        # Разбуженный ожидающий отменен до того, как занял слот
+        cancelled.cancel()
+        await asyncio.wait_for(waiting, 1)
+        return controller.in_flight
+
+    assert asyncio.run(scenario()) == 2
+
+
+def test_token_bucket_allows_burst_then_paces_at_rate():
+    async def scenario():
+        bucket = TokenBucket(rate=50, burst=3)
+        started = time.monotonic()
+        for _ in range(3):
+            await bucket.acquire()
+        burst = time.monotonic() - started
+        for _ in range(5):
+            await bucket.acquire()
+        return burst, time.monotonic() - started, bucket.metrics()
+
+    burst, total, metrics = asyncio.run(scenario())
+    assert burst < 0.01
+    # Пять запросов сверх пачки при 50 в секунду - около 0.1 с
+    assert 0.08 <= total < 0.3
+    assert metrics['waits'] == 5
+
+
+def test_token_bucket_serves_concurrent_waiters_in_turn():
+    async def scenario():
+        bucket = TokenBucket(rate=100, burst=1)
+        done = []
+
+        async def request(n):
+            await bucket.acquire()
+            done.append((n, time.monotonic()))
+
+        started = time.monotonic()
+        await asyncio.gather(*(request(n) for n in range(5)))
+        return started, done
+
+    started, done = asyncio.run(scenario())
+    assert [n for n, _ in done] == [0, 1, 2, 3, 4]
+    # Токены зарезервированы по очереди: четвертый ожидающий ждет ~40 мс
+    assert done[-1][1] - started >= 0.035
+
+
+def test_cancelled_wait_returns_token():
+    async def scenario():
+        bucket = TokenBucket(rate=10, burst=1)
+        await bucket.acquire()
+        waiting = asyncio.ensure_future(bucket.acquire())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        return bucket.tokens
+
+    # Отмененный запрос не держит резерв: долг только за выданный токен
+    assert asyncio.run(scenario()) > -0.5
+
+
+def test_client_keeps_bucket_per_host_and_endpoint():
+    client = AntiBotClient(rate_limits={'card': (7.0, 2)})
+    card = client._bucket("https://vkusvill.ru/goods/sup-1.html")
+    assert card is client._bucket("https://vkusvill.ru/goods/salat-2.html")
+    assert (card.rate, card.capacity) == (7.0, 2)
+    assert client._bucket("https://vkusvill.ru/goods/gotovaya-eda/") is not card
+    assert client._bucket("https://img.vkusvill.ru/goods/sup-1.html") is not card
+
+
+class SlowFirst:
+    """Первый запрос отвечает через slow секунд, остальные - через fast."""
+
+    def __init__(self, slow=0.5, fast=0.01):
+        self.slow = slow
+        self.fast = fast
+        self.requests = 0
+
+    async def __call__(self, request):
+        self.requests += 1
+        number = self.requests
+        await asyncio.sleep(self.slow if number == 1 else self.fast)
+        return httpx.Response(200, text=f"ответ {number}")
+
+
+def _hedging_client(site, samples=20, **kwargs):
+    client = AntiBotClient(rate_limits=FAST_LIMITS, hedge=True, **kwargs)
+    client.transport = httpx.MockTransport(site)
+    for _ in range(samples):
+        client._record_latency('card', 0.02)
+    return client
+
+
+def _run_requests(client, count=1):
+    async def scenario():
+        try:
+            return [await client.request("GET", CARD) for _ in range(count)]
+        finally:
+            await client.close()
+
+    return asyncio.run(scenario())
+
+
+def test_slow_card_is_hedged_and_the_faster_answer_wins():
+    site = SlowFirst()
+    client = _hedging_client(site, hedge_budget=1.0)
+    started = time.monotonic()
+    [response] = _run_requests(client)
+    assert time.monotonic() - started < 0.3
+    assert response.text == "ответ 2"
+    stats = client.hedge_stats
+    assert (stats['requests'], stats['hedged'], stats['hedge_wins']) == (1, 1, 1)
+    # Основной запрос был в пути ~0.06 с, дубль ответил за ~0.01 с
+    assert 0 < stats['saved_seconds'] < 0.2
+
+
+def test_no_hedge_until_latency_is_known():
+    site = SlowFirst(slow=0.1)
+    client = _hedging_client(site, samples=5, hedge_budget=1.0)
+    [response] = _run_requests(client)
+    assert response.text == "ответ 1"
+    assert client.hedge_stats['hedged'] == 0
+    assert site.requests == 1
+
+
+def test_hedges_stay_within_budget():
+    site = SlowFirst(slow=0.2, fast=0.2)
+    client = _hedging_client(site, hedge_budget=0.25)
+    _run_requests(client, count=4)
+    # Не больше четверти запросов получают дубль
+    assert client.hedge_stats['requests'] == 4
+    assert client.hedge_stats['hedged'] == 1
+
+
+def test_only_selected_endpoints_are_hedged():
+    site = SlowFirst(slow=0.2)
+    client = _hedging_client(site, hedge_budget=1.0)
+
+    async def scenario():
+        try:
+            return await client.request("GET", "https://vkusvill.ru/goods/gotovaya-eda/")
+        finally:
+            await client.close()
+
+    asyncio.run(scenario())
+    assert client.hedge_stats['requests'] == 0
+    assert site.requests == 1
+
+
+def _page(text="<html>каталог</html>", status=200, url="https://vkusvill.ru/goods/", **headers):
+    headers.setdefault('content-type', 'text/html; charset=utf-8')
+    return httpx.Response(status, headers=headers, text=text, request=httpx.Request("GET", url))
+
+
+@pytest.mark.parametrize("response, reason", [
+    (_page(**{'cf-mitigated': 'challenge'}), 'cloudflare'),
+    (_page(status=503, server='DDoS-Guard'), 'ddos-guard'),
+    (_page(url="https://vkusvill.ru/captcha/?back=/goods/"), 'redirect:captcha'),
+    (_page(status=403), 'http-403'),
+    (_page("<html><h1>Проверка браузера</h1></html>"), 'проверка браузера'),
+    (_page("<script>document.cookie='t=1'; location.reload()</script>"), 'js-challenge'),
+])
+def test_detect_challenge(response, reason):
+    assert detect_challenge(response) == reason
+
+
+def test_large_page_mentioning_captcha_is_not_a_challenge():
+    assert detect_challenge(_page("<html>captcha " + "x" * CHALLENGE_MAX_BYTES + "</html>")) is None
+    assert detect_challenge(_page(status=503)) is None
+
+
+def test_circuit_opens_after_threshold_and_closes_on_good_probe():
+    async def scenario():
+        circuit = ChallengeCircuit(threshold=2, backoff=0.05)
+        circuit.record('challenge', 'captcha')
+        assert circuit.state == 'closed' and not await circuit.wait()
+        circuit.record('challenge', 'captcha')
+        assert circuit.state == 'open'
+        started = time.monotonic()
+        # После паузы проходит один пробный запрос
+        assert await circuit.wait()
+        waited = time.monotonic() - started
+        circuit.record('ok', probe=True)
+        return circuit, waited
+
+    circuit, waited = asyncio.run(scenario())
+    assert waited >= 0.04
+    assert circuit.state == 'closed'
+    assert circuit.metrics()['trips'] == 1 and circuit.trips_in_row == 0
+
+
+def test_failed_probe_doubles_pause_until_blocked():
+    async def scenario():
+        circuit = ChallengeCircuit(threshold=1, backoff=0.01, max_trips=2, block_cooldown=60)
+        circuit.record('challenge', 'qrator')
+        pauses = [circuit.stats['paused_seconds']]
+        assert await circuit.wait()
+        circuit.record('challenge', 'qrator', probe=True)
+        pauses.append(circuit.stats['paused_seconds'] - pauses[0])
+        assert await circuit.wait()
+        circuit.record('challenge', 'qrator', probe=True)
+        assert circuit.state == 'blocked'
+        with pytest.raises(SiteBlocked):
+            await circuit.wait()
+        return pauses
+
+    assert asyncio.run(scenario()) == pytest.approx([0.01, 0.02])
+
+
+def test_requests_wait_for_probe_result():
+    async def scenario():
+        circuit = ChallengeCircuit(threshold=1, backoff=0.01)
+        circuit.record('challenge', 'captcha')
+        assert await circuit.wait()
+        waiting = asyncio.ensure_future(circuit.wait())
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        # Проба без ответа: следующий запрос становится пробным
+        circuit.record('timeout', probe=True)
+        return await asyncio.wait_for(waiting, 1)
+
+    assert asyncio.run(scenario()) is True
+
+
+def test_client_stops_requests_while_site_challenges():
+    pages = []
+
+    def site(request):
+        pages.append(request.url.path)
+        return _page("<html>Вы не робот?</html>")
+
+    client = AntiBotClient(rate_limits=FAST_LIMITS, max_retries=0)
+    client.transport = httpx.MockTransport(site)
+    client.challenge_circuit = ChallengeCircuit(threshold=2, backoff=60)
+
+    async def scenario():
+        try:
+            for _ in range(2):
+                with pytest.raises(ChallengeDetected):
+                    await client.request("GET", CARD)
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(client.request("GET", CARD), 0.1)
+        finally:
+            await client.close()
+
+    asyncio.run(scenario())
+    assert len(pages) == 2
+    assert client.metrics()['challenge']['state'] == 'open'
+
+
+class CookieSite:
+    """Ставит cookie с координатами из запроса и возвращает cookie, присланную клиентом."""
+
+    def __call__(self, request):
+        coords = request.url.params.get("coords")
+        if coords:
+            return httpx.Response(200, headers={'Set-Cookie': f'location={coords}; Path=/'}, text="ok")
+        return httpx.Response(200, text=request.headers.get('cookie', ''))
+
+
+def test_lease_shares_session_per_location_and_isolates_cookies():
+    client = AntiBotClient(rate_limits=FAST_LIMITS)
+    client.transport = httpx.MockTransport(CookieSite())
+
+    async def visit(coords, seen):
+        async with client.lease(coords) as session:
+            await client.request("GET", f"https://vkusvill.ru/ajax/location/?coords={coords}")
+            await asyncio.sleep(0.01)
+            response = await client.request("GET", "https://vkusvill.ru/ajax/check/")
+            assert client.location_key == coords
+            seen.append((session, response.text))
+
+    async def scenario():
+        seen = []
+        try:
+            await asyncio.gather(visit("55.75,37.61", seen), visit("59.93,30.33", seen),
+                                 visit("55.75,37.61", seen))
+            # Вне lease() запросы идут через общую сессию
+            assert client.session is client.default_session
+        finally:
+            await client.close()
+        return seen
+
+    seen = asyncio.run(scenario())
+    cookies = {session.key: text for session, text in seen}
+    assert cookies == {"55.75,37.61": "location=55.75,37.61", "59.93,30.33": "location=59.93,30.33"}
+    moscow = [session for session, _ in seen if session.key == "55.75,37.61"]
+    assert moscow[0] is moscow[1]
+    assert client.session_stats == {'created': 2, 'reused': 1, 'evicted': 0}
+
+
+def test_only_free_sessions_are_evicted():
+    client = AntiBotClient(max_sessions=2)
+
+    async def scenario():
+        async with client.lease("a") as held:
+            async with client.lease("b"):
+                pass
+            async with client.lease("c"):
+                pass
+            async with client.lease("d"):
+                pass
+            # Занятая сессия "a" самая давняя, но не вытесняется
+            assert list(client.sessions) == ["a", "d"]
+            assert client.sessions["a"] is held
+        async with client.lease("e"):
+            pass
+        return list(client.sessions)
+
+    assert asyncio.run(scenario()) == ["d", "e"]
+    assert client.session_stats == {'created': 5, 'reused': 0, 'evicted': 3}
@@ -0,0 +1,82 @@
+"""Кэш доступности по ячейкам геосетки: ключи, TTL, устаревшие записи, хранилища."""
+
+import asyncio
+import json
+import time
+
+import pytest
+
+from availability import AvailabilityCache, geohash
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_geohash_matches_reference():
+    assert geohash(57.64911, 10.40744, precision=11) == "u4pruydqqvj"
+
+
+def test_neighbouring_addresses_share_cell(tmp_path):
+    cache = AvailabilityCache(cache_dir=str(tmp_path))
+    assert cache.cell("55.7558,37.6176") == cache.cell("55.7560, 37.6180") == "ucfv0n"
+    assert cache.cell("55.80,37.70") != "ucfv0n"
+    assert AvailabilityCache(cache_dir=str(tmp_path), precision=4).cell("55.7558,37.6176") == "ucfv"
+
+
+def test_fresh_stale_and_expired_entries(tmp_path):
+    cache = AvailabilityCache(cache_dir=str(tmp_path), ttl=60, max_stale=600)
+    now = time.time()
+    run(cache.put("fresh", ["1", "2"]))
+    run(cache.put("stale", ["3"], ts=now - 300))
+    run(cache.put("expired", ["4"], ts=now - 700))
+
+    ids, age, ts = run(cache.get("fresh"))
+    assert ids == ["1", "2"] and age < 60 and ts >= now
+    # Устаревшая запись отдается вместе с возрастом и исходным временем проверки
+    ids, age, ts = run(cache.get("stale"))
+    assert ids == ["3"] and age >= 300 and ts == pytest.approx(now - 300)
+    assert run(cache.get("expired")) is None
+    assert run(cache.get("missing")) is None
+    assert cache.stats == {'hits': 1, 'stale': 1, 'misses': 2, 'stored': 3, 'errors': 0}
+
+
+def test_broken_file_is_a_miss(tmp_path):
+    cache = AvailabilityCache(cache_dir=str(tmp_path))
+    (tmp_path / "ucfv0n.json").write_text("{не json", encoding='utf-8')
+    assert run(cache.get("ucfv0n")) is None
+    assert cache.stats['errors'] == 1 and cache.stats['misses'] == 1
+
+
+class FakeRedis:
+    """Асинхронный клиент с get/set, как у redis.asyncio."""
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.data[key] = value
+        self.expires[key] = ex
+
+
+def test_redis_storage_expires_with_stale_window(tmp_path):
+    redis = FakeRedis()
+    cache = AvailabilityCache(redis=redis, cache_dir=str(tmp_path), ttl=60, max_stale=600)
+    run(cache.put("ucfv0n", ["1"], ts=123.0))
+    assert json.loads(redis.data["availability:ucfv0n"]) == {'ids': ["1"], 'ts': 123.0}
+    assert redis.expires["availability:ucfv0n"] == 660
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_from_env(tmp_path, monkeypatch):
+    monkeypatch.setenv("AVAILABILITY_CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("AVAILABILITY_TTL", "120")
+    monkeypatch.setenv("AVAILABILITY_MAX_STALE", "0")
+    monkeypatch.setenv("AVAILABILITY_CELL_PRECISION", "5")
+    cache = AvailabilityCache.from_env()
+    assert (str(cache.cache_dir), cache.ttl, cache.max_stale, cache.precision) == (str(tmp_path), 120, 0, 5)
+    assert cache.cell("55.7558,37.6176") == "ucfv0"
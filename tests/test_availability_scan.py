@@ -0,0 +1,269 @@
+"""Проверка доступности по каталогу: порядок, условия остановки, ошибки категорий."""
+
+import asyncio
+import time
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+pytest.importorskip("selectolax.parser")
+
+from address import AVAILABILITY_CATEGORIES, VkusvillFastParser  # noqa: E402
+from antibot import AntiBotClient  # noqa: E402
+
+FAST_LIMITS = {'catalog': (1000.0, 100), 'card': (1000.0, 100), 'ajax': (1000.0, 100)}
+
+
+class FakeCatalog:
+    """Каталог для httpx.MockTransport: категория -> страницы со списками ID.
+
+    Страница за последней отдается пустой (repeat_last=True - повторяет
+    последнюю, как делает Битрикс). paginate - показывать ссылки пагинации.
+    Ответ приходит через delay секунд: requests - начатые запросы, served -
+    дождавшиеся ответа (отмененные в него не попадают).
+    """
+
+    def __init__(self, pages, paginate=False, repeat_last=False, status=None, challenge=(), delay=0.01):
+        self.pages = pages
+        self.paginate = paginate
+        self.repeat_last = repeat_last
+        # категория -> HTTP статус ответа
+        self.status = status or {}
+        self.challenge = set(challenge)
+        self.delay = delay
+        self.requests = []
+        self.served = []
+
+    async def __call__(self, request):
+        category = request.url.path
+        page = int(request.url.params.get("page", "1"))
+        self.requests.append((category, page))
+        await asyncio.sleep(self.delay)
+        self.served.append((category, page))
+        return self._respond(category, page)
+
+    def _respond(self, category, page):
+        if category in self.status:
+            return httpx.Response(self.status[category], text="ошибка")
+        if category in self.challenge:
+            return httpx.Response(403, headers={'cf-mitigated': 'challenge'}, text="проверка")
+        pages = self.pages.get(category, [])
+        if page > len(pages):
+            if not (self.repeat_last and pages):
+                return httpx.Response(200, text="<html><p>Товаров нет</p></html>")
+            page = len(pages)
+        links = "".join(f'<a href="/goods/{product_id}.html">товар</a>' for product_id in pages[page - 1])
+        pagination = ""
+        if self.paginate:
+            pagination = "".join(f'<a href="{category}?PAGEN_1={n}">{n}</a>' for n in range(1, len(pages) + 1))
+        return httpx.Response(200, text=f"<html>{links}{pagination}</html>")
+
+
+@pytest.fixture
+def make_parser(tmp_path, monkeypatch):
+    monkeypatch.setenv("CATEGORY_YIELD_PATH", str(tmp_path / "category_yield.json"))
+    monkeypatch.setenv("AVAILABILITY_CACHE_DIR", str(tmp_path / "availability"))
+    clients = []
+
+    def make(catalog):
+        client = AntiBotClient(rate_limits=FAST_LIMITS)
+        client.transport = httpx.MockTransport(catalog)
+        clients.append(client)
+        return VkusvillFastParser(client)
+
+    yield make
+    for client in clients:
+        asyncio.run(client.close())
+
+
+def scan(parser, categories, window=None, failures=None, stop_after=None):
+    """События обхода: (категория, новые ID, завершена); stop_after - прервать после N событий."""
+
+    async def run():
+        events = []
+        generator = parser._iter_available_products(categories, window, failures)
+        try:
+            async for event in generator:
+                events.append(event)
+                if stop_after is not None and len(events) >= stop_after:
+                    break
+        finally:
+            await generator.aclose()
+        return events
+
+    return asyncio.run(run())
+
+
+def ids(events):
+    return [product_id for _, page_ids, _ in events for product_id in page_ids]
+
+
+@pytest.mark.parametrize("paginate", [False, True])
+def test_scan_orders_pages_and_dedups_across_categories(make_parser, paginate):
+    catalog = FakeCatalog({
+        "/a/": [["1", "2"], ["3", "2"]],
+        "/b/": [["3", "4"], ["5"]],
+    }, paginate=paginate)
+    events = scan(make_parser(catalog), ["/a/", "/b/"])
+    assert ids(events) == ["1", "2", "3", "4", "5"]
+    # По событию на страницу и отметка о завершении каждой категории
+    assert events == [
+        ("/a/", ["1", "2"], False), ("/a/", ["3"], False), ("/a/", [], True),
+        ("/b/", ["4"], False), ("/b/", ["5"], False), ("/b/", [], True),
+    ]
+
+
+def test_empty_page_ends_category(make_parser):
+    catalog = FakeCatalog({"/a/": [["1"], ["2"]]})
+    assert ids(scan(make_parser(catalog), ["/a/"])) == ["1", "2"]
+    assert catalog.requests == [("/a/", 1), ("/a/", 2), ("/a/", 3)]
+
+
+def test_repeated_page_ends_category(make_parser):
+    # Страница за последней повторяет последнюю - новых ID нет, обход категории заканчивается
+    catalog = FakeCatalog({"/a/": [["1"], ["2"]]}, repeat_last=True)
+    assert ids(scan(make_parser(catalog), ["/a/"])) == ["1", "2"]
+    assert catalog.requests == [("/a/", 1), ("/a/", 2), ("/a/", 3)]
+
+
+def test_page_without_new_ids_ends_category(make_parser):
+    # Подкатегория целиком из уже найденных товаров: дальше ее страницы не нужны
+    catalog = FakeCatalog({"/a/": [["1", "2", "3"]], "/a/sub/": [["1", "2"], ["9"]]})
+    events = scan(make_parser(catalog), ["/a/", "/a/sub/"], window=1)
+    assert ids(events) == ["1", "2", "3"]
+    assert ("/a/sub/", [], True) in events
+    # Следующая страница подкатегории отменяется, не дождавшись ответа
+    assert ("/a/sub/", 2) not in catalog.served
+    assert ("/a/sub/", 3) not in catalog.requests
+
+
+@pytest.mark.parametrize("paginate", [False, True])
+def test_stop_cancels_remaining_pages_of_current_category(make_parser, paginate):
+    catalog = FakeCatalog({"/a/": [[str(n)] for n in range(1, 11)], "/b/": [["b1"]]}, paginate=paginate)
+    events = scan(make_parser(catalog), ["/a/", "/b/"], window=1, stop_after=1)
+    assert events == [("/a/", ["1"], False)]
+    # Лимит набран на первой странице: остальные страницы категории отменены
+    assert catalog.served == [("/a/", 1)]
+    assert all(category == "/a/" for category, _ in catalog.requests)
+
+
+def test_max_pages_bounds_category(make_parser):
+    catalog = FakeCatalog({"/a/": [[str(n)] for n in range(1, 31)]}, paginate=True)
+    assert len(ids(scan(make_parser(catalog), ["/a/"]))) == 19
+    assert max(page for _, page in catalog.requests) == 19
+
+
+@pytest.mark.parametrize("failure", [{"status": {"/b/": 500}}, {"challenge": ["/b/"]}])
+def test_failed_category_is_reported_and_scan_continues(make_parser, failure):
+    catalog = FakeCatalog({"/a/": [["1"]], "/b/": [["2"]], "/c/": [["3"]]}, **failure)
+    failures = []
+    events = scan(make_parser(catalog), ["/a/", "/b/", "/c/"], failures=failures)
+    assert ids(events) == ["1", "3"]
+    assert failures == ["/b/"]
+    # Неудачная категория не отмечается завершенной - ее выход не записывается
+    assert ("/b/", [], True) not in events
+
+
+def test_not_found_page_ends_category_without_failure(make_parser):
+    catalog = FakeCatalog({"/a/": [["1"]], "/b/": [["2"]]}, status={"/b/": 404})
+    failures = []
+    events = scan(make_parser(catalog), ["/a/", "/b/"], failures=failures)
+    assert ids(events) == ["1"]
+    assert failures == []
+    assert ("/b/", [], True) in events
+
+
+COORDS = "55.7558,37.6176"
+
+
+def scrape(parser, limit):
+    """scrape_fast по COORDS с базой из всех товаров каталога; фоновые задачи дожидаются."""
+
+    async def run():
+        products = await parser.scrape_fast("Москва", COORDS, limit=limit)
+        await parser.wait_background()
+        # Запросы, не отмененные при остановке, успели бы получить ответ
+        await asyncio.sleep(0.05)
+        return products
+
+    return asyncio.run(run())
+
+
+def with_heavy_data(parser, catalog):
+    parser.heavy_data = {product_id: {'id': product_id, 'name': f"Товар {product_id}"}
+                         for pages in catalog.pages.values() for page in pages for product_id in page}
+    return parser
+
+
+def cached(parser):
+    return asyncio.run(parser.availability_cache.get(parser.availability_cache.cell(COORDS)))
+
+
+def test_limit_stops_scan_without_background_crawl(make_parser):
+    first = AVAILABILITY_CATEGORIES[0]
+    catalog = FakeCatalog({first: [[str(n)] for n in range(1, 11)]}, paginate=True)
+    parser = with_heavy_data(make_parser(catalog), catalog)
+    products = scrape(parser, limit=1)
+    assert [product['id'] for product in products] == ["1"]
+    # Остальные страницы отменены и не дочитываются в фоне, неполный список не кэшируется
+    assert max(page for _, page in catalog.served) == 1
+    assert cached(parser) is None
+
+
+def test_limit_background_scan_is_opt_in(make_parser, monkeypatch):
+    monkeypatch.setenv("AVAILABILITY_BACKGROUND_SCAN", "1")
+    first = AVAILABILITY_CATEGORIES[0]
+    catalog = FakeCatalog({first: [[str(n)] for n in range(1, 11)]}, paginate=True)
+    parser = with_heavy_data(make_parser(catalog), catalog)
+    assert len(scrape(parser, limit=1)) == 1
+    ids_, _, _ = cached(parser)
+    assert ids_ == [str(n) for n in range(1, 11)]
+
+
+def test_failed_scan_falls_back_to_catalog(make_parser):
+    catalog = FakeCatalog({}, status={category: 500 for category in AVAILABILITY_CATEGORIES})
+    parser = make_parser(catalog)
+    parser.heavy_data = {"1": {'id': "1", 'name': "Суп"}}
+    fallback = []
+
+    async def fallback_catalog_parsing(limit):
+        fallback.append(limit)
+        return [{'id': "catalog"}]
+
+    parser._fallback_catalog_parsing = fallback_catalog_parsing
+    assert scrape(parser, limit=5) == [{'id': "catalog"}]
+    assert fallback == [5]
+    assert cached(parser) is None
+
+
+def test_empty_scan_is_not_a_failure(make_parser):
+    # Каталог ответил, но по адресу ничего нет - пустой результат, без запасного пути
+    catalog = FakeCatalog({})
+    parser = make_parser(catalog)
+    parser.heavy_data = {"1": {'id': "1", 'name': "Суп"}}
+    parser._fallback_catalog_parsing = None
+    assert scrape(parser, limit=5) == []
+
+
+def test_fresh_cell_is_served_without_requests(make_parser):
+    catalog = FakeCatalog({AVAILABILITY_CATEGORIES[0]: [["1", "2"]]})
+    parser = with_heavy_data(make_parser(catalog), catalog)
+    cache = parser.availability_cache
+    asyncio.run(cache.put(cache.cell("55.7560,37.6180"), ["2"]))
+    # Соседний адрес в той же ячейке
+    assert [product['id'] for product in scrape(parser, limit=5)] == ["2"]
+    assert catalog.requests == []
+
+
+def test_stale_cell_is_served_and_refreshed_in_background(make_parser):
+    catalog = FakeCatalog({AVAILABILITY_CATEGORIES[0]: [["1", "2"]]})
+    parser = with_heavy_data(make_parser(catalog), catalog)
+    cache = parser.availability_cache
+    cell = cache.cell(COORDS)
+    asyncio.run(cache.put(cell, ["2"], ts=time.time() - cache.ttl - 60))
+    # Ответ - из устаревшей записи, обход каталога идет в фоне
+    assert [product['id'] for product in scrape(parser, limit=5)] == ["2"]
+    assert catalog.requests
+    ids_, age, _ = cached(parser)
+    assert ids_ == ["1", "2"]
+    assert age < cache.ttl
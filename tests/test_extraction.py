@@ -0,0 +1,165 @@
+"""Индекс текста карточки и порядок стратегий извлечения."""
+
+import re
+
+import pytest
+
+selectolax = pytest.importorskip("selectolax.parser")
+
+from extraction import (  # noqa: E402
+    FIELD_RULES, CardPage, StrategyStats, TextIndex, extract_card, extract_field, listing_price,
+)
+
+HTML = """<!DOCTYPE html>
+<html><head><title>Суп</title></head>
+<body>
+  <div class="menu">Меню <span>Каталог</span> Салат 120 г</div>
+  <!-- комментарий: Состав 999 -->
+  <div class="Product__content">
+    <h1>Суп <b>куриный</b> с лапшой</h1>
+    <div class="ProductWeight">Вес: 250 г</div>
+    <p>Состав: вода, курица, лапша. Белки <span>4,5</span> г, Жиры 2 г</p>
+    <table><tr><td>Ккал</td><td>52</td></tr><tr><td>Углеводы</td><td>6,1</td></tr></table>
+    <div>İSTANBUL и ещё 12/34 текст</div>
+  </div>
+</body></html>"""
+
+
+def _elements(root):
+    """Элементы в порядке документа - те же, что попадают в TextIndex."""
+    return [node for node in root.traverse(include_text=False)
+            if node.tag[0] not in '-_!']
+
+
+@pytest.fixture
+def parsed():
+    parser = selectolax.HTMLParser(HTML)
+    return parser, TextIndex(parser.root)
+
+
+def test_element_text_matches_selectolax(parsed):
+    parser, index = parsed
+    nodes = _elements(parser.root)
+    assert len(index.elements) == len(nodes)
+    for i, node in enumerate(nodes):
+        assert index.elements[i][0] == node.tag
+        assert index.element_text(i) == node.text()
+        assert index.element_lower(i) == node.text().lower()
+
+
+def test_numbers_in_matches_findall(parsed):
+    parser, index = parsed
+    for i, node in enumerate(_elements(parser.root)):
+        assert index.numbers_in(i) == len(re.findall(r'\d+', node.text()))
+
+
+@pytest.mark.parametrize("tags, keywords", [
+    (("div", "p", "span"), ("состав",)),
+    (("td", "span", "div"), ("ккал", "углеводы")),
+    (("h1", "b"), ("курин",)),
+    (("div",), ("istanbul", "нет такого")),
+])
+def test_candidates_match_css_scan(parsed, tags, keywords):
+    parser, index = parsed
+    expected = [node.text() for node in parser.css(", ".join(tags))
+                if any(keyword in node.text().lower() for keyword in keywords)]
+    assert [index.element_text(i) for i in index.candidates(tags, keywords)] == expected
+
+
+def test_candidates_without_lowercase_offsets():
+    # "İ" меняет длину при lower(): индекс переходит на поиск по тексту элементов
+    parser = selectolax.HTMLParser("<div><p>İ Состав: мука</p><p>вода</p></div>")
+    index = TextIndex(parser.root)
+    assert index.lower is None
+    assert [index.element_text(i) for i in index.candidates(("p",), ("состав",))] == ["İ Состав: мука"]
+
+
+def _names(strategies):
+    return [strategy.name for strategy in strategies]
+
+
+def test_default_order_follows_cost():
+    for rules in FIELD_RULES.values():
+        costs = [strategy.cost for strategy in rules]
+        assert costs == sorted(costs)
+    assert StrategyStats().order('portion_g') == FIELD_RULES['portion_g']
+
+
+@pytest.mark.parametrize("field", list(FIELD_RULES))
+def test_order_without_observations_puts_catch_all_last(field):
+    order = StrategyStats().order(field)
+    specific = [strategy for strategy in FIELD_RULES[field] if not strategy.catch_all]
+    catch_all = [strategy for strategy in FIELD_RULES[field] if strategy.catch_all]
+    # Внутри групп - по цене, как в FIELD_RULES
+    assert order == specific + catch_all
+
+
+def test_first_observation_does_not_change_group_order():
+    stats = StrategyStats()
+    before = _names(stats.order('price'))
+    # В FIELD_RULES общий css:any-price (цена 5) стоит перед точным regex:json (цена 6)
+    assert before.index('regex:json') < before.index('css:any-price')
+    stats.record('price', 'jsonld', True, 0.001)
+    assert _names(stats.order('price')) == before
+
+
+def test_observed_fast_strategy_moves_up_within_specific_group():
+    stats = StrategyStats(min_samples=5)
+    for _ in range(10):
+        stats.record('portion_g', 'regex:labeled', True, 0.0001)
+        stats.record('portion_g', 'jsonld', False, 0.001)
+    order = _names(stats.order('portion_g'))
+    assert order.index('regex:labeled') < order.index('jsonld')
+    assert order[-1] == 'regex:html'
+
+
+def test_catch_all_stays_after_specific_strategies():
+    stats = StrategyStats(min_samples=5)
+    for _ in range(50):
+        # Общий перебор быстрый и всегда что-то находит - но не обгоняет точные
+        stats.record('portion_g', 'regex:html', True, 0.00001)
+        stats.record('portion_g', 'css:weight', True, 0.01)
+    order = stats.order('portion_g')
+    specific = [strategy for strategy in order if not strategy.catch_all]
+    assert order[:len(specific)] == specific
+    assert _names(order)[-1] == 'regex:html'
+
+
+def test_catch_all_does_not_take_field_from_precise_selector():
+    stats = StrategyStats(min_samples=5)
+    for _ in range(50):
+        stats.record('portion_g', 'regex:html', True, 0.00001)
+    value, source = extract_field(CardPage(HTML), 'portion_g', stats=stats)
+    # В меню выше по странице "Салат 120 г" - вес чужого товара
+    assert source == 'css:weight'
+    assert value.startswith('250')
+
+
+def test_extract_card_prefers_jsonld():
+    html = HTML.replace('</head>', '<script type="application/ld+json">'
+                        '{"@type": "Product", "name": "Суп из JSON-LD", "offers": {"price": "189"}}'
+                        '</script></head>')
+    values, sources, log = extract_card(html.encode('utf-8'), 'https://vkusvill.ru/goods/sup-1.html')
+    assert values['name'] == 'Суп из JSON-LD'
+    assert sources['name'] == 'jsonld'
+    assert sources['price'] == 'jsonld'
+    assert log.found
+
+
+@pytest.mark.parametrize("tile, price", [
+    ('<span class="ProductCard__price">199 ₽</span>', '199'),
+    # Старая цена перед текущей
+    ('<div class="ProductCard__prices"><span class="ProductCard__priceOld">299 ₽</span>'
+     '<span class="ProductCard__price">249 ₽</span></div>', '249'),
+    ('<div class="Price"><s>299</s> 249 ₽</div>', '249'),
+    ('<span class="price price--old">299</span><span class="price">249</span>', '249'),
+    # Цена за килограмм
+    ('<span class="Price__unit">830 ₽/кг</span><span class="Price">249 ₽</span>', '249'),
+    # Точные селекторы раньше общих, как у стратегий карточки
+    ('<span class="price">299</span><span class="js-product-price">249</span>', '249'),
+    ('<meta itemprop="price" content="249"><span class="price">299</span>', '249'),
+    ('<p>Суп</p>', ''),
+])
+def test_listing_price_takes_current_price(tile, price):
+    parser = selectolax.HTMLParser(f'<div class="ProductCard">{tile}</div>')
+    assert listing_price(parser.css_first('.ProductCard')) == price
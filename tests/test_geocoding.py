@@ -0,0 +1,108 @@
+"""Геокодирование: нормализация адресов, кэши и один общий запрос на адрес."""
+
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+from geocoding import GeocodingService, OfflineGazetteer, normalize_address
+
+
+class FakeNominatim:
+    """Блокирующий geocode, как у geopy: отвечает через delay секунд."""
+
+    def __init__(self, known, delay=0.1):
+        self.known = known
+        self.delay = delay
+        self.calls = []
+
+    def geocode(self, address, timeout=None):
+        self.calls.append((address, time.monotonic(), threading.current_thread()))
+        time.sleep(self.delay)
+        coords = self.known.get(address)
+        return SimpleNamespace(latitude=coords[0], longitude=coords[1]) if coords else None
+
+
+def make_service(tmp_path, known, **kwargs):
+    service = GeocodingService(cache_path=str(tmp_path / "geocode.json"), backends=[], online=False, **kwargs)
+    service.nominatim = FakeNominatim(known)
+    return service
+
+
+def test_normalize_address_unifies_spelling():
+    assert normalize_address("г. Москва,  ул. Тверская, д. 1") == "москва, улица тверская, 1"
+    assert normalize_address("СПб, Невский пр-т, 1") == normalize_address("Санкт-Петербург, Невский проспект, 1")
+
+
+def test_gazetteer_answers_without_online_request(tmp_path):
+    service = make_service(tmp_path, {})
+    service.backends = [OfflineGazetteer()]
+    assert asyncio.run(service.geocode("СПб, Невский просп., 1")) == (59.9311, 30.3609)
+    assert service.nominatim.calls == []
+    assert service.stats['offline'] == 1
+
+
+def test_concurrent_requests_share_one_lookup_without_blocking_loop(tmp_path):
+    service = make_service(tmp_path, {"Москва, ул. Тверская, 7": (55.757, 37.612)})
+
+    async def scenario():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticking = asyncio.ensure_future(ticker())
+        spellings = ["Москва, ул. Тверская, 7", "москва, улица тверская, 7", "г. Москва, ул Тверская, 7"]
+        results = await asyncio.gather(*(service.geocode(address) for address in spellings))
+        ticking.cancel()
+        return results, ticks
+
+    results, ticks = asyncio.run(scenario())
+    assert results == [(55.757, 37.612)] * 3
+    assert len(service.nominatim.calls) == 1
+    assert service.nominatim.calls[0][2] is not threading.main_thread()
+    # Цикл событий продолжал работать, пока поток ждал ответа
+    assert ticks >= 5
+    assert service.stats['online'] == 1 and service.stats['coalesced'] == 2
+
+
+def test_cancelled_waiter_does_not_cancel_shared_lookup(tmp_path):
+    service = make_service(tmp_path, {"Москва, Арбат, 1": (55.752, 37.598)})
+
+    async def scenario():
+        first = asyncio.ensure_future(service.geocode("Москва, Арбат, 1"))
+        second = asyncio.ensure_future(service.geocode("Москва, Арбат, 1"))
+        await asyncio.sleep(0.02)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(scenario()) == (55.752, 37.598)
+    assert len(service.nominatim.calls) == 1
+
+
+def test_online_requests_keep_min_interval(tmp_path):
+    service = make_service(tmp_path, {"Москва, Арбат, 1": (55.752, 37.598),
+                                      "Москва, Арбат, 2": (55.751, 37.597)}, min_interval=0.3)
+
+    async def scenario():
+        await asyncio.gather(service.geocode("Москва, Арбат, 1"), service.geocode("Москва, Арбат, 2"))
+
+    asyncio.run(scenario())
+    (_, first, _), (_, second, _) = service.nominatim.calls
+    assert second - first >= 0.3
+
+
+def test_found_address_is_cached_on_disk_and_missing_is_not(tmp_path):
+    service = make_service(tmp_path, {"Москва, Арбат, 1": (55.752, 37.598)})
+    assert asyncio.run(service.geocode("Москва, Арбат, 1")) == (55.752, 37.598)
+    assert asyncio.run(service.geocode("Нигде, 1")) is None
+    assert service.stats['failed'] == 1
+
+    restarted = make_service(tmp_path, {})
+    assert asyncio.run(restarted.geocode("москва, арбат, 1")) == (55.752, 37.598)
+    assert restarted.nominatim.calls == []
+    assert restarted.stats['cache'] == 1
+    assert "нигде, 1" not in restarted.cache
@@ -0,0 +1,164 @@
+"""Тяжелый обход по поддельному сайту: страницы категорий, инкрементальный режим, расписание обновления."""
+
+import asyncio
+import time
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+selectolax = pytest.importorskip("selectolax.parser")
+
+from antibot import AntiBotClient  # noqa: E402
+from moscow_improved import VkusvillHeavyParser  # noqa: E402
+from refresh import DAY, FreshnessStore, RefreshScheduler  # noqa: E402
+
+FAST_LIMITS = {'catalog': (1000.0, 100), 'card': (1000.0, 100), 'ajax': (1000.0, 100)}
+CATEGORY = "/goods/gotovaya-eda/supy/"
+NUTRITION = {'kcal_100g': '52', 'protein_100g': '4.5', 'fat_100g': '2', 'carb_100g': '6.1'}
+
+
+class FakeSite:
+    """Сайт для httpx.MockTransport: одна категория с плитками и карточки товаров.
+
+    items - id -> (название, цена в плитке). requests - пути запросов.
+    """
+
+    def __init__(self, items):
+        self.items = items
+        self.requests = []
+
+    async def __call__(self, request):
+        path = request.url.path
+        self.requests.append(path)
+        await asyncio.sleep(0.001)
+        if path == CATEGORY and request.url.params.get("page", "1") == "1":
+            tiles = "".join(
+                f'<div class="ProductCard"><a href="/goods/{product_id}.html" title="{name}">{name}</a>'
+                f'<span class="ProductCard__price">{price} ₽</span></div>'
+                for product_id, (name, price) in self.items.items())
+            return httpx.Response(200, text=f"<html><body>{tiles}</body></html>")
+        product_id = path.rsplit("/", 1)[-1][:-len(".html")] if path.endswith(".html") else None
+        if product_id in self.items:
+            name, price = self.items[product_id]
+            return httpx.Response(200, text=(
+                f'<html><body><div class="Product__content"><h1>{name}</h1>'
+                f'<span class="Price">{price} ₽</span>'
+                '<table><tr><td>Ккал</td><td>52</td></tr><tr><td>Белки</td><td>4,5</td></tr>'
+                '<tr><td>Жиры</td><td>2</td></tr><tr><td>Углеводы</td><td>6,1</td></tr></table>'
+                '</div></body></html>'))
+        return httpx.Response(200, text="<html><p>Товаров нет</p></html>")
+
+
+@pytest.fixture
+def make_parser(tmp_path, monkeypatch):
+    monkeypatch.setenv("EXTRACTION_STATS", str(tmp_path / "extraction_stats.json"))
+    clients = []
+
+    def make(site):
+        client = AntiBotClient(rate_limits=FAST_LIMITS)
+        client.transport = httpx.MockTransport(site)
+        clients.append(client)
+        return VkusvillHeavyParser(client, card_workers=4, extract_workers=0)
+
+    yield make
+    for client in clients:
+        asyncio.run(client.close())
+
+
+def known(product_id, name, price):
+    return {'id': product_id, 'name': name, 'price': price,
+            'url': f"https://vkusvill.ru/goods/{product_id}.html", **NUTRITION}
+
+
+def test_scheduler_decides_known_cards_without_snapshot_counters(make_parser):
+    site = FakeSite({
+        "sup-1": ("Суп куриный", "199"),
+        "salat-2": ("Салат цезарь", "249"),
+        "borsch-3": ("Борщ", "159"),
+    })
+    parser = make_parser(site)
+    previous = {
+        "sup-1": known("sup-1", "Суп куриный", "199"),
+        # Цена в плитке изменилась - кандидат на обновление
+        "salat-2": known("salat-2", "Салат цезарь", "229"),
+    }
+    store = FreshnessStore()
+    now = time.time()
+    for product_id in previous:
+        store.items[product_id] = {'first_seen': now, 'last_fetched': now, 'last_changed': None,
+                                   'interval': DAY, 'fetches': 1, 'changes': {}}
+    scheduler = RefreshScheduler(store, budget=5)
+
+    products = asyncio.run(parser.scrape_heavy(10, previous=previous, scheduler=scheduler))
+
+    assert {product['id'] for product in products} == {"sup-1", "salat-2", "borsch-3"}
+    fetched = {path for path in site.requests if path.endswith(".html")}
+    assert fetched == {"/goods/salat-2.html", "/goods/borsch-3.html"}
+    # Каждая карточка учтена один раз - планировщиком
+    assert scheduler.stats == {'budget': 5, 'new': 1, 'new_skipped': 0, 'due': 1, 'not_due': 1,
+                               'fetched': 1, 'carried': 0}
+    assert scheduler.used == 2
+    assert parser.incremental_stats == {'new': 0, 'changed': 0, 'incomplete': 0, 'carried': 0}
+
+
+def test_snapshot_counters_without_scheduler(make_parser):
+    site = FakeSite({"sup-1": ("Суп куриный", "199"), "salat-2": ("Салат цезарь", "249")})
+    parser = make_parser(site)
+    previous = {"sup-1": known("sup-1", "Суп куриный", "199"),
+                "salat-2": known("salat-2", "Салат цезарь", "229")}
+
+    asyncio.run(parser.scrape_heavy(10, previous=previous))
+
+    assert parser.incremental_stats == {'new': 0, 'changed': 1, 'incomplete': 0, 'carried': 1}
+    assert [path for path in site.requests if path.endswith(".html")] == ["/goods/salat-2.html"]
+
+
+class PagedCategory:
+    """Категория из pages страниц по товару; страница 2 отвечает сразу, остальные - через delay."""
+
+    def __init__(self, pages, delay=0.5):
+        self.pages = pages
+        self.delay = delay
+        self.served = []
+
+    async def __call__(self, request):
+        page = int(request.url.params.get("page", "1"))
+        if page > 2:
+            await asyncio.sleep(self.delay)
+        self.served.append(page)
+        pagination = "".join(f'<a href="{CATEGORY}?PAGEN_1={n}">{n}</a>' for n in range(1, self.pages + 1))
+        return httpx.Response(200, text=f'<html><a href="/goods/sup-{page}.html">Суп</a>{pagination}</html>')
+
+
+def test_interrupted_category_awaits_cancelled_pages(make_parser):
+    site = PagedCategory(pages=6)
+    parser = make_parser(site)
+
+    def on_url(url, title, price):
+        if url.endswith("sup-2.html"):
+            raise KeyError("обход прерван")
+
+    async def scenario():
+        with pytest.raises(KeyError):
+            await parser._get_category_products(CATEGORY, 500, on_url=on_url)
+        # Отмененные страницы завершены и вернули слоты клиента
+        pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        return pending, parser.antibot_client.concurrency.in_flight
+
+    pending, in_flight = asyncio.run(scenario())
+    assert pending == []
+    assert in_flight == 0
+    assert sorted(site.served) == [1, 2]
+
+
+def test_discounted_tile_does_not_mark_listing_changed(make_parser):
+    parser = make_parser(FakeSite({}))
+    page = selectolax.HTMLParser(
+        '<div class="ProductCard"><a href="/goods/sup-1.html" title="Суп куриный">Суп</a>'
+        '<div class="ProductCard__prices"><span class="ProductCard__priceOld">239 ₽</span>'
+        '<span class="ProductCard__price">199 ₽</span><span class="ProductCard__priceUnit">796 ₽/кг</span>'
+        '</div></div>')
+    found = []
+    parser._collect_page_links(page, set(), 500, lambda url, title, price: found.append((title, price)))
+    assert found == [("Суп куриный", "199")]
+    assert not parser._listing_changed(known("sup-1", "Суп куриный", "199"), *found[0])
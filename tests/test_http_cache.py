@@ -0,0 +1,158 @@
+"""Дисковый кэш HTTP: свежие записи, перепроверка по ETag / Last-Modified, локации."""
+
+import asyncio
+import time
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+
+from antibot import AntiBotClient, HttpCache  # noqa: E402
+
+FAST_LIMITS = {'catalog': (1000.0, 100), 'card': (1000.0, 100), 'ajax': (1000.0, 100)}
+PAGE = "https://vkusvill.ru/goods/gotovaya-eda/supy/?page=1"
+
+
+class Site:
+    """Страница с валидатором; 304, если клиент прислал совпадающий."""
+
+    def __init__(self, validator='etag'):
+        self.validator = validator
+        self.requests = []
+
+    def __call__(self, request):
+        self.requests.append(request)
+        if self.validator == 'etag':
+            if request.headers.get('if-none-match') == '"v1"':
+                return httpx.Response(304)
+            headers = {'ETag': '"v1"'}
+        else:
+            if request.headers.get('if-modified-since') == 'Wed, 01 Jan 2025 00:00:00 GMT':
+                return httpx.Response(304)
+            headers = {'Last-Modified': 'Wed, 01 Jan 2025 00:00:00 GMT'}
+        headers['Set-Cookie'] = 'session=abc; Path=/'
+        return httpx.Response(200, headers=headers, text=f"<html>{request.url.path}</html>")
+
+
+def make_client(site, cache_dir):
+    client = AntiBotClient(rate_limits=FAST_LIMITS, cache_dir=str(cache_dir))
+    client.transport = httpx.MockTransport(site)
+    return client
+
+
+def run(client, coro_factory):
+    async def main():
+        try:
+            return await coro_factory()
+        finally:
+            await client.close()
+
+    return asyncio.run(main())
+
+
+def test_fresh_entry_is_served_without_request(tmp_path):
+    site = Site()
+    client = make_client(site, tmp_path)
+
+    async def scenario():
+        first = await client.request("GET", PAGE)
+        second = await client.request("GET", PAGE)
+        return first, second
+
+    first, second = run(client, scenario)
+    assert len(site.requests) == 1
+    assert second.status_code == 200 and second.text == first.text
+    assert client.cache.stats['hits'] == 1
+
+
+@pytest.mark.parametrize("validator", ['etag', 'last-modified'])
+def test_stale_entry_is_revalidated(tmp_path, monkeypatch, validator):
+    site = Site(validator)
+    client = make_client(site, tmp_path)
+    real_time = time.time
+
+    async def scenario():
+        await client.request("GET", PAGE)
+        # Запись старше TTL каталога
+        monkeypatch.setattr(time, 'time', lambda: real_time() + 3600)
+        return await client.request("GET", PAGE)
+
+    response = run(client, scenario)
+    assert response.status_code == 200
+    assert response.text == "<html>/goods/gotovaya-eda/supy/</html>"
+    assert len(site.requests) == 2
+    conditional = {'etag': 'if-none-match', 'last-modified': 'if-modified-since'}[validator]
+    assert conditional in site.requests[1].headers
+    assert client.cache.stats['revalidated'] == 1
+
+
+def test_entries_are_separated_by_location(tmp_path):
+    cache = HttpCache(tmp_path)
+    response = httpx.Response(200, headers={'ETag': '"v1"'}, content=b"moscow",
+                              request=httpx.Request("GET", PAGE))
+    cache.store(PAGE, "55.75,37.61", response)
+    assert cache.load(PAGE, "55.75,37.61")['body'] == b"moscow"
+    assert cache.load(PAGE, "59.93,30.33") is None
+    cache.invalidate(PAGE, "55.75,37.61")
+    assert cache.load(PAGE, "55.75,37.61") is None
+
+
+def test_only_cacheable_get_pages(tmp_path):
+    cache = HttpCache(tmp_path)
+    assert cache.cacheable("GET", 'catalog') and cache.cacheable("GET", 'card')
+    assert not cache.cacheable("GET", 'ajax')
+    assert not cache.cacheable("POST", 'catalog')
+
+
+def test_bypass_reaches_site_and_sets_cookies(tmp_path):
+    site = Site()
+    location = "55.7558,37.6176"
+
+    def fetch_main(client, **kwargs):
+        async def scenario():
+            async with client.lease(location) as session:
+                await client.request("GET", "https://vkusvill.ru", **kwargs)
+                return session
+        return scenario
+
+    warm = make_client(site, tmp_path)
+    run(warm, fetch_main(warm))
+    assert len(site.requests) == 1
+
+    # Новая сессия той же локации: из кэша главная страница придет без Set-Cookie
+    client = make_client(site, tmp_path)
+    assert 'session' not in run(client, fetch_main(client)).cookies
+    assert len(site.requests) == 1
+
+    client = make_client(site, tmp_path)
+    session = run(client, fetch_main(client, cache=False))
+    assert len(site.requests) == 2
+    assert session.cookies.get('session') == 'abc'
+
+
+def test_set_location_fetches_main_page_past_cache(tmp_path):
+    pytest.importorskip("selectolax.parser")
+    from address import VkusvillFastParser
+
+    site = Site()
+    location = "55.7558,37.6176"
+    warm = make_client(site, tmp_path)
+
+    async def warm_up():
+        async with warm.lease(location):
+            await warm.request("GET", "https://vkusvill.ru")
+
+    run(warm, warm_up)
+    client = make_client(site, tmp_path)
+    parser = VkusvillFastParser(client)
+
+    async def scenario():
+        async with client.lease(location) as session:
+            await parser._set_location("Москва", location)
+            return session
+
+    session = run(client, scenario)
+    main_requests = [request for request in site.requests if request.url.path == "/"]
+    assert len(main_requests) == 2
+    assert session.cookies.get('session') == 'abc'
+    assert session.location == location
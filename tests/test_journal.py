@@ -0,0 +1,134 @@
+"""Журнал тяжелого обхода: запись, возобновление, устаревание."""
+
+import json
+import time
+
+import pytest
+
+pytest.importorskip("selectolax.parser")
+
+from moscow_improved import CrawlJournal  # noqa: E402
+
+URL_A = "https://vkusvill.ru/goods/sup-1.html"
+URL_B = "https://vkusvill.ru/goods/salat-2.html"
+
+
+def _crawl(path):
+    journal = CrawlJournal(str(path))
+    journal.open()
+    journal.record_url(URL_A, "Суп", "199", "/goods/gotovaya-eda/supy/")
+    journal.record_url(URL_B, "Салат", "149", "/goods/gotovaya-eda/salaty/")
+    journal.record_card(URL_A, {'id': 'sup-1', 'name': 'Суп'})
+    journal.record_category("/goods/gotovaya-eda/supy/")
+    journal.close()
+    return journal
+
+
+def test_resume_restores_cards_frontier_and_categories(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    _crawl(path)
+
+    journal = CrawlJournal(str(path))
+    journal.open(resume=True)
+    assert journal.resumed
+    assert journal.cards == {URL_A: {'id': 'sup-1', 'name': 'Суп'}}
+    assert journal.frontier() == [(URL_B, "Салат", "149", "/goods/gotovaya-eda/salaty/")]
+    assert journal.categories == {"/goods/gotovaya-eda/supy/"}
+    # Продолжение дописывает тот же журнал
+    journal.record_card(URL_B, {'id': 'salat-2', 'name': 'Салат'})
+    journal.close()
+
+    journal = CrawlJournal(str(path))
+    journal.load()
+    assert journal.frontier() == []
+
+
+def test_truncated_last_line_is_skipped(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    _crawl(path)
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"t": "card", "url": "https://vkusvill.ru/goods/obryv')
+
+    journal = CrawlJournal(str(path))
+    journal.open(resume=True)
+    assert journal.resumed
+    assert set(journal.cards) == {URL_A}
+
+
+def test_resume_twice_after_torn_write(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    _crawl(path)
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"t": "card", "url": "https://vkusvill.ru/goods/obryv')
+
+    journal = CrawlJournal(str(path))
+    journal.open(resume=True)
+    journal.record_card(URL_B, {'id': 'salat-2', 'name': 'Салат'})
+    journal.close()
+
+    # Записи продолжения не слиплись с оборванной строкой и читаются при следующем запуске
+    journal = CrawlJournal(str(path))
+    journal.open(resume=True)
+    assert set(journal.cards) == {URL_A, URL_B}
+    journal.close()
+    for line in path.read_text(encoding='utf-8').splitlines():
+        json.loads(line)
+
+
+def test_bad_line_in_the_middle_is_skipped(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    _crawl(path)
+    lines = path.read_text(encoding='utf-8').splitlines()
+    lines.insert(2, '{"t": "url", "url": "https://vkusvill.ru/goods/obryv')
+    path.write_text("\n".join(lines) + "\n", encoding='utf-8')
+
+    journal = CrawlJournal(str(path))
+    journal.load()
+    assert set(journal.cards) == {URL_A}
+    assert journal.categories == {"/goods/gotovaya-eda/supy/"}
+
+
+def test_finished_journal_starts_over(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = _crawl(path)
+    journal.open(resume=True)
+    journal.finish()
+
+    journal = CrawlJournal(str(path))
+    journal.open(resume=True)
+    assert not journal.resumed
+    assert journal.cards == {}
+    journal.close()
+
+
+def test_without_resume_journal_is_rewritten(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    _crawl(path)
+
+    journal = CrawlJournal(str(path))
+    journal.open(resume=False)
+    journal.close()
+    entries = [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+    assert [entry['t'] for entry in entries] == ['start']
+
+
+def test_stale_journal_is_not_resumed(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    _crawl(path)
+    lines = path.read_text(encoding='utf-8').splitlines()
+    header = json.loads(lines[0])
+    header['ts'] = time.time() - 2 * 24 * 3600
+    path.write_text("\n".join([json.dumps(header)] + lines[1:]) + "\n", encoding='utf-8')
+
+    journal = CrawlJournal(str(path))
+    journal.open(resume=True, max_age=24 * 3600)
+    assert not journal.resumed
+    assert journal.frontier() == []
+    journal.close()
+
+    # Без ограничения возраста тот же журнал продолжился бы
+    path.write_text("\n".join([json.dumps(header)] + lines[1:]) + "\n", encoding='utf-8')
+    journal = CrawlJournal(str(path))
+    journal.open(resume=True, max_age=None)
+    assert journal.resumed
+    journal.close()
@@ -0,0 +1,93 @@
+"""Метаданные свежести и выбор карточек для обновления в пределах бюджета."""
+
+from refresh import DAY, FreshnessStore, RefreshScheduler
+
+NOW = 1_000_000.0
+NUTRITION = {'kcal_100g': '52', 'protein_100g': '4.5', 'fat_100g': '2', 'carb_100g': '6.1'}
+
+
+def _record(**fields):
+    return {'name': 'Суп', 'price': '199', **NUTRITION, **fields}
+
+
+def _store(**last_fetched_days_ago):
+    store = FreshnessStore()
+    for product_id, days in last_fetched_days_ago.items():
+        store.observe(product_id, _record(), None, now=NOW - days * DAY)
+    return store
+
+
+def test_interval_doubles_without_changes_and_halves_on_change():
+    store = FreshnessStore(max_interval=4 * DAY)
+    store.observe('sup', _record(), None, now=NOW)
+    assert store.items['sup']['interval'] == DAY
+    for step in range(1, 4):
+        assert store.observe('sup', _record(), _record(), now=NOW + step) == []
+    # Удвоение упирается в max_interval
+    assert store.items['sup']['interval'] == 4 * DAY
+    assert store.observe('sup', _record(price='209'), _record(), now=NOW + 10) == ['price']
+    assert store.items['sup']['interval'] == 2 * DAY
+    assert store.volatility('sup') == 1 / 5
+
+
+def test_overdue_in_intervals():
+    store = _store(sup=0.5, salat=3)
+    assert store.overdue('sup', now=NOW) == -0.5
+    assert store.overdue('salat', now=NOW) == 2
+    assert store.overdue('novyy', now=NOW) is None
+
+
+def test_priority_order_and_not_due():
+    store = _store(fresh=0.5, due=1.5, volatile=1.5)
+    store.observe('volatile', _record(price='209'), _record(), now=NOW - 1.5 * DAY)
+    scheduler = RefreshScheduler(store)
+    # Еще рано - не загружается и учитывается как перенесенный
+    assert scheduler.priority('fresh', _record(), False, now=NOW) is None
+    assert scheduler.stats['not_due'] == 1
+    changed = scheduler.priority('fresh', _record(), True, now=NOW)
+    incomplete = scheduler.priority('due', _record(kcal_100g=''), False, now=NOW)
+    volatile = scheduler.priority('volatile', _record(), False, now=NOW)
+    due = scheduler.priority('due', _record(), False, now=NOW)
+    assert changed > incomplete > volatile > due
+    # Товар из снимка без метаданных считается подошедшим
+    assert scheduler.priority('snapshot-only', _record(), False, now=NOW) is not None
+
+
+def test_select_ranks_candidates_and_keeps_ties_in_offer_order():
+    scheduler = RefreshScheduler(FreshnessStore())
+    for priority, item in [(1.0, 'a'), (3.0, 'b'), (1.0, 'c'), (2.0, 'd')]:
+        scheduler.offer(priority, item)
+    assert scheduler.select() == ['b', 'd', 'a', 'c']
+    assert scheduler.select() == []
+    assert scheduler.stats['due'] == 4
+
+
+def test_budget_is_charged_only_on_admission():
+    scheduler = RefreshScheduler(FreshnessStore(), budget=3)
+    scheduler.offer(1.0, 'a')
+    scheduler.offer(2.0, 'b')
+    assert scheduler.used == 0
+    assert scheduler.admit_new() and scheduler.admit_new()
+    ranked = scheduler.select()
+    admitted = [item for item in ranked if scheduler.admit_due()]
+    assert admitted == ['b']
+    assert not scheduler.admit_new()
+    assert scheduler.used == 3
+    assert scheduler.stats == {'budget': 3, 'new': 2, 'new_skipped': 1, 'due': 2, 'not_due': 0,
+                               'fetched': 1, 'carried': 1}
+
+
+def test_unlimited_budget():
+    scheduler = RefreshScheduler(FreshnessStore())
+    assert all(scheduler.admit_new() for _ in range(100))
+    assert scheduler.used == 100
+
+
+def test_store_round_trip(tmp_path):
+    path = tmp_path / "sub" / "freshness.json"
+    store = FreshnessStore(str(path))
+    store.observe('sup', _record(), None, now=NOW)
+    store.save()
+    assert FreshnessStore.load(str(path)).items == store.items
+    path.write_text("{не json", encoding='utf-8')
+    assert FreshnessStore.load(str(path)).items == {}
@@ -17,14 +17,17 @@ try:
 except ImportError:
     HTMLParser = None
 
-import httpx
+from antibot import AntiBotClient, SiteBlocked
 
 
 class AddressVerifier:
     """Класс для проверки правильности данных по адресу."""
     
-    def __init__(self):
+    def __init__(self, antibot_client: AntiBotClient = None):
         self.BASE_URL = "https://vkusvill.ru"
+        # Общий клиент: cookies локации сохраняются между проверками,
+        # частоту запросов ограничивает его лимитер
+        self.antibot_client = antibot_client or AntiBotClient(timeout=30)
         
     async def verify_csv_file(self, csv_file: str, address: str, sample_size: int = 10):
         """Проверка CSV файла - доступны ли товары по адресу."""
@@ -56,6 +59,28 @@ class AddressVerifier:
         print(f"🎲 Выбрана случайная выборка: {len(sample_products)} товаров")
         print()
         
+        try:
+            available_count, unavailable_count, error_count = await self._verify_sample(sample_products, address)
+        finally:
+            await self.antibot_client.close()
+        
+        # Итоговая статистика
+        print("📊 РЕЗУЛЬТАТЫ ПРОВЕРКИ")
+        print("=" * 30)
+        print(f"✅ Доступно: {available_count} ({available_count/len(sample_products)*100:.1f}%)")
+        print(f"❌ Недоступно: {unavailable_count} ({unavailable_count/len(sample_products)*100:.1f}%)")
+        print(f"⚠️ Ошибки: {error_count} ({error_count/len(sample_products)*100:.1f}%)")
+        print()
+        
+        if available_count / len(sample_products) >= 0.8:
+            print("🎉 ДАННЫЕ КОРРЕКТНЫ - большинство товаров доступны по адресу!")
+        elif available_count / len(sample_products) >= 0.5:
+            print("⚠️ ДАННЫЕ ЧАСТИЧНО КОРРЕКТНЫ - около половины товаров доступны")
+        else:
+            print("❌ ДАННЫЕ НЕКОРРЕКТНЫ - большинство товаров недоступны по адресу")
+    
+    async def _verify_sample(self, sample_products: List[Dict], address: str):
+        """Проверить выборку товаров, вернуть (доступно, недоступно, ошибок)."""
         # Устанавливаем геолокацию
         await self._set_location_for_verification(address)
         
@@ -85,24 +110,9 @@ class AddressVerifier:
                 error_count += 1
                 print(f"   ⚠️ ОШИБКА ПРОВЕРКИ: {e}")
             
-            # Пауза между проверками
-            await asyncio.sleep(1)
             print()
         
-        # Итоговая статистика
-        print("📊 РЕЗУЛЬТАТЫ ПРОВЕРКИ")
-        print("=" * 30)
-        print(f"✅ Доступно: {available_count} ({available_count/len(sample_products)*100:.1f}%)")
-        print(f"❌ Недоступно: {unavailable_count} ({unavailable_count/len(sample_products)*100:.1f}%)")
-        print(f"⚠️ Ошибки: {error_count} ({error_count/len(sample_products)*100:.1f}%)")
-        print()
-        
-        if available_count / len(sample_products) >= 0.8:
-            print("🎉 ДАННЫЕ КОРРЕКТНЫ - большинство товаров доступны по адресу!")
-        elif available_count / len(sample_products) >= 0.5:
-            print("⚠️ ДАННЫЕ ЧАСТИЧНО КОРРЕКТНЫ - около половины товаров доступны")
-        else:
-            print("❌ ДАННЫЕ НЕКОРРЕКТНЫ - большинство товаров недоступны по адресу")
+        return available_count, unavailable_count, error_count
     
     async def _set_location_for_verification(self, address: str):
         """Установка геолокации для проверки."""
@@ -119,16 +129,9 @@ class AddressVerifier:
             
             lat, lon = coords.split(',')
             
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'ru-RU,ru;q=0.8,en-US;q=0.5,en;q=0.3',
-            }
-            
-            async with httpx.AsyncClient(timeout=30, headers=headers) as client:
-                location_url = f"{self.BASE_URL}/api/location?city={city}&lat={lat.strip()}&lon={lon.strip()}"
-                await client.get(location_url)
-                print(f"📍 Геолокация установлена: {address}")
+            location_url = f"{self.BASE_URL}/api/location?city={city}&lat={lat.strip()}&lon={lon.strip()}"
+            await self.antibot_client.request(method="GET", url=location_url)
+            print(f"📍 Геолокация установлена: {address}")
                 
         except Exception as e:
             print(f"⚠️ Ошибка установки геолокации: {e}")
@@ -136,42 +139,38 @@ class AddressVerifier:
     async def _check_product_availability(self, product_url: str, product_id: str) -> bool:
         """Проверка доступности конкретного товара по адресу."""
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'ru-RU,ru;q=0.8,en-US;q=0.5,en;q=0.3',
-            }
+            response = await self.antibot_client.request(method="GET", url=product_url)
             
-            async with httpx.AsyncClient(timeout=30, headers=headers) as client:
-                response = await client.get(product_url)
-                
-                if response.status_code != 200:
-                    return False
-                
-                if not HTMLParser:
-                    # Простая проверка по тексту
-                    return "недоступен" not in response.text.lower() and "нет в наличии" not in response.text.lower()
-                
-                parser = HTMLParser(response.text)
-                
-                # Проверяем наличие кнопки "В корзину" или цены
-                buy_buttons = parser.css('.buy-button, [data-testid*="buy"], .add-to-cart, .price')
-                if buy_buttons:
-                    return True
-                
-                # Проверяем что нет сообщений о недоступности
-                unavailable_indicators = [
-                    'недоступен', 'нет в наличии', 'закончился', 
-                    'временно недоступен', 'out of stock'
-                ]
-                
-                page_text = response.text.lower()
-                for indicator in unavailable_indicators:
-                    if indicator in page_text:
-                        return False
-                
+            if response.status_code != 200:
+                return False
+            
+            if not HTMLParser:
+                # Простая проверка по тексту
+                return "недоступен" not in response.text.lower() and "нет в наличии" not in response.text.lower()
+            
+            parser = HTMLParser(response.text)
+            
+            # Проверяем наличие кнопки "В корзину" или цены
+            buy_buttons = parser.css('.buy-button, [data-testid*="buy"], .add-to-cart, .price')
+            if buy_buttons:
                 return True
-                
+            
+            # Проверяем что нет сообщений о недоступности
+            unavailable_indicators = [
+                'недоступен', 'нет в наличии', 'закончился', 
+                'временно недоступен', 'out of stock'
+            ]
+            
+            page_text = response.text.lower()
+            for indicator in unavailable_indicators:
+                if indicator in page_text:
+                    return False
+            
+            return True
+            
+        except SiteBlocked:
+            # Блокировка - это ошибка проверки, а не отсутствие товара
+            raise
         except Exception:
             return False
 